@@ -0,0 +1,107 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import sys
+import json
+import logging
+import argparse
+
+from benchmarks.synthetic import Layout, generate
+from benchmarks.harness import MODES, run_benchmark, compare
+
+
+def parse_args():
+    """Parse arguments of the benchmark suite.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='benchmarks',
+        description="SoFiAX ingest and merge benchmarks."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="write a synthetic SoFiA output field")
+    gen.add_argument("--out", required=True, help="output directory")
+    gen.add_argument("--sources", type=int, default=1000, help="sources in the field")
+    gen.add_argument("--tiles", default="2x2", help="tile layout, e.g. 3x2")
+    gen.add_argument("--tile-size", type=int, default=500, help="tile size in pixels")
+    gen.add_argument("--depth", type=int, default=500, help="channels")
+    gen.add_argument("--overlap", type=float, default=0.1,
+                     help="fraction of a tile overlapping each neighbour")
+    gen.add_argument("--jitter", type=float, default=0.02,
+                     help="relative noise between measurements of the same source")
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--no-cubelets", action="store_true", help="catalogs only")
+    gen.add_argument("--ascii", action="store_true",
+                     help="also write ASCII catalogs, read in place of the VOTables")
+
+    run = commands.add_parser("run", help="ingest a generated field")
+    run.add_argument("--data", required=True, help="generated field directory")
+    run.add_argument("--dsn", required=True,
+                     help="throwaway database, e.g. postgresql://postgres@localhost/bench")
+    run.add_argument("--schema", default="sofiax_benchmark",
+                     help="schema dropped and recreated for every case")
+    run.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    run.add_argument("--processes", type=int, default=1, help="concurrent instances")
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE",
+                     help="extra SoFiAX configuration options")
+    run.add_argument("--output", default="results.json")
+
+    cmp = commands.add_parser("compare", help="compare two result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("results")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format="%(asctime)s - %(levelname)s - %(message)s")
+    args = parse_args()
+
+    if args.command == "generate":
+        nx, ny = (int(i) for i in args.tiles.lower().split("x"))
+        layout = Layout(nx, ny, args.tile_size, args.depth, args.overlap)
+        params = generate(args.out, args.sources, layout, args.jitter, args.seed,
+                          not args.no_cubelets, args.ascii)
+        logging.info(f"Wrote {len(params)} instances to {args.out}")
+
+    elif args.command == "run":
+        extra = dict(item.split("=", 1) for item in args.set)
+        results = run_benchmark(args.data, args.dsn, args.modes, args.processes,
+                                args.schema, args.repeat, extra)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        for case in results["cases"]:
+            logging.info(
+                f"{case['mode']}: {case['wall_seconds']:.2f}s, "
+                f"{case['sources_per_second']:.1f} sources/s, "
+                f"{case['queries']} queries, "
+                f"peak RSS {case['peak_rss_bytes'] / 1024 ** 2:.0f} MB")
+
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.results) as f:
+            results = json.load(f)
+        compare(baseline, results)
+
+
+if __name__ == "__main__":
+    main()
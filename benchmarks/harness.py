@@ -0,0 +1,229 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import platform
+import resource
+import subprocess
+import collections
+import multiprocessing
+import asyncpg
+
+from urllib.parse import urlparse
+from concurrent.futures import ProcessPoolExecutor
+
+
+# ingest modes: direct import, merge with concurrent instances, offline merge
+MODES = ('direct', 'merge', 'offline')
+
+# metric stages that each issue one database query per call
+QUERY_STAGES = ('lock_wait', 'instance_write', 'match_query', 'detection_insert',
+                'product_insert', 'detection_delete', 'unresolved_update',
+                'run_detections')
+
+SANITY = {
+    'flux': 10,
+    'spatial_extent': (10, 10),
+    'spectral_extent': (10, 10),
+    'uncertainty_sigma': 5
+}
+
+SCHEMA_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+
+
+def dsn_config(dsn: str, schema: str):
+    """SoFiAX configuration for a postgresql:// DSN.
+
+    """
+    url = urlparse(dsn)
+    return {
+        'db_hostname': url.hostname or 'localhost',
+        'db_port': str(url.port or 5432),
+        'db_name': url.path.lstrip('/') or 'postgres',
+        'db_username': url.username or 'postgres',
+        'db_password': url.password or '',
+        'db_schema': schema,
+        'sofia_execute': '0',
+        'sofia_path': 'sofia',
+    }
+
+
+async def reset_schema(dsn: str, schema: str):
+    with open(SCHEMA_SQL) as f:
+        sql = f.read().replace('{schema}', schema)
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        await conn.execute(sql)
+    finally:
+        await conn.close()
+
+
+async def _ingest(config: dict, mode: str, params: list, processes: int):
+    from sofiax.merge import run_merge
+    from sofiax.offline import run_offline_merge
+
+    params = list(params)
+    if mode == 'offline':
+        await run_offline_merge(config, 'benchmark', params, SANITY, [0, 4])
+        return
+
+    tasks = [
+        asyncio.create_task(run_merge(config, 'benchmark', params, SANITY, [0, 4]))
+        for _ in range(processes)
+    ]
+    await asyncio.gather(*tasks)
+
+
+def _run_case(dsn: str, schema: str, mode: str, params: list, processes: int,
+              extra: dict):
+    # runs in a fresh process so peak RSS and metrics belong to the case alone
+    from sofiax.metrics import add_stop_observer
+
+    logging.basicConfig(level=logging.WARNING)
+    config = dsn_config(dsn, schema)
+    config['perform_merge'] = '0' if mode == 'direct' else '1'
+    config['merge_offline'] = '1' if mode == 'offline' else '0'
+    config.update(extra)
+
+    finished = []
+    add_stop_observer(finished.append)
+
+    asyncio.run(reset_schema(dsn, schema))
+    start = time.perf_counter()
+    asyncio.run(_ingest(config, mode, params, processes))
+    wall = time.perf_counter() - start
+
+    stages = collections.Counter()
+    calls = collections.Counter()
+    counters = collections.Counter()
+    for metrics in finished:
+        stages.update(metrics.timers)
+        calls.update(metrics.calls)
+        counters.update(metrics.counters)
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        'wall_seconds': wall,
+        'stages': {k: {'seconds': stages[k], 'calls': calls[k]} for k in sorted(stages)},
+        'counters': dict(sorted(counters.items())),
+        'queries': sum(calls[k] for k in QUERY_STAGES),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_bytes': rss * 1024,
+        'peak_rss_children_bytes': children * 1024,
+    }
+
+
+async def _count_detections(dsn: str, schema: str):
+    conn = await asyncpg.connect(dsn)
+    try:
+        return await conn.fetchval(f'SELECT count(*) FROM {schema}.detection')
+    finally:
+        await conn.close()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(SCHEMA_SQL)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(data_dir: str, dsn: str, modes: list, processes: int = 1,
+                  schema: str = 'sofiax_benchmark', repeat: int = 1, extra: dict = None):
+    """Ingest the synthetic field in data_dir once per mode and repeat into a
+    freshly created schema, returns the results.
+
+    """
+    with open(os.path.join(data_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    data_bytes = 0
+    for root, _, files in os.walk(data_dir):
+        data_bytes += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'manifest': {k: v for k, v in manifest.items() if k != 'params'},
+        'data_bytes': data_bytes,
+        'processes': processes,
+        'cases': []
+    }
+
+    ctx = multiprocessing.get_context('spawn')
+    for mode in modes:
+        if mode not in MODES:
+            raise ValueError(f'Unknown benchmark mode {mode}, expected one of {MODES}')
+        for i in range(repeat):
+            logging.info(f'Running {mode} benchmark {i + 1}/{repeat}')
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+                case = executor.submit(_run_case, dsn, schema, mode, manifest['params'],
+                                       processes, extra or {}).result()
+
+            wall = case['wall_seconds']
+            case['mode'] = mode
+            case['repeat'] = i
+            case['detections_stored'] = asyncio.run(_count_detections(dsn, schema))
+            case['sources_per_second'] = manifest['detections'] / wall if wall > 0 else None
+            case['bytes_per_second'] = data_bytes / wall if wall > 0 else None
+            results['cases'].append(case)
+    return results
+
+
+def summarise(results: dict):
+    """Best of the repeats of each mode.
+
+    """
+    best = {}
+    for case in results['cases']:
+        mode = case['mode']
+        if mode not in best or case['wall_seconds'] < best[mode]['wall_seconds']:
+            best[mode] = case
+    return best
+
+
+def compare(baseline: dict, results: dict, out=sys.stdout):
+    """Print the change of each mode between two result files.
+
+    """
+    out.write(f"baseline {baseline.get('commit')}  new {results.get('commit')}\n")
+    old = summarise(baseline)
+    new = summarise(results)
+    keys = ('wall_seconds', 'sources_per_second', 'bytes_per_second', 'queries',
+            'peak_rss_bytes')
+    for mode in MODES:
+        if mode not in old or mode not in new:
+            continue
+        out.write(f'{mode}:\n')
+        for key in keys:
+            a, b = old[mode].get(key), new[mode].get(key)
+            change = f'{100.0 * (b - a) / a:+.1f}%' if a and b is not None else '-'
+            out.write(f'  {key:<20s} {a!s:>20s} {b!s:>20s} {change:>8s}\n')
@@ -0,0 +1,86 @@
+--
+-- Copyright (c) 2021 AusSRC.
+--
+-- This file is part of SoFiAX
+-- (see https://github.com/AusSRC/SoFiAX).
+--
+-- This program is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Lesser General Public License as published by
+-- the Free Software Foundation, either version 2.1 of the License, or
+-- (at your option) any later version.
+--
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU Lesser General Public License for more details.
+--
+-- You should have received a copy of the GNU Lesser General Public License
+-- along with this program. If not, see <http://www.gnu.org/licenses/>.--
+
+-- Minimal copy of the SoFiAX_services tables written by SoFiAX, used to
+-- benchmark against a throwaway database. {schema} is replaced by the harness.
+
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE SCHEMA {schema};
+
+CREATE TABLE {schema}.run (
+    id bigserial PRIMARY KEY,
+    name varchar NOT NULL UNIQUE,
+    sanity_thresholds jsonb NOT NULL
+);
+
+CREATE TABLE {schema}.instance (
+    id bigserial PRIMARY KEY,
+    run_id bigint NOT NULL REFERENCES {schema}.run (id) ON DELETE CASCADE,
+    filename varchar NOT NULL,
+    boundary integer[] NOT NULL,
+    run_date timestamp without time zone NOT NULL,
+    flag_log bytea,
+    reliability_plot bytea,
+    log bytea,
+    parameters jsonb NOT NULL,
+    version varchar,
+    return_code integer,
+    stdout bytea,
+    stderr bytea,
+    UNIQUE (run_id, filename, boundary)
+);
+
+CREATE TABLE {schema}.detection (
+    id bigserial PRIMARY KEY,
+    instance_id bigint NOT NULL REFERENCES {schema}.instance (id) ON DELETE CASCADE,
+    run_id bigint NOT NULL REFERENCES {schema}.run (id) ON DELETE CASCADE,
+    name varchar NOT NULL,
+    access_url varchar,
+    x double precision NOT NULL,
+    y double precision NOT NULL,
+    z double precision NOT NULL,
+    x_min numeric, x_max numeric, y_min numeric, y_max numeric,
+    z_min numeric, z_max numeric, n_pix numeric,
+    f_min double precision, f_max double precision, f_sum double precision,
+    rel double precision, rms double precision,
+    w20 double precision, w50 double precision, wm50 double precision,
+    ell_maj double precision, ell_min double precision, ell_pa double precision,
+    ell3s_maj double precision, ell3s_min double precision, ell3s_pa double precision,
+    kin_pa double precision,
+    ra double precision, dec double precision, l double precision, b double precision,
+    v_rad double precision, v_opt double precision, v_app double precision,
+    err_x double precision NOT NULL, err_y double precision NOT NULL,
+    err_z double precision NOT NULL, err_f_sum double precision,
+    freq double precision, flag integer,
+    x_peak integer, y_peak integer, z_peak integer,
+    ra_peak double precision, dec_peak double precision, freq_peak double precision,
+    l_peak double precision, b_peak double precision,
+    v_rad_peak double precision, v_opt_peak double precision, v_app_peak double precision,
+    unresolved boolean DEFAULT false NOT NULL,
+    UNIQUE (name, x, y, z, x_min, x_max, y_min, y_max, z_min, z_max,
+            n_pix, f_min, f_max, f_sum, instance_id, run_id)
+);
+
+CREATE TABLE {schema}.product (
+    id bigserial PRIMARY KEY,
+    detection_id bigint NOT NULL UNIQUE REFERENCES {schema}.detection (id) ON DELETE CASCADE,
+    cube bytea, mask bytea, mom0 bytea, mom1 bytea, mom2 bytea,
+    chan bytea, spec bytea, pv bytea
+);
@@ -0,0 +1,401 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import io
+import os
+import json
+import numpy as np
+
+from datetime import datetime
+from xml.sax.saxutils import escape
+from astropy.io import fits
+
+from sofiax import products
+
+
+# SoFiA-2 catalog fields with their VOTable datatype
+FIELDS = (
+    ('name', 'char'), ('id', 'long'), ('x', 'double'), ('y', 'double'),
+    ('z', 'double'), ('x_min', 'long'), ('x_max', 'long'), ('y_min', 'long'),
+    ('y_max', 'long'), ('z_min', 'long'), ('z_max', 'long'), ('n_pix', 'long'),
+    ('f_min', 'double'), ('f_max', 'double'), ('f_sum', 'double'),
+    ('rel', 'double'), ('flag', 'long'), ('rms', 'double'), ('w20', 'double'),
+    ('w50', 'double'), ('wm50', 'double'), ('ell_maj', 'double'),
+    ('ell_min', 'double'), ('ell_pa', 'double'), ('ell3s_maj', 'double'),
+    ('ell3s_min', 'double'), ('ell3s_pa', 'double'), ('kin_pa', 'double'),
+    ('err_x', 'double'), ('err_y', 'double'), ('err_z', 'double'),
+    ('err_f_sum', 'double'), ('ra', 'double'), ('dec', 'double'),
+    ('freq', 'double'), ('x_peak', 'long'), ('y_peak', 'long'),
+    ('z_peak', 'long'), ('ra_peak', 'double'), ('dec_peak', 'double'),
+    ('freq_peak', 'double'),
+)
+
+CUBELET_PRODUCTS = ('cube', 'mask', 'mom0', 'mom1', 'mom2', 'snr', 'pv')
+
+PIXEL_SCALE = 0.001
+CHANNEL_WIDTH = 18500.0
+REFERENCE_FREQ = 1.4e9
+
+# fraction of the peak of a source model labelled in the SoFiA mask
+MASK_LEVEL = 0.05
+
+
+class Layout(object):
+    """Tiles of tile_size pixels on an nx by ny grid, each tile extended into
+    its neighbours by the overlap fraction.
+
+    """
+    def __init__(self, nx: int, ny: int, tile_size: int, depth: int, overlap: float):
+        self.nx = nx
+        self.ny = ny
+        self.tile_size = tile_size
+        self.depth = depth
+        self.overlap = overlap
+
+    @property
+    def width(self):
+        return self.nx * self.tile_size
+
+    @property
+    def height(self):
+        return self.ny * self.tile_size
+
+    def regions(self):
+        margin = int(round(self.overlap * self.tile_size))
+        for i in range(self.nx):
+            for j in range(self.ny):
+                x0 = max(i * self.tile_size - margin, 0)
+                x1 = min((i + 1) * self.tile_size + margin, self.width) - 1
+                y0 = max(j * self.tile_size - margin, 0)
+                y1 = min((j + 1) * self.tile_size + margin, self.height) - 1
+                yield f"tile_{i}_{j}", [x0, x1, y0, y1, 0, self.depth - 1]
+
+
+def make_sources(layout: Layout, count: int, rng):
+    """Random sources over the whole field, in absolute pixel coordinates.
+
+    """
+    return {
+        'x': rng.uniform(5, layout.width - 5, count),
+        'y': rng.uniform(5, layout.height - 5, count),
+        'z': rng.uniform(10, layout.depth - 10, count),
+        'f_sum': rng.lognormal(1.0, 0.8, count),
+        'ell_maj': rng.uniform(3, 10, count),
+        'ell_min': rng.uniform(1.5, 3, count),
+        'w20': rng.uniform(10, 40, count),
+        'w50': rng.uniform(5, 10, count),
+        'err_x': rng.uniform(0.05, 0.5, count),
+        'err_y': rng.uniform(0.05, 0.5, count),
+        'err_z': rng.uniform(0.1, 1.0, count),
+        'flag': np.where(rng.random(count) < 0.9, 0, 4),
+    }
+
+
+def measure(sources: dict, index: int, region: list, jitter: float, rng):
+    """Catalog row of a source as measured by the instance covering region.
+
+    """
+    def noisy(key):
+        return float(sources[key][index] * (1 + rng.normal(0, jitter)))
+
+    x = sources['x'][index] + rng.normal(0, sources['err_x'][index] / 5) - region[0]
+    y = sources['y'][index] + rng.normal(0, sources['err_y'][index] / 5) - region[2]
+    z = sources['z'][index] + rng.normal(0, sources['err_z'][index] / 5) - region[4]
+    ell_maj = noisy('ell_maj')
+    w20 = noisy('w20')
+
+    width = region[1] - region[0]
+    height = region[3] - region[2]
+    depth = region[5] - region[4]
+    x_min, x_max = max(int(x - ell_maj), 0), min(int(x + ell_maj), width)
+    y_min, y_max = max(int(y - ell_maj), 0), min(int(y + ell_maj), height)
+    z_min, z_max = max(int(z - w20 / 2), 0), min(int(z + w20 / 2), depth)
+
+    ra = 180.0 - (x + region[0]) * PIXEL_SCALE
+    dec = -30.0 + (y + region[2]) * PIXEL_SCALE
+    freq = REFERENCE_FREQ + (z + region[4]) * CHANNEL_WIDTH
+    f_sum = noisy('f_sum')
+    return {
+        'name': f"SoFiA J{ra:09.5f}{dec:+09.5f}",
+        'x': x, 'y': y, 'z': z,
+        'x_min': x_min, 'x_max': x_max, 'y_min': y_min, 'y_max': y_max,
+        'z_min': z_min, 'z_max': z_max,
+        'n_pix': (x_max - x_min + 1) * (y_max - y_min + 1) * (z_max - z_min + 1) // 3,
+        'f_min': -0.01, 'f_max': f_sum / 50, 'f_sum': f_sum,
+        'rel': 1.0, 'flag': int(sources['flag'][index]), 'rms': 0.002,
+        'w20': w20, 'w50': noisy('w50'), 'wm50': noisy('w50'),
+        'ell_maj': ell_maj, 'ell_min': noisy('ell_min'), 'ell_pa': 45.0,
+        'ell3s_maj': ell_maj * 1.5, 'ell3s_min': noisy('ell_min') * 1.5,
+        'ell3s_pa': 45.0, 'kin_pa': 90.0,
+        'err_x': float(sources['err_x'][index]), 'err_y': float(sources['err_y'][index]),
+        'err_z': float(sources['err_z'][index]), 'err_f_sum': f_sum / 20,
+        'ra': ra, 'dec': dec, 'freq': freq,
+        'x_peak': int(x), 'y_peak': int(y), 'z_peak': int(z),
+        'ra_peak': ra, 'dec_peak': dec, 'freq_peak': freq,
+    }
+
+
+def write_votable(path: str, rows: list):
+    lines = [
+        '<?xml version="1.0" ?>',
+        '<VOTABLE version="1.3" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xmlns="http://www.ivoa.net/xml/VOTable/v1.3">',
+        '\t<RESOURCE>',
+        '\t\t<DESCRIPTION>Source catalogue created by the Source Finding Application (SoFiA)</DESCRIPTION>',
+        '\t\t<PARAM name="Creator" datatype="char" arraysize="*" value="SoFiA 2.5.1" ucd="meta.id;meta.software"/>',
+        f'\t\t<PARAM name="Time" datatype="char" arraysize="*" '
+        f'value="{datetime.now().strftime("%a, %d %b %Y, %H:%M:%S")}" ucd="time.creation"/>',
+        '\t\t<TABLE ID="SoFiA_source_catalogue" name="SoFiA source catalogue">',
+    ]
+    for name, datatype in FIELDS:
+        arraysize = ' arraysize="*"' if datatype == 'char' else ''
+        lines.append(f'\t\t\t<FIELD datatype="{datatype}" name="{name}"{arraysize}/>')
+    lines.append('\t\t\t<DATA>')
+    lines.append('\t\t\t\t<TABLEDATA>')
+    for row in rows:
+        cells = ''.join(f'<TD>{escape(str(row[name]))}</TD>' for name, _ in FIELDS)
+        lines.append(f'\t\t\t\t\t<TR>{cells}</TR>')
+    lines.extend(['\t\t\t\t</TABLEDATA>', '\t\t\t</DATA>', '\t\t</TABLE>',
+                  '\t</RESOURCE>', '</VOTABLE>'])
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def write_ascii(path: str, rows: list):
+    """SoFiA-2 ASCII catalog of rows, as written with output.writeCatASCII.
+    Floats are written with 17 significant digits, so the catalog holds the
+    same values as the VOTable of write_votable.
+
+    """
+    names = [name for name, _ in FIELDS]
+    widths = [max(len(name), 24) for name in names]
+    lines = [
+        '# SoFiA source catalogue',
+        '# Creator: SoFiA 2.5.1',
+        f'# Time:    {datetime.now().strftime("%a, %d %b %Y, %H:%M:%S")}',
+        '#',
+        '# Header rows:',
+        '#   1 = column number',
+        '#   2 = parameter name',
+        '#   3 = parameter unit',
+        '#',
+        '#' + ''.join(f'{i:>{w}d}' for i, w in enumerate(widths, start=1)),
+        '#' + ''.join(f'{n:>{w}}' for n, w in zip(names, widths)),
+        '#' + ''.join(f'{"-":>{w}}' for w in widths),
+    ]
+    for row in rows:
+        cells = []
+        for (name, datatype), width in zip(FIELDS, widths):
+            value = row[name]
+            if datatype == 'char':
+                quoted = f'"{value}"'
+                cells.append(f'{quoted:>{width}}')
+            elif datatype == 'long':
+                cells.append(f'{value:>{width}d}')
+            else:
+                cells.append(f'{value:>{width}.16e}')
+        lines.append(' ' + ''.join(cells))
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def wcs_header(x0: int = 0, y0: int = 0, z0: int = 0):
+    """WCS of the field, or of the region of the field starting at x0, y0, z0,
+    matching the ra, dec and freq of measure.
+
+    """
+    header = fits.Header()
+    for axis, ctype, crval, cdelt, crpix in ((1, 'RA---SIN', 180.0, -PIXEL_SCALE, 1 - x0),
+                                             (2, 'DEC--SIN', -30.0, PIXEL_SCALE, 1 - y0),
+                                             (3, 'FREQ', REFERENCE_FREQ, CHANNEL_WIDTH, 1 - z0)):
+        header[f'CTYPE{axis}'] = ctype
+        header[f'CRVAL{axis}'] = crval
+        header[f'CDELT{axis}'] = cdelt
+        header[f'CRPIX{axis}'] = crpix
+    header['CUNIT3'] = 'Hz'
+    return header
+
+
+def create_fits(path: str, shape: tuple, dtype, header: fits.Header):
+    """Zero filled FITS cube of shape written without holding it in memory
+    (sparse where the file system allows), to fill through a memory map.
+
+    """
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1, 1), dtype=dtype))
+    for axis, size in enumerate(reversed(shape), start=1):
+        hdu.header[f'NAXIS{axis}'] = size
+    hdu.header.update(header)
+    hdu.header.tofile(path, overwrite=True)
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    with open(path, 'rb+') as f:
+        f.seek(len(hdu.header.tostring()) + -(-nbytes // 2880) * 2880 - 1)
+        f.write(b'\0')
+
+
+def source_model(sources: dict, index: int, layout: Layout):
+    """Flux of a source in the field, Gaussian in position and frequency and
+    summing to f_sum. Returns the (z, y, x) offset of the model and the model.
+
+    """
+    x, y, z = sources['x'][index], sources['y'][index], sources['z'][index]
+    radius = sources['ell_maj'][index]
+    half_width = sources['w20'][index] / 2
+    x0, x1 = max(int(x - radius), 0), min(int(x + radius), layout.width - 1)
+    y0, y1 = max(int(y - radius), 0), min(int(y + radius), layout.height - 1)
+    z0, z1 = max(int(z - half_width), 0), min(int(z + half_width), layout.depth - 1)
+
+    zz, yy, xx = np.ogrid[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1]
+    spatial = ((xx - x) ** 2 + (yy - y) ** 2) / (radius / 2) ** 2
+    model = np.exp(-0.5 * (spatial + ((zz - z) / (half_width / 2)) ** 2))
+    model *= sources['f_sum'][index] / model.sum()
+    return (z0, y0, x0), model.astype(np.float32)
+
+
+def write_field(path: str, sources: dict, layout: Layout):
+    """The noise free parent cube of the field holding every source.
+
+    """
+    create_fits(path, (layout.depth, layout.height, layout.width), np.float32, wcs_header())
+    with fits.open(path, mode='update', memmap=True) as hdul:
+        data = hdul[0].data
+        for index in range(len(sources['x'])):
+            (z0, y0, x0), model = source_model(sources, index, layout)
+            nz, ny, nx = model.shape
+            data[z0:z0 + nz, y0:y0 + ny, x0:x0 + nx] += model
+
+
+def write_mask(path: str, sources: dict, layout: Layout, region: list, rows: list,
+               indices: list):
+    """SoFiA mask of the instance of region, each row (a source of indices)
+    labelled with its catalog id where its model is above MASK_LEVEL of its
+    peak, within the bounding box of the row.
+
+    """
+    x_off, y_off, z_off = region[0], region[2], region[4]
+    shape = (region[5] - z_off + 1, region[3] - y_off + 1, region[1] - x_off + 1)
+    create_fits(path, shape, np.int32, wcs_header(x_off, y_off, z_off))
+    with fits.open(path, mode='update', memmap=True) as hdul:
+        data = hdul[0].data
+        for row, index in zip(rows, indices):
+            (z0, y0, x0), model = source_model(sources, index, layout)
+            labelled = model >= MASK_LEVEL * model.max()
+            # the model in region coordinates, clipped to the bounding box
+            box = [(max(start - off, lo), min(start - off + n - 1, hi))
+                   for start, off, n, lo, hi in zip(
+                       (z0, y0, x0), (z_off, y_off, x_off), model.shape,
+                       (row['z_min'], row['y_min'], row['x_min']),
+                       (row['z_max'], row['y_max'], row['x_max']))]
+            if any(lo > hi for lo, hi in box):
+                continue
+            (za, zb), (ya, yb), (xa, xb) = box
+            sub = labelled[za + z_off - z0:zb + z_off - z0 + 1,
+                           ya + y_off - y0:yb + y_off - y0 + 1,
+                           xa + x_off - x0:xb + x_off - x0 + 1]
+            data[za:zb + 1, ya:yb + 1, xa:xb + 1][sub] = row['id']
+
+
+def write_cubelets(cubelet_dir: str, output_filename: str, row: dict, field_path: str,
+                   mask_path: str, region: list):
+    """SoFiA cubelets of a row cut out of the field and the instance mask,
+    the same products as generate_products=1 plus a position velocity
+    diagram along x.
+
+    """
+    bbox = tuple(row[k] for k in ('x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max'))
+    cube, mask, mom0, mom1, mom2, snr, spec, _ = products.generate_products(
+        field_path, mask_path, region, row['id'], bbox, row['rms'])
+    pv = fits.getdata(io.BytesIO(cube)).sum(axis=1)
+
+    base = f"{cubelet_dir}/{output_filename}_{row['id']}"
+    for product, content in zip(CUBELET_PRODUCTS, (cube, mask, mom0, mom1, mom2, snr)):
+        with open(f"{base}_{product}.fits", 'wb') as f:
+            f.write(content)
+    fits.PrimaryHDU(data=pv).writeto(f"{base}_pv.fits", overwrite=True)
+    with open(f"{base}_spec.txt", 'wb') as f:
+        f.write(spec)
+
+
+def generate(out_dir: str, sources: int, layout: Layout, jitter: float = 0.02,
+             seed: int = 1, cubelets: bool = True, ascii: bool = False):
+    """Write the parent cube (field.fits), SoFiA parameter files, catalogs,
+    masks and cubelets of a synthetic field observed by the tiles of layout,
+    with an ASCII catalog next to every VOTable if ascii. Returns the list of
+    parameter files.
+
+    """
+    rng = np.random.default_rng(seed)
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+
+    field = make_sources(layout, sources, rng)
+    field_path = f"{out_dir}/field.fits"
+    write_field(field_path, field, layout)
+
+    param_files = []
+    rows_total = 0
+    for output_filename, region in layout.regions():
+        in_x = (field['x'] >= region[0]) & (field['x'] <= region[1])
+        in_y = (field['y'] >= region[2]) & (field['y'] <= region[3])
+        inside = np.nonzero(in_x & in_y)[0]
+
+        rows = []
+        for source_id, index in enumerate(inside, start=1):
+            row = measure(field, index, region, jitter, rng)
+            row['id'] = source_id
+            rows.append(row)
+
+        output_dir = f"{out_dir}/{output_filename}"
+        os.makedirs(output_dir, exist_ok=True)
+        write_votable(f"{output_dir}/{output_filename}_cat.xml", rows)
+        if ascii:
+            write_ascii(f"{output_dir}/{output_filename}_cat.txt", rows)
+
+        mask_path = f"{output_dir}/{output_filename}_mask.fits"
+        write_mask(mask_path, field, layout, region, rows, inside)
+
+        if cubelets:
+            cubelet_dir = f"{output_dir}/{output_filename}_cubelets"
+            os.makedirs(cubelet_dir, exist_ok=True)
+            for row in rows:
+                write_cubelets(cubelet_dir, output_filename, row, field_path, mask_path,
+                               region)
+            products.close_files()
+
+        param_path = f"{out_dir}/{output_filename}.par"
+        with open(param_path, 'w') as f:
+            f.write(f"input.data = {field_path}\n")
+            f.write(f"input.region = {', '.join(str(i) for i in region)}\n")
+            f.write(f"output.directory = {output_dir}\n")
+            f.write(f"output.filename = {output_filename}\n")
+            f.write(f"output.writeCatASCII = {'true' if ascii else 'false'}\n")
+        param_files.append(param_path)
+        rows_total += len(rows)
+
+    manifest = {
+        'sources': sources, 'detections': rows_total, 'seed': seed,
+        'jitter': jitter, 'cubelets': cubelets, 'ascii': ascii,
+        'layout': {'nx': layout.nx, 'ny': layout.ny, 'tile_size': layout.tile_size,
+                   'depth': layout.depth, 'overlap': layout.overlap},
+        'params': param_files,
+    }
+    with open(f"{out_dir}/manifest.json", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return param_files
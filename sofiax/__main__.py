@@ -19,35 +19,149 @@
 
 import asyncio
 import logging
-import configparser
 import argparse
 import sys
+import random
 
-from sofiax.utils import read_config
-from sofiax.merge import run_merge
-from sofiax.db import Run, Const
+from sofiax.utils import parse_config
+from sofiax.merge import run_merge, run_settings, check_detection_table
+from sofiax.offline import run_offline_merge
+from sofiax.memory import configure_memory, parse_size
+from sofiax.catalog import configure_parsing
+from sofiax.monitor import LoopMonitor
+from sofiax.log import configure_logging, configure_detection_log
+from sofiax.profile import start_profiling, stop_profiling, PROFILE_INTERVAL
+from sofiax.schema import run_schema_command
+from sofiax.batch import run_batch
+from sofiax.export import run_export_command, EXPORT_CHUNK_ROWS
+from sofiax.db import Const
 
 
 def logger():
-    """Set up the logger.
+    """Set up the logger, written to stdout from a background thread.
 
     """
-    root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
+    configure_logging(logging.DEBUG, sys.stdout)
 
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.DEBUG)
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+def parse_schema_args(argv):
+    """Parse arguments of the schema subcommand.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='SoFiAX schema',
+        description="Check or create the indexes the SoFiAX queries need."
+    )
+    parser.add_argument(
+        "action",
+        choices=["check", "apply"],
+        help="check reports missing indexes, apply creates them"
+    )
+    parser.add_argument(
+        "-c",
+        "--conf",
+        dest="conf",
+        required=True,
+        help="configuration file"
     )
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+    args = parser.parse_args(argv)
+    args.command = "schema"
+    return args
+
+
+def parse_export_args(argv):
+    """Parse arguments of the export subcommand.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='SoFiAX export',
+        description="Export the detections of a run to a FITS or Parquet table."
+    )
+    parser.add_argument(
+        "-c",
+        "--conf",
+        dest="conf",
+        required=True,
+        help="configuration file"
+    )
+    parser.add_argument(
+        "-r",
+        "--run",
+        dest="run",
+        required=True,
+        help="run name"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        dest="output",
+        required=True,
+        help="output table file"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="format",
+        choices=["fits", "parquet"],
+        default="fits",
+        help="output table format (parquet requires pyarrow)"
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        dest="chunk_rows",
+        type=int,
+        default=EXPORT_CHUNK_ROWS,
+        help="rows decoded and written at a time"
+    )
+    parser.add_argument(
+        "--products",
+        dest="products",
+        default=None,
+        help="directory to extract the detection products to"
+    )
+    parser.add_argument(
+        "--product-workers",
+        dest="product_workers",
+        type=int,
+        default=1,
+        help="number of connections extracting products"
+    )
+    args = parser.parse_args(argv)
+    args.command = "export"
+    return args
+
+
+def parse_batch_args(argv):
+    """Parse arguments of the batch subcommand.
+
+    """
+    parser = argparse.ArgumentParser(
+        prog='SoFiAX batch',
+        description="Process the runs of a manifest in one process."
+    )
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        dest="manifest",
+        required=True,
+        help="batch manifest (json)"
+    )
+    args = parser.parse_args(argv)
+    args.command = "batch"
+    return args
 
 
 def parse_args():
     """Parse arguments for the execution of SoFiAX.
 
     """
+    if sys.argv[1:2] == ["schema"]:
+        return parse_schema_args(sys.argv[2:])
+    if sys.argv[1:2] == ["export"]:
+        return parse_export_args(sys.argv[2:])
+    if sys.argv[1:2] == ["batch"]:
+        return parse_batch_args(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         prog='SoFiAX',
         description="Sofiax standalone execution."
@@ -67,45 +181,86 @@ def parse_args():
         required=True,
         help="sofia parameter file"
     )
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        type=float,
+        nargs="?",
+        const=1.0,
+        default=0.0,
+        metavar="FRACTION",
+        help="profile the job, or only this fraction of jobs (e.g. 0.05)"
+    )
+    parser.add_argument(
+        "--profile-interval",
+        dest="profile_interval",
+        type=float,
+        default=PROFILE_INTERVAL,
+        help="profiler sampling interval in seconds"
+    )
     args = parser.parse_args()
+    args.command = "merge"
     return args
 
 
-def parse_config(file):
-    """Read config.ini file.
-
-    """
-    config = configparser.ConfigParser()
-    config.read(file)
-    return config["SoFiAX"]
-
-
 async def _main():
     logger()
     args = parse_args()
+
+    if args.command == "batch":
+        try:
+            failed = await run_batch(args.manifest)
+        except Exception as e:
+            logging.exception(e)
+            sys.exit(1)
+        if failed:
+            sys.exit(1)
+        return
+
     config = parse_config(args.conf)
 
+    if args.command == "schema":
+        if not await run_schema_command(config, args.action):
+            sys.exit(1)
+        return
+
+    if args.command == "export":
+        try:
+            await run_export_command(config, args.run, args.output, args.format,
+                                     args.chunk_rows, args.products, args.product_workers)
+        except Exception as e:
+            logging.exception(e)
+            sys.exit(1)
+        return
+
     processes = config.get("sofia_processes", 0)
-    run_name = read_config(config, "run_name")
-    spatial = read_config(config, "spatial_extent")\
-        .replace(" ", "").split(",")
-    spectral = read_config(config, "spectral_extent")\
-        .replace(" ", "").split(",")
-    flux = int(read_config(config, "flux"))
-    uncertainty_sigma = config.get("uncertainty_sigma", 5)
-    quality_flags = list(map(int, config.get("quality_flags", "0,4")\
-        .replace(" ", "").split(",")))
-
-    sanity = {
-        "flux": flux,
-        "spatial_extent": tuple(map(int, spatial)),
-        "spectral_extent": tuple(map(int, spectral)),
-        "uncertainty_sigma": int(uncertainty_sigma)
-    }
-
-    Run.check_inputs(sanity)
+    run_name, sanity, quality_flags = run_settings(config)
+    configure_detection_log(int(config.get("log_detections", 0)) == 1)
+
+    memory_limit = config.get("memory_limit", None)
+    if memory_limit:
+        configure_memory(parse_size(memory_limit))
+
+    configure_parsing(int(config.get("parse_processes", 1)))
+
+    monitor = None
+    slow_callback = config.get("slow_callback_duration", None)
+    if slow_callback:
+        monitor = LoopMonitor(float(slow_callback))
+        monitor.start()
+
+    profiling = args.profile > 0 and random.random() < args.profile
+    if profiling:
+        logging.info('Profiling enabled')
+        start_profiling(args.profile_interval)
 
     try:
+        await check_detection_table(config)
+
+        if int(config.get("merge_offline", 0)) == 1:
+            await run_offline_merge(config, run_name, args.param, sanity, quality_flags)
+            return
+
         task_list = [
             asyncio.create_task(
                 run_merge(config, run_name, args.param, sanity, quality_flags)
@@ -115,6 +270,11 @@ async def _main():
     except Exception as e:
         logging.exception(e)
         sys.exit(1)
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        if profiling:
+            stop_profiling()
 
 
 if __name__ == "__main__":
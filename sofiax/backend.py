@@ -0,0 +1,330 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import abc
+import asyncpg
+import contextlib
+
+from sofiax.db import db_run_upsert, db_lock_run, db_instance_upsert, \
+    db_instance_metrics, db_match_bounds, db_source_match, db_detection_row_insert, \
+    db_detection_insert, db_detection_product_copy, db_delete_detection, \
+    db_delete_detections, db_update_detection_unresolved, db_detection_groups, \
+    db_update_unresolved_groups, db_run_detections, db_check_detection_columns, \
+    db_detection_rows_insert, db_detection_product_insert, MatchBounds, Run, Instance
+from sofiax.columns import Detection
+from sofiax.profile import get_profiler
+
+
+BACKENDS = ('postgres', 'sqlite')
+
+# connection pools by database, see open_pool
+_pools = {}
+
+
+class InstanceWrites(object):
+    """Columns of the instances written in the open transaction of a
+    backend. The write clears the changed set of an instance, a rolled back
+    transaction marks the columns changed again so the next write sends them.
+
+    """
+    def __init__(self):
+        self.pending = None
+
+    def written(self, instance: Instance, columns: set):
+        if self.pending is not None:
+            self.pending.append((instance, columns))
+
+    @contextlib.asynccontextmanager
+    async def track(self, transaction):
+        """Wrap the async context manager of a transaction, a nested
+        transaction leaves the columns to the outermost one.
+
+        """
+        if self.pending is not None:
+            async with transaction:
+                yield
+            return
+
+        self.pending = []
+        try:
+            async with transaction:
+                yield
+        except BaseException:
+            for instance, columns in self.pending:
+                instance.changed.update(columns)
+            raise
+        finally:
+            self.pending = None
+
+
+class Backend(abc.ABC):
+    """Storage of runs, instances, detections and products used by the
+    merge. Every method has the semantics of the db_* function of the same
+    name (see sofiax.db), without the connection and schema arguments.
+
+    A backend is opened for the work of one task and closed after it.
+
+    """
+    @abc.abstractmethod
+    def transaction(self):
+        """Async context manager of a transaction.
+
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def close(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def check_detection_columns(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def run_upsert(self, run: Run):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def lock_run(self, run: Run):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def instance_upsert(self, instance: Instance):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def instance_metrics(self, column: str, instance: Instance, metrics: dict):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def match_bounds(self, run_id: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def source_match(self, run_id: int, detection: Detection, uncertainty_sigma: int,
+                           bounds: MatchBounds):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_row_insert(self, vo_datalink_url: str, run_id: int, instance_id: int,
+                                   detection: Detection, unresolved: bool = False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_insert(self, vo_datalink_url: str, run_id: int, instance_id: int,
+                               detection: Detection, cube: bytes, mask: bytes,
+                               mom0: bytes, mom1: bytes, mom2: bytes,
+                               chan: bytes, spec: bytes, pv: bytes,
+                               unresolved: bool = False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_rows_insert(self, vo_datalink_url: str, run_id: int, rows: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_product_insert(self, detection_id: int, cube: bytes, mask: bytes,
+                                       mom0: bytes, mom1: bytes, mom2: bytes,
+                                       chan: bytes, spec: bytes, pv: bytes):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_product_copy(self, detection_id: int, sizes: list, stream):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete_detection(self, detection_id: int):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def delete_detections(self, detection_id_list: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_detection_unresolved(self, unresolved: bool, detection_id_list: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def detection_groups(self, column: str, detection_id_list: list):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def update_unresolved_groups(self, column: str, run_id: int, groups: list,
+                                       inherited: dict = None):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def run_detections(self, run_id: int):
+        raise NotImplementedError
+
+
+def _database_key(config):
+    return (config['db_hostname'], str(config['db_port']), config['db_name'],
+            config['db_username'])
+
+
+async def open_pool(config, size: int):
+    """Share a pool of up to size connections between every PostgreSQL
+    backend opened on the database of config, whatever its schema.
+
+    """
+    key = _database_key(config)
+    if key not in _pools:
+        _pools[key] = await asyncpg.create_pool(
+            min_size=1,
+            max_size=size,
+            user=config['db_username'],
+            password=config['db_password'],
+            database=config['db_name'],
+            host=config['db_hostname'],
+            port=config['db_port']
+        )
+    return _pools[key]
+
+
+async def close_pools():
+    while _pools:
+        _, pool = _pools.popitem()
+        await pool.close()
+
+
+class PostgresBackend(Backend):
+    """PostgreSQL/PostGIS storage through an asyncpg connection, or one
+    acquired from a pool of open_pool and released on close.
+
+    """
+    def __init__(self, conn, schema: str, pool=None):
+        self.conn = conn
+        self.schema = schema
+        self.pool = pool
+        self.profiler = None
+        self.writes = InstanceWrites()
+
+    @classmethod
+    async def connect(cls, config):
+        pool = _pools.get(_database_key(config))
+        if pool is not None:
+            conn = await pool.acquire()
+        else:
+            conn = await asyncpg.connect(
+                user=config['db_username'],
+                password=config['db_password'],
+                database=config['db_name'],
+                host=config['db_hostname'],
+                port=config['db_port']
+            )
+        backend = cls(conn, config.get('db_schema', 'wallaby'), pool)
+        backend.profiler = get_profiler()
+        if backend.profiler is not None:
+            conn.add_query_logger(backend.profiler.log_query)
+        return backend
+
+    def transaction(self):
+        return self.writes.track(self.conn.transaction())
+
+    async def close(self):
+        if self.profiler is not None:
+            self.conn.remove_query_logger(self.profiler.log_query)
+        if self.pool is not None:
+            await self.pool.release(self.conn)
+        else:
+            await self.conn.close()
+
+    async def check_detection_columns(self):
+        await db_check_detection_columns(self.conn, self.schema)
+
+    async def run_upsert(self, run):
+        return await db_run_upsert(self.conn, self.schema, run)
+
+    async def lock_run(self, run):
+        await db_lock_run(self.conn, self.schema, run)
+
+    async def instance_upsert(self, instance):
+        columns = set(instance.changed)
+        instance = await db_instance_upsert(self.conn, self.schema, instance)
+        self.writes.written(instance, columns)
+        return instance
+
+    async def instance_metrics(self, column, instance, metrics):
+        await db_instance_metrics(self.conn, self.schema, column, instance, metrics)
+
+    async def match_bounds(self, run_id):
+        return await db_match_bounds(self.conn, self.schema, run_id)
+
+    async def source_match(self, run_id, detection, uncertainty_sigma, bounds):
+        return await db_source_match(self.conn, self.schema, run_id, detection,
+                                     uncertainty_sigma, bounds)
+
+    async def detection_row_insert(self, vo_datalink_url, run_id, instance_id, detection,
+                                   unresolved=False):
+        return await db_detection_row_insert(self.conn, self.schema, vo_datalink_url, run_id,
+                                             instance_id, detection, unresolved)
+
+    async def detection_insert(self, vo_datalink_url, run_id, instance_id, detection,
+                               cube, mask, mom0, mom1, mom2, chan, spec, pv,
+                               unresolved=False):
+        return await db_detection_insert(self.conn, self.schema, vo_datalink_url, run_id,
+                                         instance_id, detection, cube, mask, mom0, mom1,
+                                         mom2, chan, spec, pv, unresolved)
+
+    async def detection_rows_insert(self, vo_datalink_url, run_id, rows):
+        return await db_detection_rows_insert(self.conn, self.schema, vo_datalink_url,
+                                              run_id, rows)
+
+    async def detection_product_insert(self, detection_id, cube, mask, mom0, mom1, mom2,
+                                       chan, spec, pv):
+        await db_detection_product_insert(self.conn, self.schema, detection_id, cube, mask,
+                                          mom0, mom1, mom2, chan, spec, pv)
+
+    async def detection_product_copy(self, detection_id, sizes, stream):
+        await db_detection_product_copy(self.conn, self.schema, detection_id, sizes, stream)
+
+    async def delete_detection(self, detection_id):
+        await db_delete_detection(self.conn, self.schema, detection_id)
+
+    async def delete_detections(self, detection_id_list):
+        await db_delete_detections(self.conn, self.schema, detection_id_list)
+
+    async def update_detection_unresolved(self, unresolved, detection_id_list):
+        await db_update_detection_unresolved(self.conn, self.schema, unresolved,
+                                             detection_id_list)
+
+    async def detection_groups(self, column, detection_id_list):
+        return await db_detection_groups(self.conn, self.schema, column, detection_id_list)
+
+    async def update_unresolved_groups(self, column, run_id, groups, inherited=None):
+        await db_update_unresolved_groups(self.conn, self.schema, column, run_id,
+                                          groups, inherited)
+
+    async def run_detections(self, run_id):
+        return await db_run_detections(self.conn, self.schema, run_id)
+
+
+async def open_backend(config):
+    """Open the storage backend of db_backend (postgres default).
+
+    """
+    backend = config.get('db_backend', 'postgres')
+    if backend == 'postgres':
+        return await PostgresBackend.connect(config)
+    if backend == 'sqlite':
+        # imported here, sofiax.sqlite builds on this module
+        from sofiax.sqlite import SQLiteBackend
+        return await SQLiteBackend.connect(config)
+    raise ValueError(f'Unknown db_backend {backend}, expected one of: {", ".join(BACKENDS)}')
@@ -0,0 +1,179 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import json
+import asyncio
+import logging
+
+from sofiax.utils import parse_config
+from sofiax.merge import run_instance, run_settings, check_detection_table
+from sofiax.offline import run_offline_merge
+from sofiax.backend import open_pool, close_pools
+from sofiax.memory import configure_memory, parse_size
+from sofiax.catalog import configure_parsing
+from sofiax.log import configure_detection_log
+
+
+class BatchRun(object):
+    """A run of the batch: its configuration, sanity thresholds and quality
+    flags, and the parameter files still to process. At most limit of its
+    instances run at once (sofia_processes, all workers by default).
+
+    """
+    def __init__(self, conf: str, config, params: list, workers: int):
+        self.conf = conf
+        self.config = config
+        self.name, self.sanity, self.quality_flags = run_settings(config)
+        self.params = params
+        self.offline = int(config.get('merge_offline', 0)) == 1
+        self.limit = int(config.get('sofia_processes', 0)) or workers
+        self.running = 0
+        self.failed = False
+
+
+def _resolve(base: str, path: str):
+    return path if os.path.isabs(path) else os.path.join(base, path)
+
+
+def read_manifest(path: str):
+    """Read a batch manifest, a JSON object of:
+
+      * jobs: list of {"conf": config file, "param": [parameter files]},
+        jobs with the same config file are the same run.
+      * workers: instances processed at once across all runs (1 default).
+      * pool_size: connections shared by all runs of a database (workers default).
+      * memory_limit, parse_processes, log_detections: process wide, as in
+        the config file.
+
+    Relative paths are relative to the manifest.
+
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(path))
+    workers = int(manifest.get('workers', 1))
+    runs = {}
+    for job in manifest['jobs']:
+        conf = _resolve(base, job['conf'])
+        params = [_resolve(base, p) for p in job['param']]
+        if conf in runs:
+            runs[conf].params.extend(params)
+        else:
+            runs[conf] = BatchRun(conf, parse_config(conf), params, workers)
+
+    manifest['workers'] = workers
+    return manifest, list(runs.values())
+
+
+class Scheduler(object):
+    """Hands out the instances of all runs to a fixed set of workers, in
+    turn between runs, skipping runs at their limit so a worker is never
+    held waiting for one run while another has work.
+
+    """
+    def __init__(self, runs: list):
+        self._pending = []
+        longest = max((1 if r.offline else len(r.params) for r in runs), default=0)
+        for i in range(longest):
+            for run in runs:
+                if run.offline:
+                    if i == 0:
+                        self._pending.append((run, None))
+                elif i < len(run.params):
+                    self._pending.append((run, run.params[i]))
+        self._cond = asyncio.Condition()
+
+    async def next(self):
+        async with self._cond:
+            while self._pending:
+                for item in self._pending:
+                    run = item[0]
+                    if run.running < run.limit:
+                        self._pending.remove(item)
+                        run.running += 1
+                        return item
+                await self._cond.wait()
+            return None
+
+    async def done(self, run: BatchRun):
+        async with self._cond:
+            run.running -= 1
+            if run.failed:
+                self._pending = [item for item in self._pending if item[0] is not run]
+            self._cond.notify_all()
+
+
+async def _worker(scheduler: Scheduler):
+    while True:
+        item = await scheduler.next()
+        if item is None:
+            return
+
+        run, param_path = item
+        try:
+            if run.offline:
+                await run_offline_merge(run.config, run.name, list(run.params),
+                                        run.sanity, run.quality_flags)
+            elif await run_instance(run.config, run.name, param_path,
+                                    run.sanity, run.quality_flags) is False:
+                logging.info(f'{run.name}: no sources found in {param_path}')
+        except Exception as e:
+            # the other runs carry on, the rest of this run is skipped
+            logging.exception(e)
+            logging.error(f'{run.name}: failed on {param_path or run.conf}, skipping the rest of the run')
+            run.failed = True
+        finally:
+            await scheduler.done(run)
+
+
+async def run_batch(manifest_path: str):
+    """Process every job of a batch manifest in one process, sharing the
+    connection pools, FITS header cache, catalog parsers and memory budget
+    between runs. Each run keeps its own config, thresholds and run lock.
+
+    Returns the runs that failed.
+
+    """
+    manifest, runs = read_manifest(manifest_path)
+    workers = manifest['workers']
+
+    memory_limit = manifest.get('memory_limit', None)
+    if memory_limit:
+        configure_memory(parse_size(memory_limit))
+    configure_parsing(int(manifest.get('parse_processes', 1)))
+    configure_detection_log(int(manifest.get('log_detections', 0)) == 1)
+
+    try:
+        for run in runs:
+            if run.config.get('db_backend', 'postgres') == 'postgres':
+                await open_pool(run.config, int(manifest.get('pool_size', workers)))
+            await check_detection_table(run.config)
+
+        logging.info(f'Batch of {len(runs)} run(s) with {workers} worker(s)')
+        scheduler = Scheduler(runs)
+        await asyncio.gather(*[_worker(scheduler) for _ in range(workers)])
+    finally:
+        await close_pools()
+
+    failed = [run for run in runs if run.failed]
+    for run in failed:
+        logging.error(f'Run {run.name} ({run.conf}) failed')
+    return failed
@@ -0,0 +1,190 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import mmap
+import struct
+import asyncio
+import logging
+import zipfile
+import aiofiles
+import aiofiles.os
+
+from sofiax.utils import get_file_bytes
+
+
+# NOTE: cubelet _chan.fits files renames _snr.fits in SoFiA-2 v2.3
+PRODUCTS = ('cube.fits', 'mask.fits', 'mom0.fits', 'mom1.fits',
+            'mom2.fits', 'snr.fits', 'spec.txt', 'pv.fits')
+
+# read size of products streamed to the database
+PRODUCT_CHUNK = 1024 * 1024
+
+# zip local file header: signature ... file name length, extra field length
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+
+def bundle_path(output_dir: str, output_filename: str):
+    return f"{output_dir}/{output_filename}_cubelets.zip"
+
+
+def build_bundle(cubelet_dir: str, path: str):
+    """Pack the files of a SoFiA cubelet directory into an uncompressed zip
+    so they can be read by offset from a single open file.
+
+    """
+    tmp_path = f"{path}.tmp"
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as bundle:
+        for name in sorted(os.listdir(cubelet_dir)):
+            file_path = os.path.join(cubelet_dir, name)
+            if os.path.isfile(file_path):
+                bundle.write(file_path, arcname=name)
+    os.replace(tmp_path, path)
+
+
+class CubeletBundle(object):
+    """Memory mapped cubelet bundle with an in-memory member index.
+
+    """
+    def __init__(self, path: str, output_filename: str, stream_threshold: int = None):
+        self.path = path
+        self.output_filename = output_filename
+        self.stream_threshold = stream_threshold
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index = {}
+            with zipfile.ZipFile(self._file) as bundle:
+                for info in bundle.infolist():
+                    if info.compress_type != zipfile.ZIP_STORED:
+                        raise ValueError(f'{path} member {info.filename} is compressed')
+                    header = ZIP_LOCAL_HEADER.unpack_from(self._mmap, info.header_offset)
+                    offset = info.header_offset + ZIP_LOCAL_HEADER.size + header[-2] + header[-1]
+                    self._index[info.filename] = (offset, info.file_size)
+        except Exception:
+            self._file.close()
+            raise
+
+    def get(self, name: str):
+        entry = self._index.get(name)
+        if entry is None:
+            return b''
+        offset, size = entry
+        return self._mmap[offset:offset + size]
+
+    def prefetch(self, detect_ids: list):
+        pass
+
+    async def sizes(self, detect_id: int):
+        base = f"{self.output_filename}_{detect_id}"
+        return [self._index.get(f"{base}_{product}", (0, 0))[1] for product in PRODUCTS]
+
+    async def size(self, detect_id: int):
+        return sum(await self.sizes(detect_id))
+
+    async def read(self, detect_id: int):
+        base = f"{self.output_filename}_{detect_id}"
+        return tuple(self.get(f"{base}_{product}") for product in PRODUCTS)
+
+    async def stream(self, detect_id: int, index: int):
+        """Chunks of a product copied out of the memory map one at a time, so
+        no view of the map is left to fail its close.
+
+        """
+        entry = self._index.get(f"{self.output_filename}_{detect_id}_{PRODUCTS[index]}")
+        if entry is None:
+            return
+        offset, size = entry
+        for start in range(offset, offset + size, PRODUCT_CHUNK):
+            yield self._mmap[start:min(start + PRODUCT_CHUNK, offset + size)]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class CubeletDirectory(object):
+    """Cubelet products read file by file from the SoFiA cubelet directory.
+
+    """
+    def __init__(self, cubelet_dir: str, output_filename: str, stream_threshold: int = None):
+        self.cubelet_dir = cubelet_dir
+        self.output_filename = output_filename
+        self.stream_threshold = stream_threshold
+
+    def prefetch(self, detect_ids: list):
+        pass
+
+    async def sizes(self, detect_id: int):
+        base = f"{self.cubelet_dir}/{self.output_filename}_{detect_id}"
+        sizes = []
+        for product in PRODUCTS:
+            try:
+                sizes.append((await aiofiles.os.stat(f"{base}_{product}")).st_size)
+            except FileNotFoundError:
+                sizes.append(0)
+        return sizes
+
+    async def size(self, detect_id: int):
+        return sum(await self.sizes(detect_id))
+
+    async def read(self, detect_id: int):
+        base = f"{self.cubelet_dir}/{self.output_filename}_{detect_id}"
+        return tuple([await get_file_bytes(f"{base}_{product}") for product in PRODUCTS])
+
+    async def stream(self, detect_id: int, index: int):
+        path = f"{self.cubelet_dir}/{self.output_filename}_{detect_id}_{PRODUCTS[index]}"
+        if not os.path.isfile(path):
+            return
+        async with aiofiles.open(path, 'rb') as f:
+            while True:
+                chunk = await f.read(PRODUCT_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+
+    def close(self):
+        pass
+
+
+async def open_cubelets(output_dir: str, output_filename: str, build: bool = False,
+                        stream_threshold: int = None):
+    """Open the cubelet products of an instance, preferring the bundle.
+    Detections with at least stream_threshold bytes of products are streamed
+    to the database (see db_detection_product_copy), None to never stream.
+
+    """
+    cubelet_dir = f"{output_dir}/{output_filename}_cubelets"
+    path = bundle_path(output_dir, output_filename)
+
+    # a bundle older than the cubelet directory is from a previous SoFiA run
+    stale = os.path.isfile(path) and os.path.isdir(cubelet_dir) and \
+        os.path.getmtime(cubelet_dir) > os.path.getmtime(path)
+    if stale:
+        logging.warning(f'Cubelet bundle {path} is older than {cubelet_dir}')
+
+    loop = asyncio.get_event_loop()
+    if build and (stale or not os.path.isfile(path)) and os.path.isdir(cubelet_dir):
+        logging.info(f'Building cubelet bundle {path}')
+        await loop.run_in_executor(None, build_bundle, cubelet_dir, path)
+    elif stale or not os.path.isfile(path):
+        return CubeletDirectory(cubelet_dir, output_filename, stream_threshold)
+
+    return await loop.run_in_executor(None, CubeletBundle, path, output_filename,
+                                      stream_threshold)
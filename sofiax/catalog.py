@@ -0,0 +1,319 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import re
+import asyncio
+import logging
+import xmltodict
+import numpy as np
+
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from sofiax.columns import DETECTION_COLUMNS, CATALOG_ONLY_COLUMNS, COLUMN_INDEX, \
+    Detection
+
+
+XML_SUFFIX = '_cat.xml'
+ASCII_SUFFIX = '_cat.txt'
+
+RUN_DATE_FORMAT = '%a, %d %b %Y, %H:%M:%S'
+
+# quoted text fields of an ASCII catalog row, the source name
+_QUOTED = re.compile(r'"[^"]*"')
+
+_executor = None
+_processes = 1
+
+
+class Catalog(object):
+    """Decoded catalog rows stored by column in DETECTION_COLUMNS order, a
+    compact form to send back from a worker process.
+
+    """
+    __slots__ = ('ids', 'columns', 'unknown')
+
+    def __init__(self, ids: list, columns: list, unknown: list):
+        self.ids = ids
+        self.columns = columns
+        self.unknown = unknown
+
+    def __len__(self):
+        return len(self.ids)
+
+    def detections(self):
+        """List of (SoFiA source id, Detection).
+
+        """
+        return [(detect_id, Detection(*values))
+                for detect_id, values in zip(self.ids, zip(*self.columns))]
+
+
+def configure_parsing(processes: int = 1):
+    """Set the number of worker processes parsing catalogs, 0 to parse on the
+    event loop.
+
+    """
+    global _processes, _executor
+    _processes = processes
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def get_parse_executor():
+    """Process pool shared by every instance parsing a catalog.
+
+    """
+    global _executor
+    if _processes > 0 and _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=_processes)
+    return _executor
+
+
+def decode_votable(content: str):
+    """Decode a SoFiA VOTable catalog.
+
+    Returns the run date, SoFiA version, field names and table rows.
+
+    """
+    cat = xmltodict.parse(content)
+
+    run_date = None
+    for _, j in enumerate(cat['VOTABLE']['RESOURCE']['PARAM']):
+        if j['@name'] == 'Time':
+            run_date = j['@value']
+            break
+
+    if run_date is None:
+        raise AttributeError('Run date not found in votable')
+
+    version = None
+    for _, j in enumerate(cat['VOTABLE']['RESOURCE']['PARAM']):
+        if j['@name'] == 'Creator':
+            version = j['@value']
+            break
+
+    detect_names = []
+    fields = cat['VOTABLE']['RESOURCE']['TABLE']['FIELD']
+    for _, j in enumerate(fields):
+        detect_names.append(j['@name'])
+
+    tr = cat['VOTABLE']['RESOURCE']['TABLE']['DATA']['TABLEDATA']['TR']
+    if not isinstance(tr, list):
+        tr = [tr]
+
+    run_date = datetime.strptime(run_date, RUN_DATE_FORMAT)
+    return run_date, version, detect_names, tr
+
+
+def _decode(item):
+    try:
+        # NOTE: handle cases where field contains "nan"
+        if "nan" in item:
+            return None
+        return float(item)
+    except ValueError:
+        return item
+
+
+def decode_rows(detect_names: list, rows: list, quality_flags: list, boundary: list):
+    """Decode catalog rows, keeping only the allowed quality flags and shifting
+    x, y, z into absolute terms of the input cube.
+
+    """
+    position = {name: i for i, name in enumerate(detect_names)}
+    fields = [position.get(name) for name in DETECTION_COLUMNS]
+    id_field = position['id']
+    flag_field = position['flag']
+    offsets = [(COLUMN_INDEX['x'], boundary[0]),
+               (COLUMN_INDEX['y'], boundary[2]),
+               (COLUMN_INDEX['z'], boundary[4])]
+
+    ids = []
+    decoded = []
+    for _, j in enumerate(rows):
+        td = j['TD']
+
+        # only allow selected flagged detections (default 0 or 4), throw the others away
+        if _decode(td[flag_field]) not in quality_flags:
+            continue
+
+        values = [None if i is None else _decode(td[i]) for i in fields]
+
+        # adjust x, y, z to absolute terms based on region applied
+        for i, offset in offsets:
+            values[i] = values[i] + offset
+
+        ids.append(int(_decode(td[id_field])))
+        decoded.append(values)
+
+    columns = [list(c) for c in zip(*decoded)] if decoded else [[] for _ in fields]
+    unknown = [n for n in detect_names if n not in COLUMN_INDEX and n not in CATALOG_ONLY_COLUMNS]
+    return Catalog(ids, columns, unknown)
+
+
+def decode_ascii(content: str):
+    """Decode a SoFiA ASCII catalog, Time and Creator are read from the
+    header comments and the field names from the comment row naming the
+    columns.
+
+    Returns the run date, SoFiA version, field names, the source names and
+    the other fields as a 2D float array (nan where undefined).
+
+    """
+    run_date = None
+    version = None
+    detect_names = None
+    data = []
+    for line in content.splitlines():
+        if not line.startswith('#'):
+            if line.strip():
+                data.append(line)
+            continue
+
+        comment = line[1:].strip()
+        if comment.startswith('Creator:'):
+            version = comment[len('Creator:'):].strip()
+        elif comment.startswith('Time:'):
+            run_date = comment[len('Time:'):].strip()
+        elif detect_names is None:
+            names = comment.split()
+            if 'name' in names and 'id' in names:
+                detect_names = names
+
+    if run_date is None:
+        raise ValueError('Run date not found in ASCII catalog')
+    if detect_names is None:
+        raise ValueError('Column names not found in ASCII catalog')
+
+    rows = '\n'.join(data)
+    source_names = [n[1:-1] for n in _QUOTED.findall(rows)]
+    if len(source_names) != len(data):
+        raise ValueError('Expected one quoted source name per ASCII catalog row')
+
+    ncols = len(detect_names) - 1
+    values = np.fromstring(_QUOTED.sub(' ', rows), dtype=np.float64, sep=' ')
+    if values.size != len(data) * ncols:
+        raise ValueError(f'Expected {ncols} numeric fields per ASCII catalog row')
+
+    run_date = datetime.strptime(run_date, RUN_DATE_FORMAT)
+    return run_date, version, detect_names, source_names, values.reshape(len(data), ncols)
+
+
+def decode_columns(detect_names: list, source_names: list, values, quality_flags: list,
+                   boundary: list):
+    """Vectorized decode_rows of the columns of an ASCII catalog, giving the
+    same values: floats, None where undefined and int source ids.
+
+    """
+    numeric = [n for n in detect_names if n != 'name']
+    position = {name: i for i, name in enumerate(numeric)}
+
+    # only allow selected flagged detections (default 0 or 4), throw the others away
+    keep = np.isin(values[:, position['flag']], quality_flags)
+    values = values[keep]
+
+    # adjust x, y, z to absolute terms based on region applied
+    offsets = {'x': boundary[0], 'y': boundary[2], 'z': boundary[4]}
+
+    columns = []
+    for name in DETECTION_COLUMNS:
+        if name == 'name':
+            columns.append([n for n, k in zip(source_names, keep) if k])
+            continue
+        if name not in position:
+            columns.append([None] * len(values))
+            continue
+        column = values[:, position[name]] + offsets.get(name, 0)
+        decoded = column.tolist()
+        if np.isnan(column).any():
+            decoded = [None if v != v else v for v in decoded]
+        columns.append(decoded)
+
+    ids = values[:, position['id']].astype(np.int64).tolist()
+    unknown = [n for n in detect_names if n not in COLUMN_INDEX and n not in CATALOG_ONLY_COLUMNS]
+    return Catalog(ids, columns, unknown)
+
+
+def _written(params: dict, parameter: str):
+    # SoFiA writes both catalogs unless told otherwise
+    return params.get(parameter, 'true').strip().lower() == 'true'
+
+
+def catalog_path(params: dict, output_dir: str, output_filename: str):
+    """Catalog of a SoFiA output, the ASCII catalog when the parameters have
+    SoFiA write one (output.writeCatASCII) and it exists, else the VOTable.
+    An ASCII catalog left by an earlier run is ignored once SoFiA no longer
+    writes one.
+
+    """
+    ascii_path = f"{output_dir}/{output_filename}{ASCII_SUFFIX}"
+    if _written(params, 'output.writeCatASCII') and os.path.exists(ascii_path):
+        return ascii_path
+    return f"{output_dir}/{output_filename}{XML_SUFFIX}"
+
+
+def parse_catalog(path: str, quality_flags: list, boundary: list):
+    """Read and decode a VOTable or ASCII catalog, run in a worker process.
+
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    if path.endswith(ASCII_SUFFIX):
+        run_date, version, detect_names, source_names, values = decode_ascii(content)
+        return run_date, version, decode_columns(detect_names, source_names, values,
+                                                 quality_flags, boundary)
+    run_date, version, detect_names, tr = decode_votable(content)
+    return run_date, version, decode_rows(detect_names, tr, quality_flags, boundary)
+
+
+async def _parse(path: str, quality_flags: list, boundary: list):
+    executor = get_parse_executor()
+    if executor is None:
+        return parse_catalog(path, quality_flags, boundary)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor, parse_catalog, path, quality_flags, boundary)
+
+
+async def read_catalog(path: str, quality_flags: list, boundary: list):
+    """Read a SoFiA VOTable or ASCII catalog (see catalog_path) off the event
+    loop. An ASCII catalog that cannot be decoded is read from the VOTable
+    written next to it, if any.
+
+    Returns the run date, SoFiA version and a list of (SoFiA source id,
+    Detection).
+
+    """
+    if not os.path.exists(path):
+        raise AttributeError(f'SoFiA output catalog file {path} does not exist')
+
+    try:
+        run_date, version, catalog = await _parse(path, quality_flags, boundary)
+    except (ValueError, KeyError, IndexError) as e:
+        vo_table = path[:-len(ASCII_SUFFIX)] + XML_SUFFIX
+        if not path.endswith(ASCII_SUFFIX) or not os.path.exists(vo_table):
+            raise
+        logging.warning(f'Could not decode ASCII catalog {path} ({e}), reading {vo_table}')
+        run_date, version, catalog = await _parse(vo_table, quality_flags, boundary)
+
+    if catalog.unknown:
+        logging.warning(f'Catalog columns not stored by SoFiAX: {", ".join(catalog.unknown)}')
+    return run_date, version, catalog.detections()
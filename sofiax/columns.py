@@ -0,0 +1,101 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import operator
+
+
+# detection table columns filled from the SoFiA catalog, in insert order
+DETECTION_COLUMNS = (
+    'name', 'x', 'y', 'z', 'x_min', 'x_max', 'y_min', 'y_max', 'z_min',
+    'z_max', 'n_pix', 'f_min', 'f_max', 'f_sum', 'rel', 'flag', 'rms', 'w20',
+    'w50', 'ell_maj', 'ell_min', 'ell_pa', 'ell3s_maj', 'ell3s_min',
+    'ell3s_pa', 'kin_pa', 'err_x', 'err_y', 'err_z', 'err_f_sum', 'ra', 'dec',
+    'freq', 'l', 'b', 'v_rad', 'v_opt', 'v_app', 'wm50', 'x_peak', 'y_peak',
+    'z_peak', 'ra_peak', 'dec_peak', 'freq_peak', 'l_peak', 'b_peak',
+    'v_rad_peak', 'v_opt_peak', 'v_app_peak'
+)
+
+# columns set by SoFiAX on insert, before and after the catalog columns
+INSERT_PREFIX = ('run_id', 'instance_id', 'unresolved')
+INSERT_SUFFIX = ('access_url',)
+INSERT_COLUMNS = INSERT_PREFIX + DETECTION_COLUMNS + INSERT_SUFFIX
+
+# unique constraint of the detection table used to make inserts idempotent
+CONFLICT_COLUMNS = (
+    'name', 'x', 'y', 'z', 'x_min', 'x_max', 'y_min', 'y_max', 'z_min',
+    'z_max', 'n_pix', 'f_min', 'f_max', 'f_sum', 'instance_id', 'run_id'
+)
+
+# columns needed to match and merge detections against those stored
+MATCH_COLUMNS = (
+    'x', 'y', 'z', 'err_x', 'err_y', 'err_z', 'f_sum', 'ell_maj', 'ell_min',
+    'w50', 'w20', 'flag'
+)
+
+# product table columns, in the order products are read
+PRODUCT_COLUMNS = ('cube', 'mask', 'mom0', 'mom1', 'mom2', 'chan', 'spec', 'pv')
+
+# catalog columns SoFiAX reads but does not store
+CATALOG_ONLY_COLUMNS = ('id',)
+
+COLUMN_INDEX = {name: i for i, name in enumerate(DETECTION_COLUMNS)}
+
+_values = operator.attrgetter(*DETECTION_COLUMNS)
+
+
+class Detection(object):
+    """A catalog row holding every column of DETECTION_COLUMNS, None when
+    not in the catalog. Columns can be read as attributes or by name.
+
+    """
+    __slots__ = DETECTION_COLUMNS
+
+    def __init__(self, *values):
+        for name, value in zip(DETECTION_COLUMNS, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        return cls(*(mapping.get(name) for name in DETECTION_COLUMNS))
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def values(self):
+        """Column values in DETECTION_COLUMNS order.
+
+        """
+        return _values(self)
+
+    def as_dict(self):
+        return dict(zip(DETECTION_COLUMNS, self.values()))
+
+    def __repr__(self):
+        return f'Detection(name={self.name!r}, x={self.x}, y={self.y}, z={self.z})'
+
+
+def missing_columns(table_columns):
+    """Columns written by SoFiAX that are missing from the detection table.
+
+    """
+    table_columns = set(table_columns)
+    return [name for name in INSERT_COLUMNS if name not in table_columns]
@@ -0,0 +1,83 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+
+class ConflictGraph(object):
+    """Detections linked by failed sanity checks, kept as a union-find so the
+    unresolved groups are its connected components.
+
+    A detection replacing another is linked to it as well, so it takes over
+    the place of the detection it replaced in a group.
+
+    """
+    def __init__(self):
+        self._parent = {}
+
+    def add(self, node):
+        self._parent.setdefault(node, node)
+
+    def find(self, node):
+        self.add(node)
+        while self._parent[node] != node:
+            self._parent[node] = self._parent[self._parent[node]]
+            node = self._parent[node]
+        return node
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self._parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def components(self, nodes=None):
+        """Lists of nodes (all nodes by default) by connected component.
+
+        """
+        groups = {}
+        for node in sorted(self._parent if nodes is None else nodes):
+            groups.setdefault(self.find(node), []).append(node)
+        return list(groups.values())
+
+
+def assign_groups(groups: list, existing: dict):
+    """Group id of every detection in groups, merging groups that share an
+    existing group id.
+
+    existing maps detection ids to the group id they are already stored
+    with. Each group is labelled with the smallest detection or existing
+    group id it contains. Returns the group id by detection id and the
+    existing group ids that were merged into another, by their new id.
+
+    """
+    graph = ConflictGraph()
+    for group in groups:
+        for node in group:
+            graph.union(group[0], node)
+            if existing.get(node) is not None:
+                graph.union(node, existing[node])
+
+    assigned = {}
+    for component in graph.components():
+        label = component[0]
+        for node in component:
+            assigned[node] = label
+
+    members = {node: assigned[node] for group in groups for node in group}
+    renamed = {old: assigned[old] for old in set(existing.values())
+               if old is not None and assigned.get(old, old) != old}
+    return members, renamed
@@ -18,65 +18,58 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.#
 
 import json
-import sys
+import math
+import struct
 import logging
 
+from sofiax.metrics import timed, incr
+from sofiax.conflict import assign_groups
+from sofiax.columns import DETECTION_COLUMNS, INSERT_COLUMNS, CONFLICT_COLUMNS, \
+    MATCH_COLUMNS, PRODUCT_COLUMNS, INSERT_PREFIX, Detection, missing_columns
+
 
 MAX_BYTEA = 1073741823
 
+# binary COPY signature, flags and header extension length
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+
+# access_url is completed with the id of the new detection
+_DETECTION_INSERT = (
+    'INSERT INTO {{schema}}.detection ({columns}) '
+    'VALUES ({values}, ${n} || currval(pg_get_serial_sequence(\'{{schema}}.detection\', \'id\'))) '
+    'ON CONFLICT ({conflict}) '
+    'DO UPDATE SET ra=EXCLUDED.ra, unresolved=EXCLUDED.unresolved '
+    'RETURNING id'
+).format(
+    columns=', '.join(INSERT_COLUMNS),
+    values=', '.join(f'${i}' for i in range(1, len(INSERT_COLUMNS))),
+    n=len(INSERT_COLUMNS),
+    conflict=', '.join(CONFLICT_COLUMNS))
+
+# columns of the detections bulk loaded by db_detection_rows_insert
+_LOAD_COLUMNS = INSERT_PREFIX + DETECTION_COLUMNS
+
+# the loaded rows equal to a stored detection under its unique constraint
+_LOAD_MATCH = ' AND '.join(f'l.{name} = d.{name}' for name in CONFLICT_COLUMNS)
+
+# ids of the loaded rows: the stored ones get the same update as the
+# ON CONFLICT of _DETECTION_INSERT, the others new ids and are inserted
+_DETECTION_LOAD = tuple(statement.format(match=_LOAD_MATCH) for statement in (
+    'UPDATE detection_load l SET id = d.id FROM {{schema}}.detection d WHERE {match}',
+    'UPDATE {{schema}}.detection d SET ra = l.ra, unresolved = l.unresolved '
+    'FROM detection_load l WHERE d.id = l.id',
+    'UPDATE detection_load SET inserted = true, '
+    'id = nextval(pg_get_serial_sequence(\'{{schema}}.detection\', \'id\')) WHERE id IS NULL',
+))
+
+_DETECTION_LOAD_INSERT = (
+    'INSERT INTO {{schema}}.detection (id, {columns}, access_url) '
+    'SELECT id, {columns}, $1 || id FROM detection_load WHERE inserted ORDER BY seq'
+).format(columns=', '.join(_LOAD_COLUMNS))
+
 
 class Const(object):
-    FULL_SCHEMA = {
-        "name": None,
-        "x": None,
-        "y": None,
-        "z": None,
-        "x_min": None,
-        "x_max": None,
-        "y_min": None,
-        "z_min": None,
-        "z_max": None,
-        "n_pix": None,
-        "f_min": None,
-        "f_max": None,
-        "f_sum": None,
-        "rel": None,
-        "rms": None,
-        "w20": None,
-        "w50": None,
-        "ell_maj": None,
-        "ell_min": None,
-        "ell_pa": None,
-        "ell3s_maj": None,
-        "ell3s_pa": None,
-        "kin_pa": None,
-        "ra": None,
-        "dec": None,
-        "l": None,
-        "b": None,
-        "v_rad": None,
-        "v_opt": None,
-        "v_app": None,
-        "err_x": None,
-        "err_y": None,
-        "err_z": None,
-        "err_f_sum": None,
-        "freq": None,
-        "flag": None,
-        "unresolved": None,
-        "wm50": None,
-        "x_peak": None,
-        "y_peak": None,
-        "z_peak": None,
-        "ra_peak": None,
-        "dec_peak": None,
-        "freq_peak": None,
-        "l_peak": None,
-        "b_peak": None,
-        "v_rad_peak": None,
-        "v_opt_peak": None,
-        "v_app_peak": None
-    }
+    FULL_SCHEMA = dict.fromkeys(DETECTION_COLUMNS + ('unresolved',))
 
 
 class Run(object):
@@ -140,9 +133,24 @@ class Run(object):
 
 
 class Instance(object):
+    # columns updated after the instance is created, by attribute name
+    COLUMNS = {
+        'run_date': 'run_date',
+        'flag_log': 'flag_log',
+        'reliability_plot': 'reliability_plot',
+        'log': 'log',
+        'params': 'parameters',
+        'version': 'version',
+        'return_code': 'return_code',
+        'stdout': 'stdout',
+        'stderr': 'stderr'
+    }
+
     def __init__(self, run_id, run_date, filename, boundary,
                  flag_log, reliability_plot, log, parameters,
                  version, return_code, stdout, stderr):
+        # attributes of COLUMNS changed since the instance was last written
+        self.changed = set()
         self.instance_id = None
         self.run_id = run_id
         self.run_date = run_date
@@ -157,6 +165,16 @@ class Instance(object):
         self.stdout = stdout
         self.stderr = stderr
 
+    def __setattr__(self, name, value):
+        if name in Instance.COLUMNS and self.__dict__.get(name, self) != value:
+            self.changed.add(name)
+        object.__setattr__(self, name, value)
+
+    def column_value(self, name):
+        if name == 'params':
+            return json.dumps(self.params)
+        return getattr(self, name)
+
 
 async def db_run_upsert(conn, schema: str, run: Run):
     run_id = await conn.fetchrow(
@@ -172,12 +190,18 @@ async def db_run_upsert(conn, schema: str, run: Run):
     return run
 
 
+@timed('lock_wait')
 async def db_lock_run(conn, schema: str, run: Run):
     await conn.fetchrow(f'SELECT id FROM {schema}.run WHERE id=$1 FOR UPDATE',
                         run.run_id)
 
 
-async def db_instance_upsert(conn, schema: str, instance: Instance):
+@timed('instance_write')
+async def db_instance_create(conn, schema: str, instance: Instance):
+    """Create or claim the instance row of (run_id, filename, boundary),
+    writing every column.
+
+    """
     ins_id = await conn.fetchrow(
         f'INSERT INTO {schema}.instance \
             (run_id, run_date, filename, boundary, flag_log, reliability_plot,\
@@ -211,11 +235,108 @@ async def db_instance_upsert(conn, schema: str, instance: Instance):
         instance.stderr
     )
     instance.instance_id = ins_id[0]
+    instance.changed.clear()
+    return instance
+
+
+@timed('instance_write')
+async def db_instance_update(conn, schema: str, instance: Instance):
+    """Write the columns of an instance changed since it was last written.
+    Returns False if the instance row no longer exists.
+
+    """
+    changed = sorted(instance.changed)
+    if not changed:
+        return True
+
+    columns = ', '.join(f'{Instance.COLUMNS[name]}=${i}' for i, name in enumerate(changed, start=2))
+    ins_id = await conn.fetchrow(
+        f'UPDATE {schema}.instance SET {columns} WHERE id=$1 RETURNING id',
+        instance.instance_id,
+        *[instance.column_value(name) for name in changed]
+    )
+    if ins_id is None:
+        return False
+    instance.changed.clear()
+    return True
+
+
+async def db_instance_upsert(conn, schema: str, instance: Instance):
+    """Create the instance on its first write, then only send the columns
+    that changed.
+
+    """
+    if instance.instance_id is None or not await db_instance_update(conn, schema, instance):
+        await db_instance_create(conn, schema, instance)
     return instance
 
 
+class MatchBounds(object):
+    """Largest position errors of the detections of a run, which bound how far
+    apart two matching detections can be, so db_source_match can prefilter
+    on an indexed bounding box before the exact uncertainty test.
+
+    """
+    def __init__(self, err_xy: float = None, err_z: float = None):
+        self.err_xy = err_xy or 0.0
+        self.err_z = err_z or 0.0
+
+    def update(self, detection: Detection):
+        if detection['err_x'] is not None and detection['err_y'] is not None:
+            self.err_xy = max(self.err_xy, abs(detection['err_x']), abs(detection['err_y']))
+        if detection['err_z'] is not None:
+            self.err_z = max(self.err_z, abs(detection['err_z']))
+
+    def box(self, detection: Detection, uncertainty_sigma: int):
+        """(x, y, z) corners of the box holding every possible match.
+
+        """
+        err_xy = max(abs(detection['err_x']), abs(detection['err_y']))
+        r_xy = uncertainty_sigma * math.sqrt(err_xy ** 2 + self.err_xy ** 2)
+        r_z = uncertainty_sigma * math.sqrt(detection['err_z'] ** 2 + self.err_z ** 2)
+        # widen a little so rounding never drops a match on the edge
+        r_xy = r_xy * (1 + 1e-9) + 1e-9
+        r_z = r_z * (1 + 1e-9) + 1e-9
+        x, y, z = detection['x'], detection['y'], detection['z']
+        return x - r_xy, y - r_xy, z - r_z, x + r_xy, y + r_xy, z + r_z
+
+
+@timed('match_query')
+async def db_match_bounds(conn, schema: str, run_id: int):
+    row = await conn.fetchrow(
+        f'SELECT max(greatest(abs(err_x), abs(err_y))) AS err_xy, \
+        max(abs(err_z)) AS err_z \
+        FROM {schema}.detection \
+        WHERE run_id=$1',
+        run_id
+    )
+    return MatchBounds(row['err_xy'], row['err_z'])
+
+
+# positional match of a detection against those of a run, the && box on
+# ST_MakePoint(x, y, z) is served by the gist_geometry_ops_nd index (see schema.py)
+SOURCE_MATCH = """SELECT
+    d.id, d.instance_id, x, y, z, f_sum, ell_maj,
+    ell_min, w50, w20, flag, unresolved
+    FROM {schema}.detection as d
+    WHERE
+    ST_MakePoint(x, y, z) &&& ST_MakeLine(ST_MakePoint($8, $9, $10), ST_MakePoint($11, $12, $13))
+    AND
+    ST_3DDistance(geometry(ST_MakePoint($1, $2, 0)), geometry(ST_MakePoint(x, y, 0)))
+    <= {uncertainty_sigma} * SQRT( (($1 - x)^2 * ($4^2 + err_x^2) + ($2 - y)^2 * ($5^2 + err_y^2))
+    / COALESCE( NULLIF( (($1 - x)^2 + ($2 - y)^2), 0), 1) )
+    AND
+    ST_3DDistance( geometry(ST_MakePoint(0, 0, $3)), geometry(ST_MakePoint(0, 0, z)))
+    <= {uncertainty_sigma} * SQRT($6^2 + err_z^2)
+    AND d.run_id = $7
+    ORDER BY d.id
+    ASC FOR UPDATE OF d"""
+
+
+@timed('match_query')
 async def db_source_match(conn, schema: str, run_id: int,
-                          detection: dict, uncertainty_sigma: int):
+                          detection: Detection, uncertainty_sigma: int,
+                          bounds: MatchBounds):
     x = detection['x']
     y = detection['y']
     z = detection['z']
@@ -223,29 +344,20 @@ async def db_source_match(conn, schema: str, run_id: int,
     err_y = detection['err_y']
     err_z = detection['err_z']
 
+    if any(i is None for i in (x, y, z, err_x, err_y, err_z)):
+        # the uncertainty test is never true for a missing position or error
+        return []
+
     result = await conn.fetch(
-        f"""SELECT
-            d.id, d.instance_id, x, y, z, f_sum, ell_maj,
-            ell_min, w50, w20, flag, unresolved
-            FROM {schema}.detection as d, {schema}.instance as i
-            WHERE
-            ST_3DDistance(geometry(ST_MakePoint($1, $2, 0)), geometry(ST_MakePoint(x, y, 0)))
-            <= {uncertainty_sigma} * SQRT( (($1 - x)^2 * ($4^2 + err_x^2) + ($2 - y)^2 * ($5^2 + err_y^2))
-            / COALESCE( NULLIF( (($1 - x)^2 + ($2 - y)^2), 0), 1) )
-            AND
-            ST_3DDistance( geometry(ST_MakePoint(0, 0, $3)), geometry(ST_MakePoint(0, 0, z)))
-            <= {uncertainty_sigma} * SQRT($6^2 + err_z^2)
-            AND d.instance_id = i.id
-            AND i.run_id = $7
-            ORDER BY d.id
-            ASC FOR UPDATE OF d""",
+        SOURCE_MATCH.format(schema=schema, uncertainty_sigma=uncertainty_sigma),
         x,
         y,
         z,
         err_x,
         err_y,
         err_z,
-        run_id)
+        run_id,
+        *bounds.box(detection, uncertainty_sigma))
 
     for i, j in enumerate(result):
         # do not want the original detection if it already exists
@@ -255,59 +367,70 @@ async def db_source_match(conn, schema: str, run_id: int,
     return result
 
 
-def _check_bytea(var):
-    num_bytes = sys.getsizeof(var)
-    if num_bytes < MAX_BYTEA:
-        return var, num_bytes
-    else:
-        return None, 0
-
-
-async def db_detection_product_insert(conn, schema, detection_id, cube, mask,
-                                      mom0, mom1, mom2, chan, spec, pv):
-
-    cube_bytes, cube_bytes_t = _check_bytea(cube)
-    if cube_bytes is None:
-        logging.warn(f"cube for {detection_id} too large, ignoring")
+def source_match(a, b, uncertainty_sigma: int):
+    """In-memory equivalent of the positional match of SOURCE_MATCH.
 
-    mask_bytes, mask_bytes_t = _check_bytea(mask)
-    if mask_bytes is None:
-        logging.warn(f"mask for {detection_id} too large, ignoring")
+    """
+    for key in ('x', 'y', 'z', 'err_x', 'err_y', 'err_z'):
+        if a[key] is None or b[key] is None:
+            return False
 
-    mom0_bytes, mom0_bytes_t = _check_bytea(mom0)
-    if mom0_bytes is None:
-        logging.warn(f"mom0 for {detection_id} too large, ignoring")
+    dx = a['x'] - b['x']
+    dy = a['y'] - b['y']
+    dz = a['z'] - b['z']
+    dist2 = dx ** 2 + dy ** 2
+    norm = dist2 if dist2 != 0 else 1
 
-    mom1_bytes, mom1_bytes_t = _check_bytea(mom1)
-    if mom1_bytes is None:
-        logging.warn(f"mom1 for {detection_id} too large, ignoring")
+    var_x = dx ** 2 * (a['err_x'] ** 2 + b['err_x'] ** 2)
+    var_y = dy ** 2 * (a['err_y'] ** 2 + b['err_y'] ** 2)
+    limit = uncertainty_sigma * math.sqrt((var_x + var_y) / norm)
+    if math.sqrt(dist2) > limit:
+        return False
 
-    mom2_bytes, mom2_bytes_t = _check_bytea(mom2)
-    if mom2_bytes is None:
-        logging.warn(f"mom2 for {detection_id} too large, ignoring")
+    return abs(dz) <= uncertainty_sigma * math.sqrt(a['err_z'] ** 2 + b['err_z'] ** 2)
 
-    chan_bytes, chan_bytes_t = _check_bytea(chan)
-    if chan_bytes is None:
-        logging.warn(f"chan for {detection_id} too large, ignoring")
 
-    spec_bytes, spec_bytes_t = _check_bytea(spec)
-    if spec_bytes is None:
-        logging.warn(f"spec for {detection_id} too large, ignoring")
+def _select_products(detection_id, sizes: list):
+    """Which of the products (in PRODUCT_COLUMNS order) fit in the product
+    row, None if it can not be written at all.
 
-    pv_bytes, pv_bytes_t = _check_bytea(pv)
-    if pv_bytes is None:
-        logging.warn(f"pv for {detection_id} too large, ignoring")
+    """
+    keep = {}
+    for name, size in zip(PRODUCT_COLUMNS, sizes):
+        keep[name] = size < MAX_BYTEA
+        if not keep[name]:
+            logging.warn(f"{name} for {detection_id} too large, ignoring")
 
-    total_bytes = cube_bytes_t + mask_bytes_t + mom0_bytes_t + mom1_bytes_t + chan_bytes_t + spec_bytes_t + pv_bytes_t
+    t = {name: size if keep[name] else 0 for name, size in zip(PRODUCT_COLUMNS, sizes)}
+    total_bytes = t['cube'] + t['mask'] + t['mom0'] + t['mom1'] + t['chan'] + t['spec'] + t['pv']
     if total_bytes > MAX_BYTEA:
-        total_bytes = mom0_bytes_t + mom1_bytes_t + spec_bytes_t
+        total_bytes = t['mom0'] + t['mom1'] + t['spec']
         if total_bytes < MAX_BYTEA:
-            cube_bytes = None
-            mask_bytes = None
-            chan_bytes = None
+            keep['cube'] = False
+            keep['mask'] = False
+            keep['chan'] = False
         else:
             logging.warn(f"Products for {detection_id} too large, ignoring")
-            return
+            return None
+
+    return [keep[name] for name in PRODUCT_COLUMNS]
+
+
+@timed('product_insert')
+async def db_detection_product_insert(conn, schema, detection_id, cube, mask,
+                                      mom0, mom1, mom2, chan, spec, pv):
+
+    products = (cube, mask, mom0, mom1, mom2, chan, spec, pv)
+    keep = _select_products(detection_id, [0 if i is None else len(i) for i in products])
+    if keep is None:
+        return
+
+    cube_bytes, mask_bytes, mom0_bytes, mom1_bytes, mom2_bytes, chan_bytes, \
+        spec_bytes, pv_bytes = (i if k else None for i, k in zip(products, keep))
+
+    incr('bytes_uploaded', sum(len(i) for i in (
+        cube_bytes, mask_bytes, mom0_bytes, mom1_bytes, mom2_bytes,
+        chan_bytes, spec_bytes, pv_bytes) if i is not None))
 
     product_id = await conn.fetchrow(
         f'INSERT INTO {schema}.product \
@@ -328,75 +451,177 @@ async def db_detection_product_insert(conn, schema, detection_id, cube, mask,
         pv_bytes)
 
 
+async def _product_copy_source(detection_id: int, sizes: list, keep: list, stream):
+    # binary COPY stream of a single product row, bytea fields are raw bytes
+    yield COPY_HEADER + struct.pack('!hiq', len(PRODUCT_COLUMNS) + 1, 8, detection_id)
+    for index, (size, k) in enumerate(zip(sizes, keep)):
+        if not k:
+            yield struct.pack('!i', -1)
+            continue
+
+        yield struct.pack('!i', size)
+        sent = 0
+        async for chunk in stream(index):
+            sent += len(chunk)
+            yield chunk
+        if sent != size:
+            raise ValueError(f'{PRODUCT_COLUMNS[index]} for {detection_id} changed while streaming')
+    yield struct.pack('!h', -1)
+
+
+@timed('product_insert')
+async def db_detection_product_copy(conn, schema: str, detection_id: int, sizes: list, stream):
+    """Stream the products of a detection into the product table with a
+    binary COPY, so only one chunk of each product is held in memory.
+
+    stream(index) returns an async iterator over the chunks of the product
+    at index of PRODUCT_COLUMNS, which must add up to sizes[index] bytes.
+    Like db_detection_product_insert, an existing product row is kept.
+
+    """
+    exists = await conn.fetchval(
+        f'SELECT 1 FROM {schema}.product WHERE detection_id=$1',
+        detection_id
+    )
+    if exists:
+        return
+
+    keep = _select_products(detection_id, sizes)
+    if keep is None:
+        return
+
+    incr('bytes_uploaded', sum(size for size, k in zip(sizes, keep) if k))
+    incr('products_streamed')
+    await conn.copy_to_table(
+        'product',
+        schema_name=schema,
+        columns=('detection_id',) + PRODUCT_COLUMNS,
+        source=_product_copy_source(detection_id, sizes, keep, stream),
+        format='binary'
+    )
+
+
+@timed('detection_insert')
+async def db_detection_row_insert(conn, schema: str, vo_datalink_url: str, run_id: int,
+                                  instance_id: int, detection: Detection,
+                                  unresolved: bool = False):
+    """Insert a detection without its products, returns its id.
+
+    """
+    detection_id = await conn.fetchrow(
+        _DETECTION_INSERT.format(schema=schema),
+        run_id, instance_id, unresolved, *detection.values(), vo_datalink_url)
+    return detection_id[0]
+
+
+def conflict_key(row):
+    """Values of CONFLICT_COLUMNS of a detection row or mapping, identifying
+    the stored detection a row was inserted as. As in the unique constraint,
+    nan equals nan and None (NULL) equals nothing, not even itself.
+
+    """
+    key = []
+    for name in CONFLICT_COLUMNS:
+        value = row[name]
+        if value is None:
+            value = object()
+        elif isinstance(value, float) and value != value:
+            value = 'nan'
+        key.append(value)
+    return tuple(key)
+
+
+def unique_rows(rows: list):
+    """Collapse the rows with the same conflict_key into the first, taking ra
+    and unresolved from the last like a row by row upsert would.
+
+    Returns the unique rows and the index in them of every row.
+
+    """
+    unique = []
+    index = []
+    first = {}
+    for row in rows:
+        key = conflict_key(row)
+        if key in first:
+            i = first[key]
+            unique[i] = dict(unique[i], ra=row['ra'], unresolved=row['unresolved'])
+        else:
+            i = first[key] = len(unique)
+            unique.append(row)
+        index.append(i)
+    return unique, index
+
+
+def _load_row(run_id: int, instance_id: int, detection: Detection, unresolved: bool):
+    row = dict(zip(DETECTION_COLUMNS, detection.values()))
+    row.update(run_id=run_id, instance_id=instance_id, unresolved=unresolved)
+    return row
+
+
+@timed('detection_insert')
+async def db_detection_rows_insert(conn, schema: str, vo_datalink_url: str, run_id: int,
+                                   rows: list):
+    """Insert detections without their products in one binary COPY, returns
+    their ids in the order of rows, a list of (instance_id, Detection,
+    unresolved). Like db_detection_row_insert, a detection already stored
+    keeps its id and access_url, and rows with the same conflict_key are
+    stored once (see unique_rows).
+
+    The loaded rows are numbered (seq) and the ids read back by number, so
+    no values are compared outside the database.
+
+    """
+    if not rows:
+        return []
+
+    rows, index = unique_rows([_load_row(run_id, *row) for row in rows])
+    async with conn.transaction():
+        # same column types as the detection table, without its constraints
+        await conn.execute(
+            f'CREATE TEMPORARY TABLE detection_load ON COMMIT DROP AS \
+            SELECT 0 AS seq, id, false AS inserted, {", ".join(_LOAD_COLUMNS)} \
+            FROM {schema}.detection WITH NO DATA')
+        await conn.copy_records_to_table(
+            'detection_load',
+            columns=('seq',) + _LOAD_COLUMNS,
+            records=[(seq, *(row[name] for name in _LOAD_COLUMNS))
+                     for seq, row in enumerate(rows)]
+        )
+        for statement in _DETECTION_LOAD:
+            await conn.execute(statement.format(schema=schema))
+        await conn.execute(_DETECTION_LOAD_INSERT.format(schema=schema), vo_datalink_url)
+        result = await conn.fetch('SELECT seq, id FROM detection_load')
+        await conn.execute('DROP TABLE detection_load')
+
+    ids = {r['seq']: r['id'] for r in result}
+    return [ids[i] for i in index]
+
+
 async def db_detection_insert(conn, schema: str, vo_datalink_url: str, run_id: int, instance_id: int,
-                              detection: dict, cube: bytes, mask: bytes,
+                              detection: Detection, cube: bytes, mask: bytes,
                               mom0: bytes, mom1: bytes, mom2: bytes,
                               chan: bytes, spec: bytes, pv: bytes,
                               unresolved: bool = False):
 
-    detection['run_id'] = run_id
-    detection['instance_id'] = instance_id
-    detection['unresolved'] = unresolved
+    detection_id = await db_detection_row_insert(
+        conn, schema, vo_datalink_url, run_id, instance_id, detection, unresolved)
 
-    for _, key in enumerate(Const.FULL_SCHEMA):
-        if detection.get(key, None) is None:
-            detection[key] = Const.FULL_SCHEMA[key]
-
-    detection_id = await conn.fetchrow(
-        f'INSERT INTO {schema}.detection \
-            (run_id, instance_id, unresolved, name, x, y, z, x_min, x_max, \
-            y_min, y_max, z_min, z_max, n_pix, f_min, f_max, f_sum, rel, \
-            flag, rms, w20, w50, ell_maj, ell_min, ell_pa, ell3s_maj, \
-            ell3s_min, ell3s_pa, kin_pa, err_x, err_y, err_z, err_f_sum, \
-            ra, dec, freq, l, b, v_rad, v_opt, v_app, \
-            wm50, x_peak, y_peak, z_peak, ra_peak, dec_peak, \
-            freq_peak, l_peak, b_peak, v_rad_peak, v_opt_peak, v_app_peak, \
-            access_url) \
-        VALUES(\
-            $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15,\
-            $16, $17, $18, $19, $20, $21, $22, $23, $24, $25, $26, $27, $28,\
-            $29, $30, $31, $32, $33, $34, $35, $36, $37, $38, $39, $40, $41, \
-            $42, $43, $44, $45, $46, $47, $48, $49, $50, $51, $52, $53, \
-            $54 || currval(pg_get_serial_sequence(\'{schema}.detection\', \'id\'))) \
-        ON CONFLICT (\
-            name, x, y, z, x_min, x_max, y_min, y_max, z_min, z_max, \
-            n_pix, f_min, f_max, f_sum, instance_id, run_id) \
-        DO UPDATE SET ra=EXCLUDED.ra, unresolved=EXCLUDED.unresolved \
-        RETURNING id',
-        detection['run_id'], detection['instance_id'], detection['unresolved'],
-        detection['name'], detection['x'], detection['y'], detection['z'],
-        detection['x_min'], detection['x_max'],
-        detection['y_min'], detection['y_max'], detection['z_min'],
-        detection['z_max'], detection['n_pix'], detection['f_min'],
-        detection['f_max'], detection['f_sum'],
-        detection['rel'], detection['flag'], detection['rms'],
-        detection['w20'], detection['w50'], detection['ell_maj'],
-        detection['ell_min'], detection['ell_pa'],
-        detection['ell3s_maj'], detection['ell3s_min'],
-        detection['ell3s_pa'], detection['kin_pa'], detection['err_x'],
-        detection['err_y'], detection['err_z'], detection['err_f_sum'],
-        detection['ra'], detection['dec'], detection['freq'], detection['l'],
-        detection['b'], detection['v_rad'], detection['v_opt'],
-        detection['v_app'], detection['wm50'],
-        detection['x_peak'], detection['y_peak'], detection['z_peak'],
-        detection['ra_peak'], detection['dec_peak'], detection['freq_peak'],
-        detection['l_peak'], detection['b_peak'], detection['v_rad_peak'],
-        detection['v_opt_peak'], detection['v_app_peak'],
-        vo_datalink_url
-    )
-
-    await db_detection_product_insert(conn, schema, detection_id[0], cube, mask, mom0,
+    await db_detection_product_insert(conn, schema, detection_id, cube, mask, mom0,
                                       mom1, mom2, chan, spec, pv)
-    return detection_id[0]
+    return detection_id
 
 
+@timed('detection_delete')
 async def db_delete_detection(conn, schema: str, detection_id: int):
+    incr('detections_deleted')
     await conn.fetchrow(
         f'DELETE FROM {schema}.detection WHERE id=$1',
         detection_id
     )
 
 
+@timed('unresolved_update')
 async def db_update_detection_unresolved(conn, schema: str, unresolved: bool,
                                          detection_id_list: list):
     await conn.fetchrow(
@@ -406,3 +631,95 @@ async def db_update_detection_unresolved(conn, schema: str, unresolved: bool,
         unresolved,
         detection_id_list
     )
+
+
+async def db_detection_groups(conn, schema: str, column: str, detection_id_list: list):
+    result = await conn.fetch(
+        f'SELECT id, {column} FROM {schema}.detection WHERE id = ANY($1::bigint[])',
+        detection_id_list
+    )
+    return {r['id']: r[column] for r in result}
+
+
+@timed('unresolved_update')
+async def db_update_unresolved_groups(conn, schema: str, column: str, run_id: int,
+                                      groups: list, inherited: dict = None):
+    """Set the detections of each group unresolved and store their group id in
+    column, in one statement. Groups linked through a detection already
+    stored with a group id are merged (see assign_groups). inherited holds
+    the stored group id of detections deleted since they were grouped.
+
+    """
+    ids = [i for group in groups for i in group]
+    if not ids:
+        return
+
+    existing = await db_detection_groups(conn, schema, column, ids)
+    for i, group_id in (inherited or {}).items():
+        if existing.get(i) is None:
+            existing[i] = group_id
+    members, renamed = assign_groups(groups, existing)
+
+    await conn.execute(
+        f'UPDATE {schema}.detection AS d \
+        SET unresolved=true, {column}=m.group_id \
+        FROM unnest($1::bigint[], $2::bigint[]) AS m(id, group_id) \
+        WHERE d.id = m.id',
+        list(members.keys()),
+        list(members.values())
+    )
+
+    if renamed:
+        await conn.execute(
+            f'UPDATE {schema}.detection AS d \
+            SET {column}=m.group_id \
+            FROM unnest($1::bigint[], $2::bigint[]) AS m(old_id, group_id) \
+            WHERE d.run_id = $3 AND d.{column} = m.old_id',
+            list(renamed.keys()),
+            list(renamed.values()),
+            run_id
+        )
+
+
+@timed('run_detections')
+async def db_run_detections(conn, schema: str, run_id: int):
+    return await conn.fetch(
+        f'SELECT id, {", ".join(MATCH_COLUMNS)}, unresolved \
+        FROM {schema}.detection \
+        WHERE run_id=$1 \
+        ORDER BY id ASC FOR UPDATE',
+        run_id
+    )
+
+
+@timed('detection_delete')
+async def db_delete_detections(conn, schema: str, detection_id_list: list):
+    incr('detections_deleted', len(detection_id_list))
+    await conn.fetchrow(
+        f'DELETE FROM {schema}.detection WHERE id = ANY($1::bigint[])',
+        detection_id_list
+    )
+
+
+async def db_instance_metrics(conn, schema: str, column: str,
+                              instance: Instance, metrics: dict):
+    await conn.fetchrow(
+        f'UPDATE {schema}.instance SET {column}=$1 WHERE id=$2',
+        json.dumps(metrics),
+        instance.instance_id
+    )
+
+
+async def db_check_detection_columns(conn, schema: str):
+    """Fail if the detection table lacks a column SoFiAX writes.
+
+    """
+    result = await conn.fetch(
+        'SELECT column_name FROM information_schema.columns \
+        WHERE table_schema=$1 AND table_name=$2',
+        schema,
+        'detection'
+    )
+    missing = missing_columns([r['column_name'] for r in result])
+    if missing:
+        raise ValueError(f'{schema}.detection is missing columns: {", ".join(missing)}')
@@ -0,0 +1,368 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import asyncio
+import logging
+import asyncpg
+import aiofiles
+import numpy as np
+
+from astropy.io import fits
+
+from sofiax.columns import PRODUCT_COLUMNS
+
+
+EXPORT_CHUNK_ROWS = 100000
+
+# null of integer columns, numeric columns are exported as float8 with NaN
+INT_NULL = np.iinfo(np.int64).min
+
+# size of the binary COPY header with an empty extension area
+COPY_HEADER_SIZE = 19
+
+# file names of the exported products, as written by SoFiA for its cubelets
+PRODUCT_FILES = {
+    'cube': 'cube.fits', 'mask': 'mask.fits', 'mom0': 'mom0.fits',
+    'mom1': 'mom1.fits', 'mom2': 'mom2.fits', 'chan': 'chan.fits',
+    'spec': 'spec.txt', 'pv': 'pv.fits'
+}
+
+_FLOAT_TYPES = ('double precision', 'real', 'numeric')
+_INT_TYPES = ('bigint', 'integer', 'smallint')
+_TEXT_TYPES = ('text', 'character varying', 'character')
+
+
+class ExportColumn(object):
+    """How a detection table column is cast so every exported row has the
+    same binary COPY layout: numbers as float8 (NULL as NaN) or int8 (NULL as
+    INT_NULL), booleans (NULL as false) and text as zero padded bytea of the
+    longest value of the run.
+
+    """
+    def __init__(self, name: str, kind: str, width: int = 0):
+        self.name = name
+        self.kind = kind
+        self.width = width
+
+    @property
+    def wire_dtype(self):
+        return {'f8': '>f8', 'i8': '>i8', 'bool': '?'}.get(self.kind, f'S{self.width}')
+
+    def select_sql(self):
+        if self.kind == 'f8':
+            return f"coalesce({self.name}::float8, 'NaN')"
+        if self.kind == 'i8':
+            return f"coalesce({self.name}::int8, '{INT_NULL}'::int8)"
+        if self.kind == 'bool':
+            return f"coalesce({self.name}, false)"
+        return f"decode(rpad(encode(convert_to(coalesce({self.name}::text, ''), 'UTF8'), 'hex'), \
+            {2 * self.width}, '0'), 'hex')"
+
+    def fits_column(self):
+        if self.kind == 'f8':
+            return fits.Column(name=self.name, format='D')
+        if self.kind == 'i8':
+            return fits.Column(name=self.name, format='K', null=INT_NULL)
+        if self.kind == 'bool':
+            return fits.Column(name=self.name, format='L')
+        return fits.Column(name=self.name, format=f'{self.width}A')
+
+
+async def export_plan(conn, schema: str, run_id: int):
+    """Exported columns of the detection table, in table order. Columns of
+    other types (geometry, json, ...) are left out.
+
+    """
+    result = await conn.fetch(
+        'SELECT column_name, data_type FROM information_schema.columns \
+        WHERE table_schema=$1 AND table_name=$2 ORDER BY ordinal_position',
+        schema, 'detection'
+    )
+    plan = []
+    for row in result:
+        name, data_type = row['column_name'], row['data_type']
+        if data_type in _FLOAT_TYPES:
+            plan.append(ExportColumn(name, 'f8'))
+        elif data_type in _INT_TYPES:
+            plan.append(ExportColumn(name, 'i8'))
+        elif data_type == 'boolean':
+            plan.append(ExportColumn(name, 'bool'))
+        elif data_type in _TEXT_TYPES:
+            width = await conn.fetchval(
+                f'SELECT max(octet_length({name}::text)) FROM {schema}.detection WHERE run_id=$1',
+                run_id
+            )
+            plan.append(ExportColumn(name, 'text', max(width or 0, 1)))
+        else:
+            logging.info(f'Not exporting column {name} of type {data_type}')
+    return plan
+
+
+def wire_dtype(plan: list):
+    """Structured dtype of one binary COPY row of the plan.
+
+    """
+    fields = [('_count', '>i2')]
+    for i, column in enumerate(plan):
+        fields.append((f'_length{i}', '>i4'))
+        fields.append((column.name, column.wire_dtype))
+    return np.dtype(fields)
+
+
+class CopyDecoder(object):
+    """Cuts a binary COPY stream of fixed layout rows into structured arrays
+    of up to chunk_rows rows, decoding each chunk with one np.frombuffer.
+
+    """
+    def __init__(self, dtype: np.dtype, chunk_rows: int):
+        self.dtype = dtype
+        self.chunk_bytes = dtype.itemsize * chunk_rows
+        self._buffer = bytearray()
+        self._header = False
+
+    def feed(self, data: bytes):
+        """Add stream data, returns the arrays of the complete chunks.
+
+        """
+        self._buffer += data
+        if not self._header:
+            if len(self._buffer) < COPY_HEADER_SIZE:
+                return []
+            if not self._buffer.startswith(b'PGCOPY\n\xff\r\n\x00'):
+                raise ValueError('Not a binary COPY stream')
+            del self._buffer[:COPY_HEADER_SIZE]
+            self._header = True
+
+        chunks = []
+        while len(self._buffer) >= self.chunk_bytes:
+            chunks.append(self._take(self.chunk_bytes))
+        return chunks
+
+    def finish(self):
+        """Return the last rows once the stream has ended.
+
+        """
+        if not self._buffer.endswith(b'\xff\xff'):
+            raise ValueError('Binary COPY stream ended without trailer')
+        del self._buffer[-2:]
+        size = len(self._buffer) - len(self._buffer) % self.dtype.itemsize
+        if size != len(self._buffer):
+            raise ValueError('Binary COPY stream has a partial row')
+        return [self._take(size)] if size else []
+
+    def _take(self, size: int):
+        records = np.frombuffer(bytes(self._buffer[:size]), dtype=self.dtype)
+        del self._buffer[:size]
+        if records.size and (records['_count'] != (len(self.dtype.names) - 1) // 2).any():
+            raise ValueError('Unexpected field count in binary COPY stream')
+        return records
+
+
+class FitsTableWriter(object):
+    """Writes a FITS binary table chunk by chunk. The header is written first
+    with the final row count, the big endian rows of each chunk follow as is.
+
+    """
+    def __init__(self, path: str, plan: list, rows: int, header: dict = None):
+        hdu = fits.BinTableHDU.from_columns([c.fits_column() for c in plan], nrows=0)
+        hdu.header['NAXIS2'] = rows
+        for key, value in (header or {}).items():
+            hdu.header[key] = value
+
+        self.plan = plan
+        self.rows = rows
+        self.written = 0
+        self.dtype = np.dtype([(c.name, 'u1' if c.kind == 'bool' else c.wire_dtype) for c in plan])
+        if hdu.header['NAXIS1'] != self.dtype.itemsize:
+            raise ValueError('FITS row size does not match the export plan')
+
+        self._file = open(path, 'wb')
+        self._file.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        self._file.write(hdu.header.tostring().encode('ascii'))
+
+    def write(self, records: np.ndarray):
+        rows = np.empty(records.size, dtype=self.dtype)
+        for column in self.plan:
+            if column.kind == 'bool':
+                rows[column.name] = np.where(records[column.name], ord('T'), ord('F'))
+            else:
+                rows[column.name] = records[column.name]
+        self._file.write(rows.tobytes())
+        self.written += records.size
+
+    def close(self):
+        if self.written != self.rows:
+            self._file.close()
+            raise ValueError(f'Wrote {self.written} rows, expected {self.rows}')
+        # data is padded to a whole FITS block
+        size = self.written * self.dtype.itemsize
+        self._file.write(b'\x00' * (-size % 2880))
+        self._file.close()
+
+
+class ParquetWriter(object):
+    """Writes a Parquet file with one row group per chunk (needs pyarrow).
+
+    """
+    def __init__(self, path: str, plan: list, rows: int, header: dict = None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ValueError('Parquet export requires pyarrow to be installed')
+
+        self._pa = pyarrow
+        self.plan = plan
+        types = {'f8': pyarrow.float64(), 'i8': pyarrow.int64(),
+                 'bool': pyarrow.bool_(), 'text': pyarrow.string()}
+        schema = pyarrow.schema([(c.name, types[c.kind]) for c in plan],
+                                metadata={k: str(v) for k, v in (header or {}).items()})
+        self._writer = pyarrow.parquet.ParquetWriter(path, schema)
+
+    def write(self, records: np.ndarray):
+        arrays = []
+        for column in self.plan:
+            values = records[column.name]
+            if column.kind == 'text':
+                arrays.append(self._pa.array(np.char.decode(values, 'utf-8')))
+            elif column.kind == 'i8':
+                values = values.astype(np.int64)
+                arrays.append(self._pa.array(values, mask=values == INT_NULL))
+            else:
+                arrays.append(self._pa.array(values.astype(values.dtype.newbyteorder('='))))
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, names=[c.name for c in self.plan]))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {'fits': FitsTableWriter, 'parquet': ParquetWriter}
+
+
+async def export_detections(conn, schema: str, run_id: int, path: str, fmt: str,
+                            chunk_rows: int = EXPORT_CHUNK_ROWS, header: dict = None):
+    """Stream the detections of a run into a FITS or Parquet table with a
+    binary COPY, decoded into columnar chunks of chunk_rows rows.
+
+    Returns the detection ids exported.
+
+    """
+    loop = asyncio.get_event_loop()
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        plan = await export_plan(conn, schema, run_id)
+        rows = await conn.fetchval(
+            f'SELECT count(*) FROM {schema}.detection WHERE run_id=$1', run_id)
+
+        writer = await loop.run_in_executor(None, WRITERS[fmt], path, plan, rows, header)
+        decoder = CopyDecoder(wire_dtype(plan), chunk_rows)
+        ids = []
+
+        async def write(chunks):
+            for records in chunks:
+                if 'id' in records.dtype.names:
+                    ids.append(records['id'].astype(np.int64))
+                await loop.run_in_executor(None, writer.write, records)
+
+        async def output(data):
+            await write(decoder.feed(data))
+
+        select = ', '.join(c.select_sql() for c in plan)
+        await conn.copy_from_query(
+            f'SELECT {select} FROM {schema}.detection WHERE run_id=$1 ORDER BY id',
+            run_id, output=output, format='binary')
+        await write(decoder.finish())
+        await loop.run_in_executor(None, writer.close)
+
+    logging.info(f'Exported {rows} detections to {path}')
+    return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+
+
+async def _export_products(pool, schema: str, queue: asyncio.Queue, products_dir: str):
+    while True:
+        detection_id = await queue.get()
+        try:
+            async with pool.acquire() as conn:
+                for name in PRODUCT_COLUMNS:
+                    # one product at a time, the others can be up to 1GB each
+                    data = await conn.fetchval(
+                        f'SELECT {name} FROM {schema}.product WHERE detection_id=$1',
+                        detection_id)
+                    if data is None:
+                        continue
+                    path = os.path.join(products_dir, f'{detection_id}_{PRODUCT_FILES[name]}')
+                    async with aiofiles.open(path, 'wb') as f:
+                        await f.write(data)
+        finally:
+            queue.task_done()
+
+
+async def export_products(pool, schema: str, detection_ids, products_dir: str, workers: int = 1):
+    """Write the products of each detection to products_dir as
+    <detection id>_<product file>, with workers connections of the pool.
+
+    """
+    os.makedirs(products_dir, exist_ok=True)
+    queue = asyncio.Queue()
+    for detection_id in detection_ids:
+        queue.put_nowait(int(detection_id))
+
+    tasks = [asyncio.create_task(_export_products(pool, schema, queue, products_dir))
+             for _ in range(workers)]
+    try:
+        join = asyncio.create_task(queue.join())
+        done, _ = await asyncio.wait([join] + tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is not join:
+                # a worker only returns by raising
+                join.cancel()
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+    logging.info(f'Exported products of {len(detection_ids)} detections to {products_dir}')
+
+
+async def run_export_command(config, run_name: str, path: str, fmt: str,
+                             chunk_rows: int = EXPORT_CHUNK_ROWS,
+                             products_dir: str = None, product_workers: int = 1):
+    schema = config.get('db_schema', 'wallaby')
+    connect = dict(
+        user=config['db_username'],
+        password=config['db_password'],
+        database=config['db_name'],
+        host=config['db_hostname'],
+        port=config['db_port']
+    )
+    conn = await asyncpg.connect(**connect)
+    try:
+        run_id = await conn.fetchval(f'SELECT id FROM {schema}.run WHERE name=$1', run_name)
+        if run_id is None:
+            raise ValueError(f'Run {run_name} not found')
+        ids = await export_detections(conn, schema, run_id, path, fmt, chunk_rows,
+                                      {'RUNNAME': run_name})
+    finally:
+        await conn.close()
+
+    if products_dir:
+        pool = await asyncpg.create_pool(min_size=1, max_size=product_workers, **connect)
+        try:
+            await export_products(pool, schema, ids, products_dir, product_workers)
+        finally:
+            await pool.close()
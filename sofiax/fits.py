@@ -17,9 +17,11 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.#
 
+import os
 import json
 import asyncio
 import astropy
+import collections
 
 from astropy.io import fits
 
@@ -36,3 +38,40 @@ async def extract_fits_header(filepath, loop=None):
             value = [i for i in value]
         hdr_dict[key] = value
     return hdr_dict
+
+
+HEADER_CACHE_SIZE = 64
+
+# headers by (path, mtime, size), shared by every instance of the process
+_header_cache = collections.OrderedDict()
+_pending = {}
+
+
+async def read_fits_header(filepath):
+    """Primary header of a FITS file as a dict, read once while the file is
+    unchanged. Concurrent reads of the same file share a single read.
+
+    """
+    stat = os.stat(filepath)
+    key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+    header = _header_cache.get(key)
+    if header is not None:
+        _header_cache.move_to_end(key)
+        return header
+
+    future = _pending.get(key)
+    if future is not None and future.get_loop() is asyncio.get_event_loop():
+        return await asyncio.shield(future)
+
+    future = asyncio.ensure_future(extract_fits_header(filepath))
+    _pending[key] = future
+    try:
+        header = await asyncio.shield(future)
+    finally:
+        if _pending.get(key) is future:
+            del _pending[key]
+
+    _header_cache[key] = header
+    while len(_header_cache) > HEADER_CACHE_SIZE:
+        _header_cache.popitem(last=False)
+    return header
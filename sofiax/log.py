@@ -0,0 +1,104 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import sys
+import time
+import queue
+import atexit
+import logging
+import collections
+import logging.handlers
+
+
+SUMMARY_INTERVAL = 30.0
+
+# per-source messages of the merge, off unless enabled with configure_detection_log
+detail = logging.getLogger('sofiax.detections')
+detail.setLevel(logging.WARNING)
+
+_listener = None
+
+
+def configure_logging(level: int = logging.DEBUG, stream=sys.stdout):
+    """Send the records of the root logger through a queue to a thread
+    writing them to stream, so logging never blocks the event loop on I/O.
+    The queue is drained when the process exits.
+
+    """
+    global _listener
+    handler = logging.StreamHandler(stream)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    ))
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(records))
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_detection_log(enabled: bool):
+    """Log every detection's merge outcome and failed sanity check.
+
+    """
+    detail.setLevel(logging.INFO if enabled else logging.WARNING)
+
+
+class DetectionLog(object):
+    """Counts the merge outcome of the detections of an instance, logging
+    the counts every interval seconds and once the instance is merged.
+
+    """
+    def __init__(self, name: str, interval: float = SUMMARY_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._last = time.monotonic()
+
+    def record(self, outcome: str, message: str = None, *args):
+        """Count a detection outcome, message and args are only formatted
+        when per-source detail is enabled.
+
+        """
+        self.counts[outcome] += 1
+        if message is not None and detail.isEnabledFor(logging.INFO):
+            detail.info(message, *args)
+
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.summary()
+
+    def summary(self, final: bool = False):
+        counts = ', '.join(f'{k}: {v}' for k, v in sorted(self.counts.items()))
+        total = sum(self.counts.values())
+        state = 'merged' if final else 'merging'
+        logging.info(f'{self.name} {state}, {total} detection(s) ({counts or "none"})')
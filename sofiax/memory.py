@@ -0,0 +1,147 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import asyncio
+import logging
+import collections
+
+from contextlib import asynccontextmanager
+
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# in-memory size of a parsed catalog relative to its file size
+CATALOG_EXPANSION = 8
+
+
+def parse_size(value: str):
+    """Parse a byte size such as 512M or 80G.
+
+    """
+    value = str(value).strip().upper().rstrip('B')
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+class MemoryBudget(object):
+    """Byte budget shared by all tasks of the process.
+
+    Reservations wait, in order, until enough of the budget is released. A
+    single reservation is clamped to the limit, and when every task holding
+    part of the budget is itself waiting the oldest waiter is let through, so
+    the budget lowers concurrency instead of deadlocking. A task must not
+    wait on anything else, such as the run lock, while holding part of the
+    budget (see sofiax.merge.locked_run).
+
+    """
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._held = collections.Counter()
+        self._waiters = collections.deque()
+
+    def available(self):
+        if self.limit is None:
+            return float('inf')
+        return max(self.limit - self.used, 0)
+
+    def _grant(self, task, nbytes: int):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        self._held[task] += nbytes
+
+    def _wake(self):
+        while self._waiters:
+            task, nbytes, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+
+            waiting = set(t for t, _, f in self._waiters if not f.done())
+            holders = set(t for t, n in self._held.items() if n > 0)
+            if self.used + nbytes > self.limit and not holders <= waiting:
+                break
+
+            if self.used + nbytes > self.limit:
+                logging.warning(f'Memory budget exceeded by waiting tasks, granting {nbytes} bytes')
+            self._waiters.popleft()
+            self._grant(task, nbytes)
+            future.set_result(None)
+
+    async def acquire(self, nbytes: int, task=None):
+        """Reserve nbytes on behalf of task (the current task by default),
+        returns the amount reserved.
+
+        """
+        if task is None:
+            task = asyncio.current_task()
+        nbytes = int(nbytes)
+        if self.limit is not None:
+            nbytes = min(nbytes, self.limit)
+
+        if self.limit is None or (not self._waiters and self.used + nbytes <= self.limit):
+            self._grant(task, nbytes)
+            return nbytes
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((task, nbytes, future))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(nbytes, task)
+            raise
+        return nbytes
+
+    def release(self, nbytes: int, task=None):
+        if task is None:
+            task = asyncio.current_task()
+        self.used -= nbytes
+        self._held[task] -= nbytes
+        if self._held[task] <= 0:
+            del self._held[task]
+        if self.limit is not None:
+            self._wake()
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int):
+        nbytes = await self.acquire(nbytes)
+        try:
+            yield nbytes
+        finally:
+            self.release(nbytes)
+
+
+_budget = MemoryBudget()
+
+
+def configure_memory(limit: int = None):
+    """Set the process-wide memory budget, None for no limit.
+
+    """
+    global _budget
+    _budget = MemoryBudget(limit)
+    return _budget
+
+
+def get_budget():
+    return _budget
@@ -21,43 +21,38 @@ import os
 import glob
 import random
 import shutil
+import functools
 import asyncio
-import aiofiles
 import aiofiles.os
-import xmltodict
 import configparser
 import logging
-import asyncpg
 
 from datetime import datetime
+from contextlib import asynccontextmanager
 
-from sofiax.db import db_run_upsert, db_instance_upsert, \
-    db_detection_insert, db_source_match, \
-    db_delete_detection, db_update_detection_unresolved, db_lock_run, Run, Instance
+from sofiax.db import Run, Instance
+from sofiax.backend import open_backend
 
-from sofiax.fits import extract_fits_header
+from sofiax.fits import read_fits_header
+from sofiax.catalog import read_catalog, catalog_path
+from sofiax.columns import Detection
+from sofiax.conflict import ConflictGraph
+from sofiax.utils import get_file_bytes, read_config, read_column
+from sofiax.products import open_products
+from sofiax.bundle import PRODUCT_CHUNK
+from sofiax.memory import get_budget, CATALOG_EXPANSION
+from sofiax.log import DetectionLog, SUMMARY_INTERVAL, detail
+from sofiax.profile import set_profile_path, write_profile
+from sofiax.metrics import start_metrics, stop_metrics, current_metrics, \
+    timer, incr, dumps, write_prometheus
 
 
-async def _get_file_bytes(path: str, mode: str = 'rb'):
-    buffer = []
-
-    if not os.path.isfile(path):
-        return b''
-
-    async with aiofiles.open(path, mode) as f:
-        while True:
-            buff = await f.read()
-            if not buff:
-                break
-            buffer.append(buff)
-        if 'b' in mode:
-            return b''.join(buffer)
-        else:
-            return ''.join(buffer)
+# read size of the SoFiA stdout and stderr pipes
+STREAM_CHUNK = 65536
 
 
 async def parse_sofia_param_file(sofia_param_path: str):
-    content = await _get_file_bytes(sofia_param_path, mode='r')
+    content = await get_file_bytes(sofia_param_path, mode='r')
     if not content:
         raise Exception(f"{sofia_param_path} is empty")
     file_contents = f"[dummy_section]\n{content}"
@@ -101,8 +96,7 @@ def sanity_check(flux: tuple, spatial_extent: tuple,
     diff = abs(f1 - f2) * 100 / ((abs(f1) + abs(f2)) / 2)
     # gone beyond the % tolerance
     if diff > sanity_thresholds['flux']:
-        message = f"Var: {f1}, {f2}, flux {round(diff, 2)}% > {sanity_thresholds['flux']}%"
-        logging.info(message)
+        detail.info("Var: %s, %s, flux %s%% > %s%%", f1, f2, round(diff, 2), sanity_thresholds['flux'])
         # require manual separation, add ref to UnresolvedDetection
         return False
 
@@ -111,14 +105,12 @@ def sanity_check(flux: tuple, spatial_extent: tuple,
     max_diff = abs(max1 - max2) * 100 / ((abs(max1) + abs(max2)) / 2)
     min_diff = abs(min1 - min2) * 100 / ((abs(min1) + abs(min2)) / 2)
     if max_diff > max_extent:
-        message = f"Var: ell_maj Check: {round(max_diff, 2)}% > {max_extent}%"
-        logging.info(message)
+        detail.info("Var: ell_maj Check: %s%% > %s%%", round(max_diff, 2), max_extent)
         # require manual separation, add ref to UnresolvedDetection
         return False
 
     if min_diff > min_extent:
-        message = f"Var: ell_min Check: {round(max_diff, 2)}% > {min_extent}%"
-        logging.info(message)
+        detail.info("Var: ell_min Check: %s%% > %s%%", round(max_diff, 2), min_extent)
 
         # require manual separation, add ref to UnresolvedDetection
         return False
@@ -128,14 +120,12 @@ def sanity_check(flux: tuple, spatial_extent: tuple,
     max_diff = abs(max1 - max2) * 100 / ((abs(max1) + abs(max2)) / 2)
     min_diff = abs(min1 - min2) * 100 / ((abs(min1) + abs(min2)) / 2)
     if max_diff > max_extent:
-        message = f"Var: w20 Check: {round(max_diff, 2)}% > {max_extent}%"
-        logging.info(message)
+        detail.info("Var: w20 Check: %s%% > %s%%", round(max_diff, 2), max_extent)
         # require manual separation, add ref to UnresolvedDetection
         return False
 
     if min_diff > min_extent:
-        message = f"Var: w50 Check: {round(max_diff, 2)}% > {min_extent}%"
-        logging.info(message)
+        detail.info("Var: w50 Check: %s%% > %s%%", round(max_diff, 2), min_extent)
 
         # require manual separation, add ref to UnresolvedDetection
         return False
@@ -143,16 +133,13 @@ def sanity_check(flux: tuple, spatial_extent: tuple,
     return True
 
 
-async def match_merge_detections(conn, schema: str, vo_datalink_url: str,
-                                 run: Run, instance: Instance, cwd: str,
-                                 perform_merge: int,
-                                 quality_flags: list):
-    """The database connection remains open for the duration of this
-    process of merging and matching detections.
+def sofia_output_paths(params: dict, cwd: str):
+    """Resolve the input cube, output directory and output filename prefix
+    of a SoFiA parameter set relative to the parameter file directory.
 
     """
-    input_fits = instance.params['input.data']
-    output_dir = instance.params['output.directory']
+    input_fits = params['input.data']
+    output_dir = params['output.directory']
 
     if os.path.isabs(input_fits) is False:
         input_fits = f"{cwd}/{os.path.basename(input_fits)}"
@@ -160,113 +147,234 @@ async def match_merge_detections(conn, schema: str, vo_datalink_url: str,
     if os.path.isabs(output_dir) is False:
         output_dir = f"{cwd}/{os.path.basename(output_dir)}"
 
-    output_filename = instance.params['output.filename']
+    output_filename = params['output.filename']
     if not output_filename:
         output_filename = os.path.splitext(os.path.basename(input_fits))[0]
 
-    vo_table = f"{output_dir}/{output_filename}_cat.xml"
-    if not os.path.exists(vo_table):
-        raise AttributeError(f'SoFiA output catalog file {vo_table} does not exist')
+    return input_fits, output_dir, output_filename
+
+
+async def get_instance_boundary(params: dict):
+    """Instance boundary from input.region or from the input cube header.
+
+    """
+    region = params.get('input.region', None)
+    if region:
+        return [int(i) for i in region.split(',')]
+
+    with timer('header_read'):
+        header = await read_fits_header(params['input.data'])
+
+    x_max = int(header.get('NAXIS1'))
+    y_max = int(header.get('NAXIS2'))
+
+    freq_axis_1 = header.get('CTYPE3', None)
+    freq_axis_2 = header.get('CTYPE4', None)
+
+    if freq_axis_1:
+        freq_axis_1 = freq_axis_1.strip()
+
+    if freq_axis_2:
+        freq_axis_2 = freq_axis_2.strip()
+
+    if freq_axis_1 == 'FREQ':
+        freq_axis = 'NAXIS3'
+
+    if freq_axis_2 == 'FREQ':
+        freq_axis = 'NAXIS4'
+
+    z_max = int(header.get(freq_axis))
+
+    return [0, x_max-1, 0, y_max-1, 0, z_max-1]
+
+
+def catalog_size(path: str):
+    """Estimated memory needed to hold a parsed catalog.
+
+    """
+    if not os.path.isfile(path):
+        return 0
+    return CATALOG_EXPANSION * os.path.getsize(path)
+
+
+async def insert_detection(backend, vo_datalink_url: str,
+                           run_id: int, instance_id: int, detection: Detection,
+                           products, detect_id: int, unresolved: bool = False):
+    """Insert a detection and its products (see insert_products).
+
+    """
+    detection_id = await backend.detection_row_insert(
+        vo_datalink_url, run_id, instance_id, detection, unresolved)
+    await insert_products(backend, detection_id, products, detect_id)
+    return detection_id
+
+
+async def insert_products(backend, detection_id: int, products, detect_id: int):
+    """Read the products of a stored detection and insert them, holding a
+    memory budget reservation for the product bytes and their copy in the
+    send buffer.
+
+    Products of at least products.stream_threshold bytes are streamed from
+    their files instead, reserving a single chunk per product.
+
+    """
+    size = await products.size(detect_id)
+    threshold = products.stream_threshold
+    if threshold is not None and size >= threshold and size > 0:
+        async with get_budget().reserve(2 * PRODUCT_CHUNK):
+            await backend.detection_product_copy(
+                detection_id, await products.sizes(detect_id),
+                functools.partial(products.stream, detect_id))
+            incr('product_bytes_read', size)
+            return
+
+    async with get_budget().reserve(2 * size):
+        with timer('product_read'):
+            data = await products.read(detect_id)
+        incr('product_bytes_read', sum(len(i) for i in data))
+        await backend.detection_product_insert(detection_id, *data)
+
+
+async def read_process_output(proc):
+    """Read the stdout and stderr of a process, reserving every chunk from the
+    memory budget so a full budget stalls the process instead of growing.
+
+    Returns stdout, stderr and the number of bytes reserved.
+
+    """
+    budget = get_budget()
+    owner = asyncio.current_task()
+
+    async def _read(stream):
+        chunks = []
+        reserved = 0
+        while True:
+            chunk = await stream.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            reserved += await budget.acquire(len(chunk), owner)
+            chunks.append(chunk)
+        return b''.join(chunks), reserved
+
+    (stdout, out_bytes), (stderr, err_bytes) = await asyncio.gather(
+        _read(proc.stdout), _read(proc.stderr))
+    await proc.wait()
+    return stdout, stderr, out_bytes + err_bytes
 
-    content = await _get_file_bytes(vo_table, mode='r')
-    cat = xmltodict.parse(content)
 
-    run_date = None
-    for _, j in enumerate(cat['VOTABLE']['RESOURCE']['PARAM']):
-        if j['@name'] == 'Time':
-            run_date = j['@value']
-            break
+async def match_merge_detections(backend, vo_datalink_url: str,
+                                 run: Run, instance: Instance, cwd: str,
+                                 perform_merge: int,
+                                 quality_flags: list,
+                                 config=None, output_bytes: int = 0):
+    """The storage backend remains open for the duration of this process of
+    merging and matching detections.
+
+    Products are only read (or generated, see open_products) for the
+    detections that are written to the database. The parsed catalog and the
+    products being inserted are reserved from the memory budget, as are the
+    output_bytes of SoFiA stdout/stderr once the run lock is held (see
+    locked_run).
+
+    """
+    input_fits, output_dir, output_filename = sofia_output_paths(instance.params, cwd)
+
+    catalog = catalog_path(instance.params, output_dir, output_filename)
+    catalog_bytes = catalog_size(catalog)
 
-    if run_date is None:
-        raise AttributeError('Run date not found in votable')
+    async with get_budget().reserve(catalog_bytes):
+        with timer('catalog_parse'):
+            run_date, version, detections = await read_catalog(
+                catalog, quality_flags, instance.boundary)
 
-    for _, j in enumerate(cat['VOTABLE']['RESOURCE']['PARAM']):
-        if j['@name'] == 'Creator':
-            instance.version = j['@value']
-            break
+    if version is not None:
+        instance.version = version
 
-    instance.run_date = datetime.strptime(run_date, '%a, %d %b %Y, %H:%M:%S')
-    instance.reliability_plot = await _get_file_bytes(
+    instance.run_date = run_date
+    instance.reliability_plot = await get_file_bytes(
         f"{output_dir}/{output_filename}_rel.eps")
 
-    # Lock the entire run for an instance to run exclusively
-    async with conn.transaction():
-        await db_lock_run(conn, schema, run)
-
-        instance = await db_instance_upsert(conn, schema, instance)
-
-        detect_names = []
-        fields = cat['VOTABLE']['RESOURCE']['TABLE']['FIELD']
-        for _, j in enumerate(fields):
-            detect_names.append(j['@name'])
-
-        tr = cat['VOTABLE']['RESOURCE']['TABLE']['DATA']['TABLEDATA']['TR']
-        if not isinstance(tr, list):
-            tr = [tr]
-
-        for _, j in enumerate(tr):
-            detect_dict = {}
-            for i, item in enumerate(j['TD']):
-                try:
-                    # NOTE: handle cases where field contains "nan"
-                    if "nan" in item:
-                        detect_dict[detect_names[i]] = None
-                    else:
-                        detect_dict[detect_names[i]] = float(item)
-                except ValueError:
-                    detect_dict[detect_names[i]] = item
-
-            # only allow selected flagged detections (default 0 or 4), throw the others away
-            flag = detect_dict['flag']
-            if flag not in quality_flags:
-                continue
+    products = await open_products(config, input_fits, output_dir, output_filename,
+                                   instance.boundary, detections)
+    try:
+        log = DetectionLog(instance.filename, float(
+            (config or {}).get('log_summary_interval', SUMMARY_INTERVAL)))
+        await _match_merge_instance(backend, vo_datalink_url, run, instance,
+                                    detections, products, perform_merge,
+                                    read_column(config or {}, 'unresolved_group_column'),
+                                    log, catalog_bytes + output_bytes)
+    finally:
+        products.close()
+
+
+@asynccontextmanager
+async def locked_run(backend, run: Run, nbytes: int = 0):
+    """Transaction holding the run lock, then a memory budget reservation of
+    nbytes for the data merged under it.
+
+    The reservation is only taken once the lock is held: the instance
+    holding the lock may be waiting on the budget for its inserts, and the
+    budget only lets a reservation through when every holder is waiting on
+    the budget itself.
+
+    """
+    async with backend.transaction():
+        await backend.lock_run(run)
+        async with get_budget().reserve(nbytes):
+            yield
+
+
+async def _match_merge_instance(backend, vo_datalink_url: str,
+                                run: Run, instance: Instance,
+                                detections: list, products,
+                                perform_merge: int, group_column: str = None,
+                                log: DetectionLog = None, reserve_bytes: int = 0):
+    if log is None:
+        log = DetectionLog(instance.filename)
 
-            # remove id from detection list
-            detect_id = int(detect_dict['id'])
-            del detect_dict['id']
+    # Lock the entire run for an instance to run exclusively
+    async with locked_run(backend, run, reserve_bytes):
 
-            # adjust x, y, z to absolute terms based on region applied
-            detect_dict['x'] = detect_dict['x'] + instance.boundary[0]
-            detect_dict['y'] = detect_dict['y'] + instance.boundary[2]
-            detect_dict['z'] = detect_dict['z'] + instance.boundary[4]
+        instance = await backend.instance_upsert(instance)
 
-            base = f"{output_dir}/{output_filename}_cubelets/{output_filename}_{detect_id}"  # noqa
+        # stored detections to set unresolved, written once the instance is merged
+        graph = ConflictGraph()
+        flagged = set()
+        unresolved = set()
+        inherited = {}
 
-            cube_bytes = await _get_file_bytes(f"{base}_cube.fits")
-            mask_bytes = await _get_file_bytes(f"{base}_mask.fits")
-            mom0_bytes = await _get_file_bytes(f"{base}_mom0.fits")
-            mom1_bytes = await _get_file_bytes(f"{base}_mom1.fits")
-            mom2_bytes = await _get_file_bytes(f"{base}_mom2.fits")
-            # NOTE: cubelet _chan.fits files renames _snr.fits in SoFiA-2 v2.3
-            chan_bytes = await _get_file_bytes(f"{base}_snr.fits")
-            spec_bytes = await _get_file_bytes(f"{base}_spec.txt")
-            pv_bytes = await _get_file_bytes(f"{base}_pv.fits")
+        if perform_merge == 0:
+            products.prefetch([detect_id for detect_id, _ in detections])
+        else:
+            bounds = await backend.match_bounds(run.run_id)
 
+        for detect_id, detect_dict in detections:
             # Do not merge the sources into the run, just do a direct import
             if perform_merge == 0:
-                logging.info(f"Not performing merge, doing direct import. Name: {detect_dict['name']}")
+                log.record('direct', "Not performing merge, doing direct import. Name: %s",
+                           detect_dict['name'])
 
-                await db_detection_insert(
-                        conn, schema, vo_datalink_url, run.run_id, instance.instance_id,
-                        detect_dict, cube_bytes, mask_bytes, mom0_bytes, mom1_bytes,
-                        mom2_bytes, chan_bytes, spec_bytes, pv_bytes, False)
+                await insert_detection(
+                        backend, vo_datalink_url, run.run_id, instance.instance_id,
+                        detect_dict, products, detect_id, False)
                 # move onto the next source
                 continue
 
-            result = await db_source_match(
-                conn, schema, run.run_id, detect_dict,
-                run.sanity_thresholds['uncertainty_sigma'])
+            result = await backend.source_match(
+                run.run_id, detect_dict,
+                run.sanity_thresholds['uncertainty_sigma'], bounds)
+
+            # widen the match box for the detections of this instance, whether or not kept
+            bounds.update(detect_dict)
 
             result_len = len(result)
             if result_len == 0:
-                logging.info(f"No duplicates, Name: {detect_dict['name']}")
-                await db_detection_insert(
-                    conn, schema, vo_datalink_url, run.run_id, instance.instance_id,
-                    detect_dict, cube_bytes, mask_bytes, mom0_bytes, mom1_bytes,
-                    mom2_bytes, chan_bytes, spec_bytes, pv_bytes)
+                log.record('new', "No duplicates, Name: %s", detect_dict['name'])
+                await insert_detection(
+                    backend, vo_datalink_url, run.run_id, instance.instance_id,
+                    detect_dict, products, detect_id)
             else:
-                logging.info(
-                    f"Duplicates, Name: {detect_dict['name']} Details: {result_len} hit(s)")
+                detail.info("Duplicates, Name: %s Details: %s hit(s)", detect_dict['name'], result_len)
 
                 resolved = False
                 for db_detect in result:
@@ -280,142 +388,199 @@ async def match_merge_detections(conn, schema: str, vo_datalink_url: str,
                         flux, spatial, spectral, run.sanity_thresholds)
 
                     if check_result:
+                        db_unresolved = db_detect['unresolved'] or db_detect['id'] in flagged
+                        if db_detect['unresolved'] and group_column:
+                            # keep the stored group of a detection that may be replaced
+                            inherited.update(await backend.detection_groups(
+                                group_column, [db_detect['id']]))
                         detect_flag = detect_dict['flag']
                         db_detect_flag = db_detect['flag']
                         if detect_flag == 0 and db_detect_flag == 4:
-                            logging.info(
-                                f"Replacing, Name: {detect_dict['name']} Details: flag 4 with flag 0")
+                            log.record('replaced', "Replacing, Name: %s Details: flag 4 with flag 0",
+                                       detect_dict['name'])
 
-                            await db_delete_detection(conn, schema, db_detect['id'])
-                            await db_detection_insert(
-                                conn, schema, vo_datalink_url, run.run_id, instance.instance_id,
-                                detect_dict, cube_bytes, mask_bytes,
-                                mom0_bytes, mom1_bytes, mom2_bytes,
-                                chan_bytes, spec_bytes, pv_bytes, db_detect['unresolved'])
+                            await backend.delete_detection(db_detect['id'])
+                            new_id = await insert_detection(
+                                backend, vo_datalink_url, run.run_id, instance.instance_id,
+                                detect_dict, products, detect_id, db_unresolved)
+                            _replaced(graph, flagged, unresolved, inherited, db_detect['id'], new_id)
 
                         elif detect_flag == 0 and db_detect_flag == 0 or detect_flag == 4 and db_detect_flag == 4:  # noqa
                             if bool(random.getrandbits(1)) is True:
-                                logging.info(
-                                    f"Replacing, Name: {detect_dict['name']} Details: flag 0 with flag 0 or flag 4 with flag 4")
-
-                                await db_delete_detection(
-                                    conn, schema, db_detect['id'])
-
-                                await db_detection_insert(
-                                    conn, schema, vo_datalink_url, run.run_id, instance.instance_id,
-                                    detect_dict, cube_bytes, mask_bytes,
-                                    mom0_bytes, mom1_bytes, mom2_bytes,
-                                    chan_bytes, spec_bytes, pv_bytes,
-                                    db_detect['unresolved'])
+                                log.record(
+                                    'replaced',
+                                    "Replacing, Name: %s Details: flag 0 with flag 0 or flag 4 with flag 4",
+                                    detect_dict['name'])
+
+                                await backend.delete_detection(db_detect['id'])
+
+                                new_id = await insert_detection(
+                                    backend, vo_datalink_url, run.run_id, instance.instance_id,
+                                    detect_dict, products, detect_id, db_unresolved)
+                                _replaced(graph, flagged, unresolved, inherited, db_detect['id'], new_id)
+                            else:
+                                log.record('kept', "Keeping stored, Name: %s", detect_dict['name'])
+                        else:
+                            log.record('kept', "Keeping stored, Name: %s Details: flag %s with flag %s",
+                                       detect_dict['name'], db_detect_flag, detect_flag)
 
                         resolved = True
                         break
 
                 if resolved is False:
-                    logging.info(f"Not Resolved, Name: {detect_dict['name']} Details: Setting to unresolved")
+                    log.record('unresolved', "Not Resolved, Name: %s Details: Setting to unresolved",
+                               detect_dict['name'])
 
-                    await db_detection_insert(
-                        conn, schema, vo_datalink_url, run.run_id, instance.instance_id, detect_dict,
-                        cube_bytes, mask_bytes, mom0_bytes, mom1_bytes,
-                        mom2_bytes, chan_bytes, spec_bytes, pv_bytes, True)
+                    new_id = await insert_detection(
+                        backend, vo_datalink_url, run.run_id, instance.instance_id, detect_dict,
+                        products, detect_id, True)
 
-                    await db_update_detection_unresolved(
-                        conn,
-                        schema,
-                        True,
-                        [i['id'] for i in result])
+                    unresolved.add(new_id)
+                    for i in result:
+                        graph.union(i['id'], new_id)
+                        flagged.add(i['id'])
 
+        if group_column:
+            await backend.update_unresolved_groups(
+                group_column, run.run_id,
+                graph.components(flagged | unresolved | set(inherited)), inherited)
+        elif flagged:
+            await backend.update_detection_unresolved(True, sorted(flagged))
 
-async def run_merge(config, run_name, param_list, sanity, quality_flags):
-    schema = config.get('db_schema', 'wallaby')
-    host = config['db_hostname']
-    name = config['db_name']
-    username = config['db_username']
-    password = config['db_password']
-    port = config['db_port']
+    log.summary(final=True)
 
-    execute = int(config['sofia_execute'])
-    path = config['sofia_path']
-    vo_datalink_url = f'https://{schema}.aussrc.org/survey/vo/dl/dlmeta?ID='
 
-    while len(param_list) > 0:
-        param_path = param_list.pop(0)
+def _replaced(graph: ConflictGraph, flagged: set, unresolved: set, inherited: dict,
+              old_id: int, new_id: int):
+    # the new detection takes the place of the one it replaced in its group
+    graph.union(old_id, new_id)
+    if old_id in flagged or old_id in unresolved or old_id in inherited:
+        unresolved.add(new_id)
+    flagged.discard(old_id)
 
-        logging.info(f'*** Processing {param_path} ***')
-        params = await parse_sofia_param_file(param_path)
-        param_cwd = os.path.dirname(os.path.abspath(param_path))
 
-        input_fits = params['input.data']
+async def check_detection_table(config):
+    """Check the detection table has every column SoFiAX writes before any
+    instance is processed.
 
-        region = params.get('input.region', None)
-        if not region:
-            header = await extract_fits_header(input_fits)
+    """
+    backend = await open_backend(config)
+    try:
+        await backend.check_detection_columns()
+    finally:
+        await backend.close()
 
-            x_max = int(header.get('NAXIS1'))
-            y_max = int(header.get('NAXIS2'))
 
-            freq_axis_1 = header.get('CTYPE3', None)
-            freq_axis_2 = header.get('CTYPE4', None)
+def run_settings(config):
+    """Run name, sanity thresholds and quality flags of a configuration.
 
-            if freq_axis_1:
-                freq_axis_1 = freq_axis_1.strip()
+    """
+    run_name = read_config(config, "run_name")
+    spatial = read_config(config, "spatial_extent")\
+        .replace(" ", "").split(",")
+    spectral = read_config(config, "spectral_extent")\
+        .replace(" ", "").split(",")
+    flux = int(read_config(config, "flux"))
+    uncertainty_sigma = config.get("uncertainty_sigma", 5)
+    quality_flags = list(map(int, config.get("quality_flags", "0,4")
+                             .replace(" ", "").split(",")))
+
+    sanity = {
+        "flux": flux,
+        "spatial_extent": tuple(map(int, spatial)),
+        "spectral_extent": tuple(map(int, spectral)),
+        "uncertainty_sigma": int(uncertainty_sigma)
+    }
+
+    Run.check_inputs(sanity)
+
+    # column names are written into SQL, checked before any instance runs
+    read_column(config, 'metrics_column')
+    read_column(config, 'unresolved_group_column')
+    return run_name, sanity, quality_flags
 
-            if freq_axis_2:
-                freq_axis_2 = freq_axis_2.strip()
 
-            if freq_axis_1 == 'FREQ':
-                freq_axis = 'NAXIS3'
+async def run_merge(config, run_name, param_list, sanity, quality_flags):
+    while len(param_list) > 0:
+        param_path = param_list.pop(0)
+        if await run_instance(config, run_name, param_path, sanity, quality_flags) is False:
+            return
 
-            if freq_axis_2 == 'FREQ':
-                freq_axis = 'NAXIS4'
 
-            z_max = int(header.get(freq_axis))
+async def run_instance(config, run_name, param_path, sanity, quality_flags):
+    """Run SoFiA (if applicable) for a parameter file and merge its
+    detections, recording the instance metrics.
 
-            boundary = [0, x_max-1, 0, y_max-1, 0, z_max-1]
-        else:
-            boundary = [int(i) for i in params['input.region'].split(',')]
+    Returns False when SoFiA found no sources.
+
+    """
+    metrics = start_metrics(run_name, param_path)
+    try:
+        return await _run_instance(config, run_name, param_path, sanity, quality_flags)
+    finally:
+        stop_metrics()
+        logging.info(f'Metrics: {dumps(metrics)}')
+        metrics_file = config.get('metrics_file', None)
+        if metrics_file:
+            write_prometheus(metrics_file, metrics)
+        write_profile(metrics)
+
+
+async def _run_instance(config, run_name, param_path, sanity, quality_flags):
+    schema = config.get('db_schema', 'wallaby')
+
+    execute = int(config['sofia_execute'])
+    path = config['sofia_path']
+    vo_datalink_url = f'https://{schema}.aussrc.org/survey/vo/dl/dlmeta?ID='
+
+    logging.info(f'*** Processing {param_path} ***')
+    params = await parse_sofia_param_file(param_path)
+    param_cwd = os.path.dirname(os.path.abspath(param_path))
+
+    input_fits = params['input.data']
+
+    boundary = await get_instance_boundary(params)
+
+    if os.path.isabs(input_fits) is False:
+        input_fits = f"{param_cwd}/{os.path.basename(input_fits)}"
 
-        if os.path.isabs(input_fits) is False:
-            input_fits = f"{param_cwd}/{os.path.basename(input_fits)}"
+    output_filename = params['output.filename']
+    if not output_filename:
+        output_filename = os.path.splitext(os.path.basename(input_fits))[0]
 
-        output_filename = params['output.filename']
-        if not output_filename:
-            output_filename = os.path.splitext(os.path.basename(input_fits))[0]
+    _, output_dir, _ = sofia_output_paths(params, param_cwd)
+    set_profile_path(f"{output_dir}/{output_filename}_profile")
 
-        run_date = datetime.now()
+    run_date = datetime.now()
 
-        # Write run and instance to database
-        conn = await asyncpg.connect(
-            user=username,
-            password=password,
-            database=name,
-            host=host,
-            port=port
-        )
+    # Write run and instance to database
+    backend = await open_backend(config)
 
-        try:
-            run = Run(run_name, sanity)
-            run = await db_run_upsert(conn, schema, run)
-            instance = Instance(
-                run.run_id, run_date, output_filename, boundary, None, None,
-                None, params, None, None, None, None)
+    try:
+        run = Run(run_name, sanity)
+        run = await backend.run_upsert(run)
+        instance = Instance(
+            run.run_id, run_date, output_filename, boundary, None, None,
+            None, params, None, None, None, None)
 
-            instance = await db_instance_upsert(conn, schema, instance)
-        finally:
-            await conn.close()
+        instance = await backend.instance_upsert(instance)
+    finally:
+        await backend.close()
 
-        # Execute sofia (if applicable)
-        if execute == 1:
-            logging.info(f'Executing SoFiA {param_path}')
+    # Execute sofia (if applicable)
+    output_reserved = 0
+    if execute == 1:
+        logging.info(f'Executing SoFiA {param_path}')
 
-            output_path = os.path.abspath(params['output.directory'])
-            await aiofiles.os.makedirs(output_path, exist_ok=True)
+        output_path = os.path.abspath(params['output.directory'])
+        await aiofiles.os.makedirs(output_path, exist_ok=True)
 
-            sofia_clean = int(config.get("sofia_clean", 0))
-            if sofia_clean == 1:
-                await remove_output(params, param_cwd)
+        sofia_clean = int(config.get("sofia_clean", 0))
+        if sofia_clean == 1:
+            await remove_output(params, param_cwd)
 
-            sofia_cmd = f'{path} {param_path}'
+        sofia_cmd = f'{path} {param_path}'
+        with timer('sofia'):
             proc = await asyncio.create_subprocess_shell(
                 sofia_cmd,
                 stdout=asyncio.subprocess.PIPE,
@@ -423,40 +588,45 @@ async def run_merge(config, run_name, param_list, sanity, quality_flags):
                 env={'SOFIA2_PATH': os.path.dirname(path)},
                 cwd=param_cwd)
 
-            stdout, stderr = await proc.communicate()
-            instance.stdout = stdout
-            instance.stderr = stderr
-            instance.return_code = proc.returncode
-
-        # Write detections to database
-        conn = await asyncpg.connect(
-            user=username,
-            password=password,
-            database=name,
-            host=host,
-            port=port
-        )
-
-        try:
-            if instance.return_code == 0 or instance.return_code is None:
-                perform_merge = int(config.get("perform_merge", 1))
-
-                logging.info(f'SoFiA already completed: {param_path}')
-                await match_merge_detections(conn, schema, vo_datalink_url,
-                                             run, instance, param_cwd,
-                                             perform_merge, quality_flags)
-            else:
-                code = instance.return_code
-                err = f'SoFiA completed with return code: {code}'
-                await db_instance_upsert(conn, schema, instance)
+            stdout, stderr, output_reserved = await read_process_output(proc)
+        instance.stdout = stdout
+        instance.stderr = stderr
+        instance.return_code = proc.returncode
+
+    # reserved again once the run lock is held (see locked_run), a task
+    # waiting on a pool connection must not hold budget
+    output_bytes = output_reserved
+    get_budget().release(output_reserved)
+
+    # Write detections to database
+    backend = await open_backend(config)
+
+    try:
+        if instance.return_code == 0 or instance.return_code is None:
+            perform_merge = int(config.get("perform_merge", 1))
+
+            logging.info(f'SoFiA already completed: {param_path}')
+            await match_merge_detections(backend, vo_datalink_url,
+                                         run, instance, param_cwd,
+                                         perform_merge, quality_flags,
+                                         config, output_bytes)
+
+            metrics_column = read_column(config, 'metrics_column')
+            if metrics_column:
+                await backend.instance_metrics(metrics_column, instance,
+                                               current_metrics().summary())
+        else:
+            code = instance.return_code
+            err = f'SoFiA completed with return code: {code}'
+            await backend.instance_upsert(instance)
 
-                logging.error(err)
-                logging.error(instance.stderr)
+            logging.error(err)
+            logging.error(instance.stderr)
 
-                # no source(s) found, gracefully exit
-                if instance.return_code == 8:
-                    return
+            # no source(s) found, gracefully exit
+            if instance.return_code == 8:
+                return False
 
-                raise SystemError(err)
-        finally:
-            await conn.close()
+            raise SystemError(err)
+    finally:
+        await backend.close()
@@ -0,0 +1,209 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import json
+import time
+import functools
+import collections
+import contextvars
+
+from contextlib import contextmanager
+
+
+_current = contextvars.ContextVar('sofiax_metrics', default=None)
+# instances collecting metrics, an instance is removed once stopped
+_registry = []
+_stage_observers = []
+_stop_observers = []
+
+
+class InstanceMetrics(object):
+    """Stage timers and counters of one instance.
+
+    """
+    def __init__(self, run_name: str, instance: str):
+        self.run_name = run_name
+        self.instance = instance
+        self.start = time.time()
+        self.end = None
+        self.timers = collections.Counter()
+        self.calls = collections.Counter()
+        self.counters = collections.Counter()
+
+    @contextmanager
+    def timer(self, stage: str):
+        for observer in _stage_observers:
+            observer(self, stage, True)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage] += time.perf_counter() - start
+            self.calls[stage] += 1
+            for observer in _stage_observers:
+                observer(self, stage, False)
+
+    def incr(self, counter: str, value: int = 1):
+        self.counters[counter] += value
+
+    def summary(self):
+        end = self.end or time.time()
+        wall = end - self.start
+        summary = {
+            'run': self.run_name,
+            'instance': self.instance,
+            'wall_seconds': round(wall, 6),
+            'stages': {
+                k: {'seconds': round(v, 6), 'calls': self.calls[k]}
+                for k, v in sorted(self.timers.items())
+            },
+            'counters': dict(sorted(self.counters.items()))
+        }
+        if wall > 0:
+            summary['throughput'] = {
+                f'{k}_per_second': round(v / wall, 3)
+                for k, v in sorted(self.counters.items())
+            }
+        return summary
+
+    def samples(self):
+        """(metric name, labels, value) samples of the instance.
+
+        """
+        labels = f'run="{_escape(self.run_name)}",instance="{_escape(self.instance)}"'
+        yield 'sofiax_instance_wall_seconds', labels, (self.end or time.time()) - self.start
+        for stage, seconds in sorted(self.timers.items()):
+            yield 'sofiax_stage_seconds_total', f'{labels},stage="{stage}"', seconds
+            yield 'sofiax_stage_calls_total', f'{labels},stage="{stage}"', self.calls[stage]
+        for counter, value in sorted(self.counters.items()):
+            yield f'sofiax_{counter}_total', labels, value
+
+
+def _escape(value: str):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_metrics(run_name: str, instance: str):
+    """Start collecting metrics for an instance in the current context.
+
+    """
+    metrics = InstanceMetrics(run_name, instance)
+    _registry.append(metrics)
+    _current.set(metrics)
+    return metrics
+
+
+def stop_metrics():
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.end = time.time()
+        _current.set(None)
+        _registry.remove(metrics)
+        for observer in _stop_observers:
+            observer(metrics)
+    return metrics
+
+
+def current_metrics():
+    return _current.get()
+
+
+def add_stage_observer(observer):
+    """Call observer(metrics, stage, entering) as every stage timer of an
+    instance starts and stops, from the task running the stage.
+
+    """
+    _stage_observers.append(observer)
+
+
+def remove_stage_observer(observer):
+    _stage_observers.remove(observer)
+
+
+def add_stop_observer(observer):
+    """Call observer(metrics) as every instance stops collecting metrics.
+
+    """
+    _stop_observers.append(observer)
+
+
+def all_metrics():
+    """Metrics of the instances running in the process.
+
+    """
+    return list(_registry)
+
+
+@contextmanager
+def timer(stage: str):
+    """Time a stage of the current instance, if metrics are being collected.
+
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    with metrics.timer(stage):
+        yield
+
+
+def timed(stage: str):
+    """Decorator timing every call of a coroutine function as a stage.
+
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def incr(counter: str, value: int = 1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.incr(counter, value)
+
+
+def write_prometheus(path: str, *finished: InstanceMetrics):
+    """Dump the metrics of the instances running in the process, and of the
+    finished instances given, in the Prometheus text exposition format.
+
+    """
+    families = collections.defaultdict(list)
+    for metrics in list(finished) + [m for m in _registry if m not in finished]:
+        for name, labels, value in metrics.samples():
+            families[name].append(f'{name}{{{labels}}} {value}')
+
+    lines = []
+    for name, samples in sorted(families.items()):
+        kind = 'counter' if name.endswith('_total') else 'gauge'
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(samples)
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+def dumps(metrics: InstanceMetrics):
+    return json.dumps(metrics.summary())
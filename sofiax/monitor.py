@@ -0,0 +1,63 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import asyncio
+import logging
+
+
+class LoopMonitor(object):
+    """Report callbacks blocking the event loop for longer than threshold
+    seconds.
+
+    asyncio debug mode logs the offending callback, and a heartbeat task
+    measures how late the loop wakes it up so stalls are counted even when
+    the blocking code runs outside of a single callback.
+
+    """
+    def __init__(self, threshold: float, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold
+        # debug mode is otherwise very chatty at the DEBUG level
+        logging.getLogger('asyncio').setLevel(logging.WARNING)
+        self._task = asyncio.ensure_future(self._heartbeat())
+
+    async def _heartbeat(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - start - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.stalls += 1
+                logging.warning(f'Event loop blocked for {lag:.3f}s')
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        logging.info(f'Event loop stalls: {self.stalls}, max lag: {self.max_lag:.3f}s')
@@ -0,0 +1,418 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import math
+import random
+import logging
+
+from datetime import datetime
+
+from sofiax.db import source_match, Run, Instance
+from sofiax.backend import open_backend
+from sofiax.merge import parse_sofia_param_file, sofia_output_paths, \
+    get_instance_boundary, sanity_check, insert_products, catalog_size, locked_run
+from sofiax.catalog import read_catalog, catalog_path
+from sofiax.columns import Detection
+from sofiax.conflict import ConflictGraph
+from sofiax.products import open_products
+from sofiax.utils import get_file_bytes, read_column
+from sofiax.memory import get_budget
+from sofiax.profile import set_profile_path, write_profile
+from sofiax.metrics import start_metrics, stop_metrics, timer, dumps, write_prometheus
+
+
+DEFAULT_CELL_SIZE = 32.0
+
+
+class MergeEntry(object):
+    """A detection held by the merge engine. Entries loaded from the database
+    carry their detection id, new entries carry the instance they came from.
+
+    """
+    __slots__ = ('key', 'detection', 'instance', 'detect_id', 'db_id',
+                 'unresolved', 'initial_unresolved', 'cell')
+
+    def __init__(self, key, detection, instance=None, detect_id=None,
+                 db_id=None, unresolved=False):
+        self.key = key
+        self.detection = detection
+        self.instance = instance
+        self.detect_id = detect_id
+        self.db_id = db_id
+        self.unresolved = unresolved
+        self.initial_unresolved = unresolved
+        self.cell = None
+
+    def __getitem__(self, key):
+        return self.detection[key]
+
+
+class MergeEngine(object):
+    """Match and merge detections of many instances in memory.
+
+    Applies the same uncertainty_sigma match, sanity_check and flag rules as
+    match_merge_detections, in the same order, against a grid index in x, y
+    instead of querying the database for each detection.
+
+    """
+    def __init__(self, sanity_thresholds: dict, cell_size: float = DEFAULT_CELL_SIZE):
+        Run.check_inputs(sanity_thresholds)
+        self.sanity_thresholds = sanity_thresholds
+        self.uncertainty_sigma = sanity_thresholds['uncertainty_sigma']
+        self.cell_size = float(cell_size)
+        self.deleted = []
+        self._entries = {}
+        self._grid = {}
+        self._graph = ConflictGraph()
+        self._next_key = 1
+        self._max_err_xy = 0.0
+
+    def _cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)),
+                int(math.floor(y / self.cell_size)))
+
+    def _add(self, entry: MergeEntry):
+        self._entries[entry.key] = entry
+        self._graph.add(entry.key)
+        self._next_key = max(self._next_key, entry.key + 1)
+
+        d = entry.detection
+        if any(d[k] is None for k in ('x', 'y', 'z', 'err_x', 'err_y', 'err_z')):
+            # can never match, keep it out of the index
+            return
+
+        self._max_err_xy = max(self._max_err_xy, abs(d['err_x']), abs(d['err_y']))
+        entry.cell = self._cell(d['x'], d['y'])
+        self._grid.setdefault(entry.cell, {})[entry.key] = entry
+
+    def _remove(self, entry: MergeEntry):
+        del self._entries[entry.key]
+        if entry.cell is not None:
+            del self._grid[entry.cell][entry.key]
+        if entry.db_id is not None:
+            self.deleted.append(entry.db_id)
+
+    def add_existing(self, record):
+        """Add a detection already stored for the run (see db_run_detections).
+
+        """
+        entry = MergeEntry(record['id'], Detection.from_mapping(record), db_id=record['id'],
+                           unresolved=bool(record['unresolved']))
+        self._add(entry)
+        return entry
+
+    def match(self, detection: Detection):
+        """Entries matching the detection, ordered as db_source_match orders
+        them, excluding the first entry at exactly the same position.
+
+        """
+        try:
+            err_xy = max(abs(detection['err_x']), abs(detection['err_y']))
+            radius = self.uncertainty_sigma * math.sqrt(err_xy ** 2 + self._max_err_xy ** 2)
+            x, y = detection['x'], detection['y']
+            x_min, y_min = self._cell(x - radius, y - radius)
+            x_max, y_max = self._cell(x + radius, y + radius)
+        except TypeError:
+            return []
+
+        if (x_max - x_min + 1) * (y_max - y_min + 1) > len(self._grid):
+            cells = list(self._grid.values())
+        else:
+            cells = [self._grid[(i, j)]
+                     for i in range(x_min, x_max + 1)
+                     for j in range(y_min, y_max + 1)
+                     if (i, j) in self._grid]
+
+        result = [e for c in cells for e in c.values()
+                  if source_match(detection, e.detection, self.uncertainty_sigma)]
+        result.sort(key=lambda e: e.key)
+
+        for i, e in enumerate(result):
+            # do not want the original detection if it already exists
+            if e['x'] == detection['x'] and e['y'] == detection['y'] and e['z'] == detection['z']:
+                result.pop(i)
+                break
+        return result
+
+    def _insert(self, detection, instance, detect_id, unresolved=False):
+        entry = MergeEntry(self._next_key, detection, instance=instance,
+                           detect_id=detect_id, unresolved=unresolved)
+        self._add(entry)
+        return entry
+
+    def merge(self, detection: Detection, instance=None, detect_id=None):
+        """Merge a new detection into the set, returns the list of matches.
+
+        """
+        result = self.match(detection)
+        if len(result) == 0:
+            self._insert(detection, instance, detect_id)
+            return result
+
+        for entry in result:
+            flux = (detection['f_sum'], entry['f_sum'])
+            spatial = (detection['ell_maj'], entry['ell_maj'],
+                       detection['ell_min'], entry['ell_min'])
+            spectral = (detection['w20'], entry['w20'],
+                        detection['w50'], entry['w50'])
+
+            if sanity_check(flux, spatial, spectral, self.sanity_thresholds):
+                detect_flag = detection['flag']
+                entry_flag = entry['flag']
+                replace = False
+                if detect_flag == 0 and entry_flag == 4:
+                    replace = True
+                elif detect_flag == 0 and entry_flag == 0 or detect_flag == 4 and entry_flag == 4:  # noqa
+                    replace = bool(random.getrandbits(1))
+
+                if replace:
+                    self._remove(entry)
+                    new = self._insert(detection, instance, detect_id, entry.unresolved)
+                    self._graph.union(entry.key, new.key)
+                return result
+
+        new = self._insert(detection, instance, detect_id, True)
+        for entry in result:
+            entry.unresolved = True
+            self._graph.union(entry.key, new.key)
+        return result
+
+    def direct(self, detection: Detection, instance=None, detect_id=None):
+        """Accept a detection without matching (perform_merge = 0).
+
+        """
+        return self._insert(detection, instance, detect_id)
+
+    @property
+    def inserted(self):
+        """New entries that survived the merge, in insertion order.
+
+        """
+        return [e for _, e in sorted(self._entries.items()) if e.db_id is None]
+
+    @property
+    def flagged(self):
+        """Database ids of stored detections that became unresolved.
+
+        """
+        return [e.db_id for _, e in sorted(self._entries.items())
+                if e.db_id is not None and e.unresolved and not e.initial_unresolved]
+
+    @property
+    def unresolved_groups(self):
+        """Unresolved entries grouped by the matches that linked them.
+
+        """
+        return [[self._entries[key] for key in group] for group in self.conflict_groups()]
+
+    def conflict_groups(self, removed=()):
+        """Keys of the unresolved entries, and of the removed entries given,
+        grouped by the matches that linked them.
+
+        """
+        keys = [key for key, entry in self._entries.items() if entry.unresolved]
+        return self._graph.components(keys + list(removed))
+
+
+class OfflineInstance(object):
+    def __init__(self, param_path, params, instance, input_fits, output_dir,
+                 output_filename):
+        self.param_path = param_path
+        self.params = params
+        self.instance = instance
+        self.input_fits = input_fits
+        self.output_dir = output_dir
+        self.output_filename = output_filename
+        self.detections = []
+        self.products = None
+        self.reserved = 0
+
+
+async def read_offline_instance(param_path: str, run_id: int, quality_flags: list):
+    """Read the parameters, catalog and reliability plot of an instance whose
+    SoFiA output already exists on disk. The parsed catalog is reserved from
+    the memory budget until released by the caller.
+
+    """
+    params = await parse_sofia_param_file(param_path)
+    param_cwd = os.path.dirname(os.path.abspath(param_path))
+    boundary = await get_instance_boundary(params)
+    input_fits, output_dir, output_filename = sofia_output_paths(params, param_cwd)
+
+    instance = Instance(
+        run_id, datetime.now(), output_filename, boundary, None, None,
+        None, params, None, None, None, None)
+
+    offline = OfflineInstance(param_path, params, instance, input_fits,
+                              output_dir, output_filename)
+
+    catalog = catalog_path(params, output_dir, output_filename)
+    offline.reserved = await get_budget().acquire(catalog_size(catalog))
+    try:
+        with timer('catalog_parse'):
+            run_date, version, offline.detections = await read_catalog(
+                catalog, quality_flags, boundary)
+    except Exception:
+        get_budget().release(offline.reserved)
+        raise
+    instance.run_date = run_date
+    instance.version = version
+    instance.reliability_plot = await get_file_bytes(
+        f"{output_dir}/{output_filename}_rel.eps")
+    return offline
+
+
+async def write_merge_result(backend, vo_datalink_url: str,
+                             run: Run, instances: list, engine: MergeEngine,
+                             group_column: str = None):
+    """Write the outcome of an offline merge in a single transaction, the
+    surviving detections in one bulk load (see detection_rows_insert).
+
+    Returns the unresolved groups of the run touched by the merge as lists
+    of detection ids.
+
+    """
+    for offline in instances:
+        await backend.instance_upsert(offline.instance)
+
+    inherited = {}
+    if group_column and engine.deleted:
+        # keep the stored group of the detections being replaced
+        groups = await backend.detection_groups(group_column, engine.deleted)
+        inherited = {k: v for k, v in groups.items() if v is not None}
+
+    if engine.deleted:
+        await backend.delete_detections(engine.deleted)
+
+    if engine.flagged and not group_column:
+        await backend.update_detection_unresolved(True, engine.flagged)
+
+    inserted = engine.inserted
+    for entry in inserted:
+        entry.instance.products.prefetch([entry.detect_id])
+
+    # the surviving detections are loaded in bulk, then their products
+    detection_ids = await backend.detection_rows_insert(
+        vo_datalink_url, run.run_id,
+        [(entry.instance.instance.instance_id, entry.detection, entry.unresolved)
+         for entry in inserted])
+    ids = {entry.key: detection_id for entry, detection_id in zip(inserted, detection_ids)}
+    for entry, detection_id in zip(inserted, detection_ids):
+        await insert_products(backend, detection_id, entry.instance.products, entry.detect_id)
+
+    # stored and removed entries are keyed by their detection id
+    groups = [[ids.get(key, key) for key in group]
+              for group in engine.conflict_groups(inherited)]
+    if group_column:
+        changed = set(ids.values()) | set(engine.flagged) | set(inherited)
+        await backend.update_unresolved_groups(
+            group_column, run.run_id, [g for g in groups if changed.intersection(g)], inherited)
+
+    # removed entries are gone from the run
+    return [[i for i in group if i not in inherited] for group in groups]
+
+
+async def run_offline_merge(config, run_name, param_list, sanity, quality_flags):
+    """Merge the existing SoFiA output of all parameter files in memory and
+    write the result to the database in one transaction.
+
+    """
+    if int(config['sofia_execute']) != 0:
+        raise ValueError('merge_offline requires sofia_execute=0')
+
+    schema = config.get('db_schema', 'wallaby')
+    perform_merge = int(config.get('perform_merge', 1))
+    cell_size = float(config.get('merge_cell_size', DEFAULT_CELL_SIZE))
+    vo_datalink_url = f'https://{schema}.aussrc.org/survey/vo/dl/dlmeta?ID='
+
+    run = Run(run_name, sanity)
+    instances = []
+    metrics = start_metrics(run_name, 'offline')
+    try:
+        for param_path in param_list:
+            logging.info(f'*** Reading {param_path} ***')
+            offline = await read_offline_instance(param_path, None, quality_flags)
+            if not instances:
+                set_profile_path(f"{offline.output_dir}/{offline.output_filename}_offline_profile")
+            instances.append(offline)
+            offline.products = await open_products(
+                config, offline.input_fits, offline.output_dir, offline.output_filename,
+                offline.instance.boundary, offline.detections)
+
+        await _offline_merge(config, vo_datalink_url, run, instances,
+                             perform_merge, cell_size)
+    finally:
+        for offline in instances:
+            if offline.products is not None:
+                offline.products.close()
+            get_budget().release(offline.reserved)
+
+        stop_metrics()
+        logging.info(f'Metrics: {dumps(metrics)}')
+        metrics_file = config.get('metrics_file', None)
+        if metrics_file:
+            write_prometheus(metrics_file, metrics)
+        write_profile(metrics)
+
+
+async def _offline_merge(config, vo_datalink_url: str, run: Run,
+                         instances: list, perform_merge: int, cell_size: float):
+    backend = await open_backend(config)
+
+    try:
+        run = await backend.run_upsert(run)
+        for offline in instances:
+            offline.instance.run_id = run.run_id
+
+        # the parsed catalogs are reserved again once the run lock is held
+        reserved = 0
+        for offline in instances:
+            get_budget().release(offline.reserved)
+            reserved += offline.reserved
+            offline.reserved = 0
+
+        async with locked_run(backend, run, reserved):
+
+            engine = MergeEngine(run.sanity_thresholds, cell_size)
+            if perform_merge == 1:
+                for record in await backend.run_detections(run.run_id):
+                    engine.add_existing(record)
+
+            with timer('merge'):
+                for offline in instances:
+                    for detect_id, detect_dict in offline.detections:
+                        if perform_merge == 0:
+                            engine.direct(detect_dict, offline, detect_id)
+                        else:
+                            engine.merge(detect_dict, offline, detect_id)
+
+            logging.info(
+                f"Offline merge: {len(engine.inserted)} to insert, "
+                f"{len(engine.deleted)} replaced, {len(engine.flagged)} stored set to unresolved")
+
+            groups = await write_merge_result(backend, vo_datalink_url, run, instances, engine,
+                                              read_column(config, 'unresolved_group_column'))
+
+        groups = [g for g in groups if len(g) > 1]
+        logging.info(f'Offline merge: {len(groups)} unresolved group(s)')
+        for group in groups:
+            logging.info(f'Unresolved group: detection ids {", ".join(str(i) for i in sorted(group))}')
+    finally:
+        await backend.close()
@@ -0,0 +1,281 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import io
+import os
+import collections
+import itertools
+import asyncio
+import logging
+import multiprocessing.util
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from sofiax.bundle import open_cubelets
+from sofiax.memory import get_budget, parse_size
+
+
+# default product size of a detection from which it is streamed to the database
+STREAM_THRESHOLD = '64M'
+
+# header keywords carried over from the parent cube to the products
+COPY_KEYWORDS = ('BUNIT', 'BMAJ', 'BMIN', 'BPA', 'RESTFREQ', 'RESTFRQ',
+                 'SPECSYS', 'EQUINOX', 'RADESYS')
+
+# memory mapped files a worker keeps open, the cube and mask of two instances
+MAX_OPEN_FILES = 4
+
+_OpenCube = collections.namedtuple('_OpenCube', ('hdul', 'header', 'data', 'wcs'))
+
+_executor = None
+_open_files = collections.OrderedDict()
+
+
+def get_product_executor(processes: int = None):
+    """Process pool shared by every instance generating products.
+
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=processes, initializer=_init_worker)
+    return _executor
+
+
+def _init_worker():
+    # close the files a worker keeps open when it exits
+    multiprocessing.util.Finalize(None, close_files, exitpriority=10)
+
+
+def close_files():
+    """Close the files kept open by _open_cube.
+
+    """
+    while _open_files:
+        _, cube = _open_files.popitem()
+        cube.hdul.close()
+
+
+def _open_cube(path: str):
+    """The memory mapped cube of a FITS file with its header and WCS (see
+    _spectral_cube). Each worker keeps the last MAX_OPEN_FILES files open
+    between detections and closes the least recently used.
+
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    cube = _open_files.get(key)
+    if cube is not None:
+        _open_files.move_to_end(key)
+        return cube
+
+    hdul = fits.open(path, memmap=True, mode='readonly')
+    hdu = hdul[0]
+    data, wcs = _spectral_cube(hdu)
+    cube = _open_files[key] = _OpenCube(hdul, hdu.header, data, wcs)
+    while len(_open_files) > MAX_OPEN_FILES:
+        _, evicted = _open_files.popitem(last=False)
+        evicted.hdul.close()
+    return cube
+
+
+def _spectral_cube(hdu):
+    """The (z, y, x) data and WCS of a cube, dropping a degenerate Stokes
+    axis placed either before or after the spectral axis.
+
+    """
+    data = hdu.data
+    wcs = WCS(hdu.header)
+    if data.ndim == 4:
+        if hdu.header.get('CTYPE4', '').strip() == 'FREQ':
+            data = data[:, 0]
+            wcs = wcs.dropaxis(2)
+        else:
+            data = data[0]
+            wcs = wcs.dropaxis(3)
+    return data, wcs
+
+
+def _to_fits(data, wcs, header):
+    hdr = wcs.to_header()
+    for key in COPY_KEYWORDS:
+        if key in header:
+            hdr[key] = header[key]
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data=data, header=hdr).writeto(buffer)
+    return buffer.getvalue()
+
+
+def generate_products(input_fits: str, mask_fits: str, boundary: list,
+                      detect_id: int, bbox: tuple, rms: float = None):
+    """Cut out the cubelet of a detection from the parent cube and SoFiA mask
+    and compute its moment maps, signal to noise map and spectrum.
+
+    bbox is (x_min, x_max, y_min, y_max, z_min, z_max) of the catalog, i.e.
+    relative to the instance region. Returns cube, mask, mom0, mom1, mom2,
+    chan, spec and pv bytes; no pv diagram is generated. As the SoFiA _snr
+    cubelet stored in chan, chan is the moment 0 map over its noise, from
+    the rms of the catalog and the number of channels in the mask. It is
+    empty, like pv, when the catalog has no rms.
+
+    """
+    x0, x1, y0, y1, z0, z1 = (int(i) for i in bbox)
+    ox, oy, oz = boundary[0], boundary[2], boundary[4]
+
+    parent = _open_cube(input_fits)
+    data, wcs = parent.data, parent.wcs
+    cube = np.array(data[oz + z0:oz + z1 + 1, oy + y0:oy + y1 + 1, ox + x0:ox + x1 + 1],
+                    dtype=np.float32)
+    sub_wcs = wcs[oz + z0:oz + z1 + 1, oy + y0:oy + y1 + 1, ox + x0:ox + x1 + 1]
+
+    mask_data = _open_cube(mask_fits).data
+    mask = np.asarray(mask_data[z0:z1 + 1, y0:y1 + 1, x0:x1 + 1]) == detect_id
+
+    flux = np.where(mask, np.nan_to_num(cube), 0.0)
+    spectral = sub_wcs.sub([3])
+    chan_width = abs(spectral.pixel_scale_matrix[0, 0])
+    coord = spectral.pixel_to_world_values(np.arange(cube.shape[0]))
+
+    total = flux.sum(axis=0)
+    valid = total > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mom0 = total * chan_width
+        mom1 = np.where(valid, (coord[:, None, None] * flux).sum(axis=0) / total, np.nan)
+        mom2 = np.where(valid, np.sqrt(np.abs(
+            ((coord[:, None, None] - mom1) ** 2 * flux).sum(axis=0) / total)), np.nan)
+    n_chan = mask.sum(axis=0)
+    mom0[n_chan == 0] = np.nan
+
+    chan = b''
+    if rms:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr = np.where(n_chan > 0, total / (rms * np.sqrt(n_chan)), np.nan)
+        # dimensionless, the parent's BUNIT is not carried over
+        chan = _to_fits(snr.astype(np.float32), sub_wcs.celestial,
+                        {k: v for k, v in parent.header.items() if k != 'BUNIT'})
+
+    header = parent.header
+    celestial = sub_wcs.celestial
+    spec = io.StringIO()
+    spec.write("# Integrated source spectrum\n")
+    spec.write("# Creator: SoFiAX\n#\n")
+    spec.write(f"# {'Channel':>9s} {'Spectral':>18s} {'Flux':>18s} {'Pixels':>8s}\n")
+    spec.write(f"# {'-':>9s} {spectral.wcs.cunit[0].to_string() or '-':>18s} "
+               f"{header.get('BUNIT', '-'):>18s} {'-':>8s}\n#\n")
+    n_pix = mask.sum(axis=(1, 2))
+    for i, value in enumerate(flux.sum(axis=(1, 2))):
+        spec.write(f"  {oz + z0 + i:9d} {coord[i]:18.6e} {value:18.6e} {n_pix[i]:8d}\n")
+
+    return (
+        _to_fits(cube, sub_wcs, header),
+        _to_fits(mask.astype(np.int32) * detect_id, sub_wcs, header),
+        _to_fits(mom0.astype(np.float32), celestial, header),
+        _to_fits(mom1.astype(np.float32), celestial, header),
+        _to_fits(mom2.astype(np.float32), celestial, header),
+        chan,
+        spec.getvalue().encode(),
+        b''
+    )
+
+
+class ProductGenerator(object):
+    """Generate the products of a detection from the parent cube in a process
+    pool, only when it is read. Detections passed to prefetch are submitted
+    ahead of time, a window at a time, so the pool stays busy.
+
+    """
+    def __init__(self, input_fits: str, mask_fits: str, boundary: list,
+                 detections: list, executor, window: int):
+        self.input_fits = input_fits
+        self.mask_fits = mask_fits
+        self.boundary = boundary
+        self.executor = executor
+        self.window = window
+        # generated products are already in memory, there is nothing to stream
+        self.stream_threshold = None
+        self._bbox = {
+            detect_id: tuple(d[k] for k in ('x_min', 'x_max', 'y_min', 'y_max', 'z_min', 'z_max'))
+            for detect_id, d in detections
+        }
+        self._rms = {detect_id: d['rms'] for detect_id, d in detections}
+        self._queue = collections.deque()
+        self._done = set()
+        self._futures = {}
+
+    def _submit(self, detect_id: int):
+        if detect_id not in self._futures:
+            loop = asyncio.get_event_loop()
+            self._futures[detect_id] = loop.run_in_executor(
+                self.executor, generate_products, self.input_fits, self.mask_fits,
+                self.boundary, detect_id, self._bbox[detect_id], self._rms[detect_id])
+
+    def prefetch(self, detect_ids: list):
+        self._queue.extend(detect_ids)
+
+    async def size(self, detect_id: int):
+        # estimate: float32 cube and int32 mask, five 2D maps and headers
+        x0, x1, y0, y1, z0, z1 = self._bbox[detect_id]
+        pixels = (x1 - x0 + 1) * (y1 - y0 + 1)
+        return int(8 * pixels * (z1 - z0 + 1) + 20 * pixels + 8 * 5760)
+
+    async def read(self, detect_id: int):
+        self._done.add(detect_id)
+        while self._queue and self._queue[0] in self._done:
+            self._queue.popleft()
+
+        # only run ahead while the memory budget has room for the results
+        budget = get_budget()
+        ahead = 0
+        for i in itertools.islice(self._queue, self.window):
+            if i in self._done:
+                continue
+            ahead += await self.size(i)
+            if ahead > budget.available():
+                break
+            self._submit(i)
+        self._submit(detect_id)
+        return await self._futures.pop(detect_id)
+
+    def close(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+
+
+async def open_products(config, input_fits: str, output_dir: str,
+                        output_filename: str, boundary: list, detections: list):
+    """Product reader for an instance, see ProductGenerator and open_cubelets.
+
+    """
+    config = config or {}
+    if int(config.get('generate_products', 0)) == 1:
+        mask_fits = f"{output_dir}/{output_filename}_mask.fits"
+        if not os.path.isfile(mask_fits):
+            raise AttributeError(f'SoFiA output mask file {mask_fits} does not exist')
+
+        processes = int(config.get('product_processes', os.cpu_count()))
+        logging.info(f'Generating products from {input_fits} with {processes} processes')
+        return ProductGenerator(input_fits, mask_fits, boundary, detections,
+                                get_product_executor(processes), 2 * processes)
+
+    return await open_cubelets(output_dir, output_filename,
+                               int(config.get('cubelet_bundle', 0)) == 1,
+                               parse_size(config.get('product_stream_threshold', STREAM_THRESHOLD)))
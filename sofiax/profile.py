@@ -0,0 +1,271 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import threading
+import collections
+
+from sofiax.metrics import add_stage_observer, remove_stage_observer, current_metrics
+
+
+PROFILE_INTERVAL = 0.01
+
+# deepest stack kept per sample
+MAX_DEPTH = 64
+
+# samples of the event loop waiting for I/O, see _leaf_stage
+_IDLE_FUNCTIONS = ('select', 'poll', 'epoll', 'kqueue', 'control')
+
+_profiler = None
+
+
+class InstanceProfile(object):
+    """Samples and query latencies of one instance (see InstanceMetrics).
+
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.path = None
+        self.stacks = collections.Counter()
+        self.samples = collections.Counter()
+        # samples of the process no stage claimed while the instance ran
+        self.unattributed = collections.Counter()
+        self.queries = collections.defaultdict(list)
+        self.query_errors = collections.Counter()
+
+    def summary(self, interval: float):
+        stages = {}
+        for stage, seconds in sorted(self.metrics.timers.items()):
+            running = self.samples[stage] * interval
+            stages[stage] = {
+                'seconds': round(seconds, 6),
+                'calls': self.metrics.calls[stage],
+                'samples': self.samples[stage],
+                'running_seconds': round(running, 6),
+                # time the stage's task spent awaiting I/O, locks or other tasks
+                'wait_seconds': round(max(seconds - running, 0.0), 6)
+            }
+
+        queries = {}
+        for query, elapsed in sorted(self.queries.items(), key=lambda q: -sum(q[1])):
+            elapsed = sorted(elapsed)
+            queries[query] = {
+                'calls': len(elapsed),
+                'seconds': round(sum(elapsed), 6),
+                'p50_seconds': round(elapsed[len(elapsed) // 2], 6),
+                'p95_seconds': round(elapsed[int(len(elapsed) * 0.95)], 6),
+                'max_seconds': round(elapsed[-1], 6),
+                'errors': self.query_errors[query]
+            }
+
+        return {
+            'run': self.metrics.run_name,
+            'instance': self.metrics.instance,
+            'interval_seconds': interval,
+            'stages': stages,
+            'samples': dict(sorted(self.samples.items())),
+            'unattributed_samples': dict(sorted(self.unattributed.items())),
+            'queries': queries
+        }
+
+    def collapsed_stacks(self):
+        """Samples in the collapsed stack format of flame graph tools, rooted
+        at their stage.
+
+        """
+        lines = []
+        for (stage, stack), count in sorted(self.stacks.items()):
+            frames = ';'.join(f'{name} ({os.path.basename(filename)}:{line})'
+                              for filename, name, line in stack)
+            lines.append(f'{stage};{frames} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler(object):
+    """Sampling profiler attributing the samples of the event loop thread to
+    the stage timer (see sofiax.metrics.timer) of the task that was running.
+
+    A thread reads the loop thread's stack every interval seconds. The frame
+    of each task running a stage is registered when the stage starts, and
+    the innermost registered frame on a sampled stack names the task, so
+    samples are attributed without tracing every call.
+
+    The sampler thread reads the stages of the tasks and updates the
+    counters of the profiles under a lock the event loop thread holds while
+    it changes the stages or adds or writes a profile.
+
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._tasks = {}
+        self._frames = {}
+        self._thread = None
+        self._thread_id = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        add_stage_observer(self._observe)
+        self._thread = threading.Thread(target=self._run, name='sofiax-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        remove_stage_observer(self._observe)
+
+    def profile(self, metrics):
+        profile = self._profiles.get(id(metrics))
+        if profile is None or profile.metrics is not metrics:
+            profile = InstanceProfile(metrics)
+            with self._lock:
+                self._profiles[id(metrics)] = profile
+        return profile
+
+    def _observe(self, metrics, stage: str, entering: bool):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            return
+        if task is None:
+            return
+
+        profile = self.profile(metrics) if entering else None
+        frame = task.get_coro().cr_frame
+        with self._lock:
+            stages = self._tasks.setdefault(task, [])
+            if entering:
+                if frame is not None:
+                    self._frames[frame] = task
+                stages.append((profile, stage))
+            elif stages:
+                stages.pop()
+            if not stages:
+                del self._tasks[task]
+                self._frames.pop(frame, None)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self._sample(frame)
+
+    def _sample(self, frame):
+        stack = []
+        task = None
+        while frame is not None:
+            if len(stack) < MAX_DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_name, frame.f_lineno))
+            if task is None:
+                task = self._frames.get(frame)
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+
+        with self._lock:
+            stages = self._tasks.get(task) if task is not None else None
+            if stages:
+                profile, stage = stages[-1]
+                profile.samples[stage] += 1
+                profile.stacks[(stage, stack)] += 1
+            else:
+                leaf = _leaf_stage(stack)
+                for profile in self._profiles.values():
+                    profile.unattributed[leaf] += 1
+
+    def log_query(self, record):
+        # called on the event loop in the context of the query
+        metrics = current_metrics()
+        if metrics is None:
+            return
+        profile = self.profile(metrics)
+        query = ' '.join(record.query.split())[:200]
+        profile.queries[query].append(record.elapsed)
+        if record.exception is not None:
+            profile.query_errors[query] += 1
+
+    def write(self, metrics):
+        """Write the profile bundle of an instance to the path set with
+        set_profile_path: profile.json and stacks.txt.
+
+        """
+        with self._lock:
+            profile = self._profiles.pop(id(metrics), None)
+            if profile is None or profile.path is None:
+                return
+            # a stage still open in a task can sample into the profile
+            summary = profile.summary(self.interval)
+            stacks = profile.collapsed_stacks()
+        os.makedirs(profile.path, exist_ok=True)
+        summary['written'] = time.time()
+        with open(os.path.join(profile.path, 'profile.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(profile.path, 'stacks.txt'), 'w') as f:
+            f.write(stacks)
+        logging.info(f'Profile written to {profile.path}')
+
+
+def _leaf_stage(stack: tuple):
+    if stack and stack[-1][1] in _IDLE_FUNCTIONS:
+        return 'idle'
+    return 'other'
+
+
+def start_profiling(interval: float = PROFILE_INTERVAL):
+    """Start the process-wide profiler, called from the event loop thread.
+
+    """
+    global _profiler
+    _profiler = Profiler(interval)
+    _profiler.start()
+    return _profiler
+
+
+def stop_profiling():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profile_path(path: str):
+    """Directory the profile bundle of the current instance is written to.
+
+    """
+    metrics = current_metrics()
+    if _profiler is not None and metrics is not None:
+        _profiler.profile(metrics).path = path
+
+
+def write_profile(metrics):
+    if _profiler is not None and metrics is not None:
+        _profiler.write(metrics)
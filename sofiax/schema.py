@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import json
+import logging
+import asyncpg
+
+from sofiax.db import SOURCE_MATCH, db_check_detection_columns
+from sofiax.columns import INSERT_COLUMNS, CONFLICT_COLUMNS
+
+
+class Index(object):
+    """An index the SoFiAX queries rely on. An existing index of the table
+    whose definition contains signature is accepted in its place.
+
+    """
+    def __init__(self, name: str, table: str, definition: str, signature: str):
+        self.name = name
+        self.table = table
+        self.definition = definition
+        self.signature = signature
+
+    def create_sql(self, schema: str):
+        return f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.name} \
+            ON {schema}.{self.table} USING {self.definition}'
+
+
+INDEXES = (
+    # run lookups of the match query, db_run_detections and db_match_bounds
+    Index('detection_run_id_idx', 'detection', 'btree (run_id)',
+          'using btree (run_id'),
+    # instance deletes cascading to their detections
+    Index('detection_instance_id_idx', 'detection', 'btree (instance_id)',
+          'using btree (instance_id'),
+    # bounding box prefilter of the match query
+    Index('detection_xyz_nd_idx', 'detection',
+          'gist ((ST_MakePoint(x, y, z)) gist_geometry_ops_nd)',
+          'st_makepoint(x, y, z) gist_geometry_ops_nd'),
+)
+
+
+async def missing_indexes(conn, schema: str):
+    result = await conn.fetch(
+        'SELECT tablename, indexname, indexdef FROM pg_indexes WHERE schemaname=$1',
+        schema
+    )
+    missing = []
+    for index in INDEXES:
+        found = [r for r in result if r['tablename'] == index.table and (
+            r['indexname'] == index.name or index.signature in r['indexdef'].lower())]
+        if not found:
+            missing.append(index)
+    return missing
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+async def explain_match(conn, schema: str):
+    """Index names used by the match query, planned with sequential scans
+    disabled so a small table still shows whether an index can be used.
+
+    """
+    sample = await conn.fetchrow(
+        f'SELECT run_id, x, y, z, err_x, err_y, err_z FROM {schema}.detection LIMIT 1')
+    if sample is None:
+        sample = {'run_id': 0, 'x': 0.0, 'y': 0.0, 'z': 0.0,
+                  'err_x': 1.0, 'err_y': 1.0, 'err_z': 1.0}
+
+    async with conn.transaction():
+        await conn.execute('SET LOCAL enable_seqscan = off')
+        plan = await conn.fetchval(
+            'EXPLAIN (FORMAT JSON) ' + SOURCE_MATCH.format(schema=schema, uncertainty_sigma=5),
+            sample['x'], sample['y'], sample['z'],
+            sample['err_x'], sample['err_y'], sample['err_z'], sample['run_id'],
+            sample['x'] - 1, sample['y'] - 1, sample['z'] - 1,
+            sample['x'] + 1, sample['y'] + 1, sample['z'] + 1)
+
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return sorted(set(n['Index Name'] for n in _plan_nodes(plan[0]['Plan']) if 'Index Name' in n))
+
+
+async def explain_insert(conn, schema: str):
+    """Arbiter indexes of the detection insert ON CONFLICT clause.
+
+    """
+    columns = ', '.join(INSERT_COLUMNS)
+    values = ', '.join(f'${i}' for i in range(1, len(INSERT_COLUMNS) + 1))
+    plan = await conn.fetchval(
+        f'EXPLAIN (FORMAT JSON) INSERT INTO {schema}.detection ({columns}) \
+        VALUES ({values}) ON CONFLICT ({", ".join(CONFLICT_COLUMNS)}) \
+        DO UPDATE SET ra=EXCLUDED.ra RETURNING id',
+        *([None] * len(INSERT_COLUMNS)))
+
+    plan = json.loads(plan) if isinstance(plan, str) else plan
+    return plan[0]['Plan'].get('Conflict Arbiter Indexes', [])
+
+
+async def check_schema(conn, schema: str, apply: bool = False):
+    """Report (and with apply, create) the indexes the SoFiAX queries need and
+    verify with EXPLAIN that the match and insert statements use them.
+
+    Returns True if nothing is missing.
+
+    """
+    ok = True
+    try:
+        await db_check_detection_columns(conn, schema)
+    except ValueError as e:
+        logging.error(e)
+        ok = False
+
+    missing = await missing_indexes(conn, schema)
+    for index in missing:
+        if apply:
+            logging.info(f'Creating index {schema}.{index.name} on {index.table}')
+            await conn.execute(index.create_sql(schema))
+        else:
+            logging.warning(f'Missing index on {schema}.{index.table}: {index.definition}')
+            ok = False
+
+    if apply and missing:
+        await conn.execute(f'ANALYZE {schema}.detection')
+
+    used = await explain_match(conn, schema)
+    if used:
+        logging.info(f'Match query uses indexes: {", ".join(used)}')
+    else:
+        logging.warning('Match query can not use an index')
+        ok = False
+
+    arbiters = await explain_insert(conn, schema)
+    if arbiters:
+        logging.info(f'Detection insert conflict arbiter: {", ".join(arbiters)}')
+    else:
+        logging.warning('Detection insert has no unique index for ON CONFLICT')
+        ok = False
+
+    return ok
+
+
+async def run_schema_command(config, action: str):
+    schema = config.get('db_schema', 'wallaby')
+    conn = await asyncpg.connect(
+        user=config['db_username'],
+        password=config['db_password'],
+        database=config['db_name'],
+        host=config['db_hostname'],
+        port=config['db_port']
+    )
+    try:
+        return await check_schema(conn, schema, action == 'apply')
+    finally:
+        await conn.close()
@@ -0,0 +1,391 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import json
+import asyncio
+import sqlite3
+import contextlib
+
+from sofiax.backend import Backend, InstanceWrites
+from sofiax.db import MatchBounds, Instance, source_match, _select_products
+from sofiax.metrics import timed, incr
+from sofiax.conflict import assign_groups
+from sofiax.utils import read_column
+from sofiax.columns import DETECTION_COLUMNS, INSERT_COLUMNS, CONFLICT_COLUMNS, \
+    MATCH_COLUMNS, PRODUCT_COLUMNS, missing_columns
+
+
+_COLUMN_TYPES = {'name': 'TEXT', 'flag': 'INTEGER'}
+
+_DETECTION_COLUMNS_SQL = ', '.join(
+    f'{name} {_COLUMN_TYPES.get(name, "REAL")}' for name in DETECTION_COLUMNS)
+_PRODUCT_COLUMNS_SQL = ', '.join(f'{name} BLOB' for name in PRODUCT_COLUMNS)
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS run ( \
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, sanity_thresholds TEXT)',
+    'CREATE TABLE IF NOT EXISTS instance ( \
+        id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL REFERENCES run(id) ON DELETE CASCADE, \
+        run_date TEXT, filename TEXT NOT NULL, boundary TEXT NOT NULL, flag_log BLOB, \
+        reliability_plot BLOB, log BLOB, parameters TEXT, version TEXT, return_code INTEGER, \
+        stdout BLOB, stderr BLOB, UNIQUE (run_id, filename, boundary))',
+    f'CREATE TABLE IF NOT EXISTS detection ( \
+        id INTEGER PRIMARY KEY, \
+        run_id INTEGER NOT NULL REFERENCES run(id) ON DELETE CASCADE, \
+        instance_id INTEGER NOT NULL REFERENCES instance(id) ON DELETE CASCADE, \
+        unresolved BOOLEAN NOT NULL DEFAULT 0, access_url TEXT, {_DETECTION_COLUMNS_SQL}, \
+        UNIQUE ({", ".join(CONFLICT_COLUMNS)}))',
+    f'CREATE TABLE IF NOT EXISTS product ( \
+        id INTEGER PRIMARY KEY, \
+        detection_id INTEGER NOT NULL UNIQUE REFERENCES detection(id) ON DELETE CASCADE, \
+        {_PRODUCT_COLUMNS_SQL})',
+    'CREATE INDEX IF NOT EXISTS detection_run_id_idx ON detection (run_id)',
+    # points of the detections, the bounding box prefilter of the match
+    'CREATE VIRTUAL TABLE IF NOT EXISTS detection_rtree USING rtree( \
+        id, x_min, x_max, y_min, y_max, z_min, z_max)',
+    'CREATE TRIGGER IF NOT EXISTS detection_rtree_insert AFTER INSERT ON detection \
+        WHEN new.x IS NOT NULL AND new.y IS NOT NULL AND new.z IS NOT NULL BEGIN \
+        INSERT INTO detection_rtree VALUES (new.id, new.x, new.x, new.y, new.y, new.z, new.z); \
+        END',
+    'CREATE TRIGGER IF NOT EXISTS detection_rtree_delete AFTER DELETE ON detection BEGIN \
+        DELETE FROM detection_rtree WHERE id=old.id; \
+        END',
+    'CREATE TRIGGER IF NOT EXISTS detection_rtree_update AFTER UPDATE OF x, y, z ON detection \
+        BEGIN \
+        DELETE FROM detection_rtree WHERE id=old.id; \
+        INSERT INTO detection_rtree SELECT new.id, new.x, new.x, new.y, new.y, new.z, new.z \
+        WHERE new.x IS NOT NULL AND new.y IS NOT NULL AND new.z IS NOT NULL; \
+        END'
+]
+
+# the R*Tree stores 32 bit floats rounded outwards, so the box only
+# prefilters and the exact test is source_match
+SOURCE_MATCH = """SELECT
+    d.id, d.instance_id, x, y, z, err_x, err_y, err_z, f_sum, ell_maj,
+    ell_min, w50, w20, flag, unresolved
+    FROM detection_rtree AS r JOIN detection AS d ON d.id = r.id
+    WHERE
+    r.x_max >= ? AND r.x_min <= ? AND r.y_max >= ? AND r.y_min <= ?
+    AND r.z_max >= ? AND r.z_min <= ?
+    AND d.run_id = ?
+    ORDER BY d.id ASC"""
+
+_DETECTION_INSERT = (
+    f'INSERT INTO detection ({", ".join(INSERT_COLUMNS)}) '
+    f'VALUES ({", ".join("?" * len(INSERT_COLUMNS))}) '
+    f'ON CONFLICT ({", ".join(CONFLICT_COLUMNS)}) '
+    'DO UPDATE SET ra=excluded.ra, unresolved=excluded.unresolved '
+    'RETURNING id, access_url'
+)
+
+_INSTANCE_COLUMNS = ('run_id', 'run_date', 'filename', 'boundary') + tuple(
+    Instance.COLUMNS[name] for name in Instance.COLUMNS if name != 'run_date')
+
+_databases = {}
+
+
+class _Database(object):
+    """A SQLite connection shared by every backend of the process opened on
+    the same path. SQLite calls do not yield to the event loop, a task holds
+    the connection for the span of its transaction.
+
+    """
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.lock = asyncio.Lock()
+        self.owner = None
+
+    def create_schema(self, group_column: str = None, metrics_column: str = None):
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self._add_column('detection', group_column, 'INTEGER')
+        self._add_column('instance', metrics_column, 'TEXT')
+
+    def _add_column(self, table: str, column: str, column_type: str):
+        if not column:
+            return
+        columns = [r['name'] for r in self.conn.execute(f'PRAGMA table_info({table})')]
+        if column not in columns:
+            self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        task = asyncio.current_task()
+        if self.owner is task:
+            yield
+            return
+
+        async with self.lock:
+            self.owner = task
+            try:
+                yield
+            finally:
+                self.owner = None
+
+
+def _instance_value(instance: Instance, name: str):
+    if name == 'boundary':
+        return json.dumps(instance.boundary)
+    if name == 'parameters':
+        return json.dumps(instance.params)
+    if name == 'run_date':
+        return None if instance.run_date is None else instance.run_date.isoformat()
+    return getattr(instance, name)
+
+
+def _row(row):
+    record = dict(row)
+    record['unresolved'] = bool(record['unresolved'])
+    return record
+
+
+class SQLiteBackend(Backend):
+    """Embedded storage in a SQLite file (or :memory:) with the same match,
+    insert, delete and unresolved semantics as PostgreSQL, for tuning and
+    testing the merge without a database server.
+
+    """
+    def __init__(self, database: _Database):
+        self.database = database
+        self.conn = database.conn
+        self.writes = InstanceWrites()
+
+    @classmethod
+    async def connect(cls, config):
+        path = config.get('db_path', ':memory:')
+        database = _databases.get(path)
+        if database is None:
+            database = _Database(path)
+            database.create_schema(read_column(config, 'unresolved_group_column'),
+                                   read_column(config, 'metrics_column'))
+            _databases[path] = database
+        return cls(database)
+
+    def transaction(self):
+        return self.writes.track(self._transaction())
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        async with self.database.exclusive():
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    async def close(self):
+        # the connection is shared with the other backends of the path
+        pass
+
+    async def check_detection_columns(self):
+        result = self.conn.execute('PRAGMA table_info(detection)')
+        missing = missing_columns([r['name'] for r in result])
+        if missing:
+            raise ValueError(f'detection is missing columns: {", ".join(missing)}')
+
+    async def run_upsert(self, run):
+        async with self.database.exclusive():
+            row = self.conn.execute(
+                'INSERT INTO run (name, sanity_thresholds) VALUES (?, ?) \
+                ON CONFLICT (name) DO UPDATE SET name=excluded.name RETURNING id',
+                (run.name, json.dumps(run.sanity_thresholds))).fetchone()
+        run.run_id = row[0]
+        return run
+
+    @timed('lock_wait')
+    async def lock_run(self, run):
+        # the transaction already holds the database exclusively
+        pass
+
+    @timed('instance_write')
+    async def instance_upsert(self, instance):
+        written = set(instance.changed)
+        async with self.database.exclusive():
+            changed = sorted(written)
+            if instance.instance_id is not None:
+                if changed:
+                    columns = ', '.join(f'{Instance.COLUMNS[name]}=?' for name in changed)
+                    cursor = self.conn.execute(
+                        f'UPDATE instance SET {columns} WHERE id=?',
+                        [_instance_value(instance, Instance.COLUMNS[name]) for name in changed] + [
+                            instance.instance_id])
+                    if cursor.rowcount == 0:
+                        instance.instance_id = None
+                if instance.instance_id is not None:
+                    instance.changed.clear()
+                    self.writes.written(instance, written)
+                    return instance
+
+            row = self.conn.execute(
+                f'INSERT INTO instance ({", ".join(_INSTANCE_COLUMNS)}) \
+                VALUES ({", ".join("?" * len(_INSTANCE_COLUMNS))}) \
+                ON CONFLICT (run_id, filename, boundary) DO UPDATE SET \
+                {", ".join(f"{c}=excluded.{c}" for c in _INSTANCE_COLUMNS)} \
+                RETURNING id',
+                [_instance_value(instance, name) for name in _INSTANCE_COLUMNS]).fetchone()
+        instance.instance_id = row[0]
+        instance.changed.clear()
+        self.writes.written(instance, written)
+        return instance
+
+    async def instance_metrics(self, column, instance, metrics):
+        async with self.database.exclusive():
+            self.conn.execute(f'UPDATE instance SET {column}=? WHERE id=?',
+                              (json.dumps(metrics), instance.instance_id))
+
+    @timed('match_query')
+    async def match_bounds(self, run_id):
+        row = self.conn.execute(
+            'SELECT max(max(abs(err_x), abs(err_y))) AS err_xy, max(abs(err_z)) AS err_z \
+            FROM detection WHERE run_id=?', (run_id,)).fetchone()
+        return MatchBounds(row['err_xy'], row['err_z'])
+
+    @timed('match_query')
+    async def source_match(self, run_id, detection, uncertainty_sigma, bounds):
+        if any(detection[k] is None for k in ('x', 'y', 'z', 'err_x', 'err_y', 'err_z')):
+            return []
+
+        x0, y0, z0, x1, y1, z1 = bounds.box(detection, uncertainty_sigma)
+        result = [_row(r) for r in self.conn.execute(
+            SOURCE_MATCH, (x0, x1, y0, y1, z0, z1, run_id))
+            if source_match(detection, r, uncertainty_sigma)]
+
+        for i, j in enumerate(result):
+            # do not want the original detection if it already exists
+            if j['x'] == detection['x'] and j['y'] == detection['y'] and j['z'] == detection['z']:
+                result.pop(i)
+                break
+        return result
+
+    def _insert_row(self, vo_datalink_url, run_id, instance_id, detection, unresolved):
+        row = self.conn.execute(
+            _DETECTION_INSERT,
+            (run_id, instance_id, unresolved, *detection.values(), None)).fetchone()
+        if row['access_url'] is None:
+            # access_url is completed with the id of the new detection
+            self.conn.execute('UPDATE detection SET access_url=? WHERE id=?',
+                              (f'{vo_datalink_url}{row["id"]}', row['id']))
+        return row['id']
+
+    @timed('detection_insert')
+    async def detection_row_insert(self, vo_datalink_url, run_id, instance_id, detection,
+                                   unresolved=False):
+        async with self.database.exclusive():
+            return self._insert_row(vo_datalink_url, run_id, instance_id, detection, unresolved)
+
+    @timed('detection_insert')
+    async def detection_rows_insert(self, vo_datalink_url, run_id, rows):
+        # no COPY in SQLite, the rows are inserted in one hold of the connection
+        async with self.database.exclusive():
+            return [self._insert_row(vo_datalink_url, run_id, instance_id, detection, unresolved)
+                    for instance_id, detection, unresolved in rows]
+
+    @timed('product_insert')
+    async def detection_product_insert(self, detection_id, *products):
+        keep = _select_products(detection_id, [0 if p is None else len(p) for p in products])
+        if keep is None:
+            return
+        products = [p if k else None for p, k in zip(products, keep)]
+        incr('bytes_uploaded', sum(len(p) for p in products if p is not None))
+        async with self.database.exclusive():
+            self.conn.execute(
+                f'INSERT INTO product (detection_id, {", ".join(PRODUCT_COLUMNS)}) \
+                VALUES ({", ".join("?" * (len(PRODUCT_COLUMNS) + 1))}) \
+                ON CONFLICT (detection_id) DO NOTHING',
+                (detection_id, *products))
+
+    async def detection_insert(self, vo_datalink_url, run_id, instance_id, detection,
+                               cube, mask, mom0, mom1, mom2, chan, spec, pv,
+                               unresolved=False):
+        detection_id = await self.detection_row_insert(
+            vo_datalink_url, run_id, instance_id, detection, unresolved)
+        await self.detection_product_insert(detection_id, cube, mask, mom0, mom1, mom2,
+                                            chan, spec, pv)
+        return detection_id
+
+    async def detection_product_copy(self, detection_id, sizes, stream):
+        products = []
+        for index, size in enumerate(sizes):
+            if size == 0:
+                products.append(None)
+                continue
+            data = b''.join([chunk async for chunk in stream(index)])
+            if len(data) != size:
+                raise ValueError(f'{PRODUCT_COLUMNS[index]} for {detection_id} changed while streaming')
+            products.append(data)
+        incr('products_streamed')
+        await self.detection_product_insert(detection_id, *products)
+
+    @timed('detection_delete')
+    async def delete_detection(self, detection_id):
+        incr('detections_deleted')
+        async with self.database.exclusive():
+            self.conn.execute('DELETE FROM detection WHERE id=?', (detection_id,))
+
+    @timed('detection_delete')
+    async def delete_detections(self, detection_id_list):
+        incr('detections_deleted', len(detection_id_list))
+        async with self.database.exclusive():
+            self.conn.executemany('DELETE FROM detection WHERE id=?',
+                                  [(i,) for i in detection_id_list])
+
+    @timed('unresolved_update')
+    async def update_detection_unresolved(self, unresolved, detection_id_list):
+        async with self.database.exclusive():
+            self.conn.executemany('UPDATE detection SET unresolved=? WHERE id=?',
+                                  [(unresolved, i) for i in detection_id_list])
+
+    async def detection_groups(self, column, detection_id_list):
+        groups = {}
+        for i in detection_id_list:
+            row = self.conn.execute(f'SELECT id, {column} FROM detection WHERE id=?', (i,)).fetchone()
+            if row is not None:
+                groups[row['id']] = row[column]
+        return groups
+
+    @timed('unresolved_update')
+    async def update_unresolved_groups(self, column, run_id, groups, inherited=None):
+        ids = [i for group in groups for i in group]
+        if not ids:
+            return
+
+        async with self.database.exclusive():
+            existing = await self.detection_groups(column, ids)
+            for i, group_id in (inherited or {}).items():
+                if existing.get(i) is None:
+                    existing[i] = group_id
+            members, renamed = assign_groups(groups, existing)
+
+            self.conn.executemany(
+                f'UPDATE detection SET unresolved=1, {column}=? WHERE id=?',
+                [(group_id, i) for i, group_id in members.items()])
+            self.conn.executemany(
+                f'UPDATE detection SET {column}=? WHERE run_id=? AND {column}=?',
+                [(group_id, run_id, old) for old, group_id in renamed.items()])
+
+    @timed('run_detections')
+    async def run_detections(self, run_id):
+        result = self.conn.execute(
+            f'SELECT id, {", ".join(MATCH_COLUMNS)}, unresolved FROM detection \
+            WHERE run_id=? ORDER BY id ASC', (run_id,))
+        return [_row(r) for r in result]
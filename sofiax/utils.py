@@ -1,3 +1,21 @@
+import os
+import re
+import aiofiles
+import configparser
+
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse_config(file):
+    """Read config.ini file.
+
+    """
+    config = configparser.ConfigParser()
+    config.read(file)
+    return config["SoFiAX"]
+
+
 def read_config(config, parameter):
     """Read the value of a parameter in the config file or raise an error.
 
@@ -6,3 +24,34 @@ def read_config(config, parameter):
     if param is None:
         raise ValueError(f"{parameter} is not defined in configuration.")
     return param
+
+
+def read_column(config, parameter):
+    """Read an optional column name in the config file, None if not set. It
+    is written into SQL statements, so only a plain identifier is accepted.
+
+    """
+    column = config.get(parameter, None)
+    if not column:
+        return None
+    if _IDENTIFIER.match(column) is None:
+        raise ValueError(f"{parameter} {column!r} is not a valid column name.")
+    return column
+
+
+async def get_file_bytes(path: str, mode: str = 'rb'):
+    buffer = []
+
+    if not os.path.isfile(path):
+        return b''
+
+    async with aiofiles.open(path, mode) as f:
+        while True:
+            buff = await f.read()
+            if not buff:
+                break
+            buffer.append(buff)
+        if 'b' in mode:
+            return b''.join(buffer)
+        else:
+            return ''.join(buffer)
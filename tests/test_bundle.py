@@ -0,0 +1,68 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import asyncio
+import tempfile
+import unittest
+
+from unittest import mock
+
+from sofiax import db
+from sofiax.bundle import CubeletBundle, build_bundle, PRODUCT_CHUNK
+
+
+class BundleStreamTest(unittest.TestCase):
+    def test_close_with_chunk_held(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cubelets = os.path.join(tmp, 'out_cubelets')
+            os.makedirs(cubelets)
+            data = os.urandom(3 * PRODUCT_CHUNK + 10)
+            with open(os.path.join(cubelets, 'out_1_cube.fits'), 'wb') as f:
+                f.write(data)
+            path = os.path.join(tmp, 'out_cubelets.zip')
+            build_bundle(cubelets, path)
+
+            async def main():
+                bundle = CubeletBundle(path, 'out')
+                chunks = [chunk async for chunk in bundle.stream(1, 0)]
+                self.assertEqual(b''.join(chunks), data)
+
+                # an aborted COPY leaves its generator and last chunk behind
+                stream = bundle.stream(1, 0)
+                held = await stream.__anext__()
+                bundle.close()
+                self.assertEqual(held, data[:PRODUCT_CHUNK])
+
+            asyncio.run(main())
+
+
+class ProductInsertTest(unittest.TestCase):
+    def test_oversized_product_dropped(self):
+        conn = mock.AsyncMock()
+        products = [b'x' * 2000] + [b'y' * 10] * 7
+        with mock.patch.object(db, 'MAX_BYTEA', 1000):
+            asyncio.run(db.db_detection_product_insert(conn, 'wallaby', 1, *products))
+        args = conn.fetchrow.call_args.args
+        self.assertIsNone(args[2])
+        self.assertEqual(args[3:], tuple(products[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
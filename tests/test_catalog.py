@@ -0,0 +1,59 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import tempfile
+import unittest
+
+from benchmarks.synthetic import Layout, generate
+from sofiax.catalog import catalog_path, parse_catalog, ASCII_SUFFIX, XML_SUFFIX
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        generate(self.tmp.name, 200, Layout(2, 1, 100, 60, 0.2), cubelets=False, ascii=True)
+        self.base = os.path.join(self.tmp.name, 'tile_0_0', 'tile_0_0')
+
+    def test_ascii_and_votable_records_are_identical(self):
+        boundary = [100, 219, 0, 99, 0, 59]
+        run_date, version, ascii_catalog = parse_catalog(self.base + ASCII_SUFFIX, [0, 4], boundary)
+        xml_date, xml_version, xml_catalog = parse_catalog(self.base + XML_SUFFIX, [0, 4], boundary)
+
+        self.assertEqual((run_date, version), (xml_date, xml_version))
+        self.assertGreater(len(xml_catalog), 0)
+        self.assertEqual(ascii_catalog.ids, xml_catalog.ids)
+        for (_, a), (_, b) in zip(ascii_catalog.detections(), xml_catalog.detections()):
+            self.assertEqual(a.as_dict(), b.as_dict())
+
+    def test_catalog_path_follows_parameters(self):
+        output_dir, output_filename = os.path.split(self.base)
+        self.assertEqual(catalog_path({}, output_dir, output_filename), self.base + ASCII_SUFFIX)
+
+        # a stale ASCII catalog of an earlier run
+        params = {'output.writeCatASCII': 'false'}
+        self.assertEqual(catalog_path(params, output_dir, output_filename), self.base + XML_SUFFIX)
+
+        os.remove(self.base + ASCII_SUFFIX)
+        self.assertEqual(catalog_path({}, output_dir, output_filename), self.base + XML_SUFFIX)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import asyncio
+import tempfile
+import unittest
+
+from benchmarks.synthetic import Layout, generate
+from sofiax.memory import MemoryBudget, configure_memory
+from sofiax.merge import run_merge, run_settings
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    def test_waits_for_release(self):
+        async def main():
+            budget = MemoryBudget(100)
+            await budget.acquire(80)
+            waiter = asyncio.ensure_future(budget.acquire(50))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            budget.release(80)
+            self.assertEqual(await waiter, 50)
+            self.assertEqual(budget.used, 50)
+
+        asyncio.run(main())
+
+    def test_clamped_to_limit(self):
+        async def main():
+            budget = MemoryBudget(100)
+            self.assertEqual(await budget.acquire(500), 100)
+
+        asyncio.run(main())
+
+
+class ConcurrentMergeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(configure_memory, None)
+
+        layout = Layout(2, 2, 100, 60, 0.2)
+        self.params = generate(self.tmp.name, 200, layout)
+        self.config = {
+            'db_backend': 'sqlite',
+            'db_path': os.path.join(self.tmp.name, 'run.db'),
+            'sofia_execute': '0',
+            'sofia_path': 'sofia',
+            'run_name': 'memory',
+            'spatial_extent': '5, 5',
+            'spectral_extent': '5, 5',
+            'flux': '5',
+            'uncertainty_sigma': '5',
+            'quality_flags': '0, 4',
+            'parse_processes': '0',
+        }
+
+    def test_merge_under_memory_limit(self):
+        # an instance waiting on the run lock must not hold budget the
+        # instance holding the lock is waiting for
+        configure_memory(300000)
+        run_name, sanity, quality_flags = run_settings(self.config)
+
+        async def main():
+            await asyncio.wait_for(asyncio.gather(
+                run_merge(self.config, run_name, self.params[0::2], sanity, quality_flags),
+                run_merge(self.config, run_name, self.params[1::2], sanity, quality_flags)
+            ), timeout=60)
+
+        asyncio.run(main())
+
+
+if __name__ == '__main__':
+    unittest.main()
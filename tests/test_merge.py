@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import random
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+
+from benchmarks.synthetic import Layout, generate
+from sofiax.merge import run_merge, run_settings
+from sofiax.offline import run_offline_merge
+
+
+class SQLiteMergeTest(unittest.TestCase):
+    """run_merge of a synthetic field of 4 overlapping tiles against the
+    SQLite backend.
+
+    """
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+        layout = Layout(2, 2, 100, 60, 0.2)
+        self.params = generate(self.tmp.name, 200, layout)
+        self.config = {
+            'db_backend': 'sqlite',
+            'sofia_execute': '0',
+            'sofia_path': 'sofia',
+            'run_name': 'merge',
+            'spatial_extent': '5, 5',
+            'spectral_extent': '5, 5',
+            'flux': '5',
+            'uncertainty_sigma': '5',
+            'quality_flags': '0, 4',
+            'parse_processes': '0',
+        }
+
+    def merge(self, name: str, offline: bool = False, **settings):
+        config = dict(self.config, db_path=os.path.join(self.tmp.name, f'{name}.db'), **settings)
+        run_name, sanity, quality_flags = run_settings(config)
+        # equal detections are replaced at random
+        random.seed(1)
+        # run_merge consumes the parameter list
+        params = list(self.params)
+        if offline:
+            asyncio.run(run_offline_merge(config, run_name, params, sanity, quality_flags))
+        else:
+            asyncio.run(run_merge(config, run_name, params, sanity, quality_flags))
+
+        conn = sqlite3.connect(config['db_path'])
+        self.addCleanup(conn.close)
+        return conn
+
+    def counts(self, conn):
+        return conn.execute('SELECT COUNT(*), SUM(unresolved) FROM detection').fetchone()
+
+    def test_run_merge(self):
+        conn = self.merge('online')
+        self.assertEqual(self.counts(conn), (232, 65))
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM product').fetchone()[0], 232)
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM instance').fetchone()[0], 4)
+
+    def test_offline_merge_agrees(self):
+        self.assertEqual(self.counts(self.merge('offline', offline=True)),
+                         self.counts(self.merge('online')))
+
+    def test_generated_products_match_cubelets(self):
+        # the cubelets are cut out of the field and mask SoFiA reads
+        cubelets = self.merge('cubelets')
+        generated = self.merge('generated', generate_products='1', product_processes='1')
+        query = 'SELECT d.name, p.mom0, p.chan FROM detection d \
+            JOIN product p ON p.detection_id = d.id ORDER BY d.name, d.x'
+        self.assertEqual(cubelets.execute(query).fetchall(), generated.execute(query).fetchall())
+
+
+if __name__ == '__main__':
+    unittest.main()
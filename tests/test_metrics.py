@@ -0,0 +1,57 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import tempfile
+import unittest
+
+from sofiax.metrics import start_metrics, stop_metrics, all_metrics, incr, write_prometheus
+from sofiax.utils import read_column
+
+
+class MetricsTest(unittest.TestCase):
+    def test_stopped_instances_are_evicted(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.prom')
+            for i in range(3):
+                metrics = start_metrics('run', f'instance {i}')
+                incr('detections_deleted', i)
+                stop_metrics()
+                write_prometheus(path, metrics)
+                self.assertNotIn(metrics, all_metrics())
+
+            with open(path) as f:
+                content = f.read()
+            self.assertIn('instance="instance 2"', content)
+            self.assertNotIn('instance="instance 1"', content)
+            self.assertEqual(content.count('# TYPE sofiax_detections_deleted_total counter'), 1)
+
+
+class ReadColumnTest(unittest.TestCase):
+    def test_identifier(self):
+        self.assertEqual(read_column({'metrics_column': 'metrics'}, 'metrics_column'), 'metrics')
+        self.assertIsNone(read_column({}, 'metrics_column'))
+
+    def test_rejects_sql(self):
+        with self.assertRaises(ValueError):
+            read_column({'metrics_column': 'metrics=null; --'}, 'metrics_column')
+
+
+if __name__ == '__main__':
+    unittest.main()
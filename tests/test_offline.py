@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import unittest
+
+from sofiax.columns import Detection
+from sofiax.db import unique_rows
+from sofiax.offline import MergeEngine
+
+
+SANITY = {
+    'flux': 10,
+    'uncertainty_sigma': 5,
+    'spatial_extent': (10, 10),
+    'spectral_extent': (10, 10)
+}
+
+
+def detection(name, x, y, z, f_sum=100.0, flag=0, err=1.0):
+    return Detection.from_mapping({
+        'name': name, 'x': x, 'y': y, 'z': z, 'err_x': err, 'err_y': err,
+        'err_z': err, 'f_sum': f_sum, 'ell_maj': 5.0, 'ell_min': 3.0,
+        'w20': 50.0, 'w50': 40.0, 'flag': flag
+    })
+
+
+def stored(db_id, x, y, z, f_sum=100.0, flag=0, unresolved=False):
+    record = detection(f'stored {db_id}', x, y, z, f_sum, flag).as_dict()
+    record.update(id=db_id, unresolved=unresolved, err_x=1.0, err_y=1.0, err_z=1.0)
+    return record
+
+
+class MatchTest(unittest.TestCase):
+    def test_match_across_cells(self):
+        engine = MergeEngine(SANITY, cell_size=4)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0))
+        # 5 pixels and two cells away, within 5 sigma of both errors
+        matches = engine.match(detection('a', 13.0, 14.0, 10.0))
+        self.assertEqual([e.db_id for e in matches], [1])
+
+    def test_no_match_beyond_uncertainty(self):
+        engine = MergeEngine(SANITY, cell_size=4)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0))
+        self.assertEqual(engine.match(detection('a', 30.0, 10.0, 10.0)), [])
+        self.assertEqual(engine.match(detection('b', 10.0, 10.0, 30.0)), [])
+
+    def test_cell_size_does_not_change_matches(self):
+        positions = [(i * 3.7 % 50, i * 5.3 % 50, 10.0) for i in range(40)]
+        found = []
+        for cell_size in (1, 8, 1000):
+            engine = MergeEngine(SANITY, cell_size)
+            for i, (x, y, z) in enumerate(positions, start=1):
+                engine.add_existing(stored(i, x, y, z))
+            found.append([[e.db_id for e in engine.match(detection('a', x + 0.5, y, z))]
+                          for x, y, z in positions])
+        self.assertEqual(found[0], found[1])
+        self.assertEqual(found[0], found[2])
+
+    def test_same_position_excluded(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0))
+        self.assertEqual(engine.match(detection('a', 10.0, 10.0, 10.0)), [])
+
+    def test_missing_position_never_matches(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0))
+        self.assertEqual(engine.match(detection('a', None, 10.0, 10.0)), [])
+
+
+class MergeTest(unittest.TestCase):
+    def test_new_detection_inserted(self):
+        engine = MergeEngine(SANITY)
+        engine.merge(detection('a', 10.0, 10.0, 10.0), detect_id=1)
+        engine.merge(detection('b', 100.0, 10.0, 10.0), detect_id=2)
+        self.assertEqual([e.detect_id for e in engine.inserted], [1, 2])
+        self.assertEqual(engine.deleted, [])
+
+    def test_flag_zero_replaces_flag_four(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0, flag=4))
+        engine.merge(detection('a', 11.0, 10.0, 10.0, flag=0), detect_id=7)
+        self.assertEqual(engine.deleted, [1])
+        self.assertEqual([e.detect_id for e in engine.inserted], [7])
+
+    def test_flag_four_kept_behind_flag_zero(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0, flag=0))
+        engine.merge(detection('a', 11.0, 10.0, 10.0, flag=4), detect_id=7)
+        self.assertEqual(engine.deleted, [])
+        self.assertEqual(engine.inserted, [])
+
+    def test_failed_sanity_check_flags_both(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0, f_sum=100.0))
+        engine.merge(detection('a', 11.0, 10.0, 10.0, f_sum=200.0), detect_id=7)
+        self.assertEqual(engine.flagged, [1])
+        self.assertEqual([(e.detect_id, e.unresolved) for e in engine.inserted], [(7, True)])
+
+    def test_unresolved_groups_follow_matches(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0, f_sum=100.0))
+        engine.add_existing(stored(2, 200.0, 10.0, 10.0, f_sum=100.0))
+        # a conflicts with 1, b with a, c with 2: two groups
+        engine.merge(detection('a', 14.0, 10.0, 10.0, f_sum=200.0), detect_id=7)
+        engine.merge(detection('b', 18.0, 10.0, 10.0, f_sum=400.0), detect_id=8)
+        engine.merge(detection('c', 201.0, 10.0, 10.0, f_sum=300.0), detect_id=9)
+
+        groups = sorted(sorted(e.db_id or e.detect_id for e in g)
+                        for g in engine.unresolved_groups)
+        self.assertEqual(groups, [[1, 7, 8], [2, 9]])
+        self.assertEqual(engine.flagged, [1, 2])
+
+    def test_replacement_stays_in_group(self):
+        engine = MergeEngine(SANITY)
+        engine.add_existing(stored(1, 10.0, 10.0, 10.0, f_sum=100.0, flag=4))
+        engine.merge(detection('a', 14.0, 10.0, 10.0, f_sum=200.0, flag=4), detect_id=7)
+        # replaces a, staying unresolved and linked to 1 through it
+        engine.merge(detection('b', 14.5, 10.0, 10.0, f_sum=200.0, flag=0), detect_id=8)
+
+        self.assertEqual([(e.detect_id, e.unresolved) for e in engine.inserted], [(8, True)])
+        groups = [sorted(e.db_id or e.detect_id for e in g) for g in engine.unresolved_groups]
+        self.assertEqual(groups, [[1, 8]])
+
+    def test_direct_skips_matching(self):
+        engine = MergeEngine(SANITY)
+        engine.direct(detection('a', 10.0, 10.0, 10.0), detect_id=1)
+        engine.direct(detection('b', 10.5, 10.0, 10.0), detect_id=2)
+        self.assertEqual(len(engine.inserted), 2)
+        self.assertEqual(engine.conflict_groups(), [])
+
+
+class UniqueRowsTest(unittest.TestCase):
+    def row(self, name, ra=1.0, unresolved=False, **values):
+        row = detection(name, 10.0, 10.0, 10.0).as_dict()
+        # every column of the unique constraint set
+        row.update(x_min=5, x_max=15, y_min=5, y_max=15, z_min=0, z_max=20, n_pix=300,
+                   f_min=-0.1, f_max=2.0)
+        row.update(run_id=1, instance_id=1, ra=ra, unresolved=unresolved, **values)
+        return row
+
+    def test_duplicate_key_stored_once(self):
+        rows, index = unique_rows([self.row('a'), self.row('b'), self.row('a', 2.0, True)])
+        self.assertEqual(index, [0, 1, 0])
+        self.assertEqual([r['name'] for r in rows], ['a', 'b'])
+        # like a second upsert of the row
+        self.assertEqual((rows[0]['ra'], rows[0]['unresolved']), (2.0, True))
+
+    def test_null_never_equal(self):
+        rows, index = unique_rows([self.row('a', f_min=None), self.row('a', f_min=None)])
+        self.assertEqual(index, [0, 1])
+
+    def test_nan_equal(self):
+        rows, index = unique_rows([self.row('a', f_min=float('nan')),
+                                   self.row('a', f_min=float('nan'))])
+        self.assertEqual(index, [0, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from unittest import mock
+from astropy.io import fits
+
+from sofiax import products
+
+
+def write_cube(path: str, data):
+    header = fits.Header()
+    for axis, ctype, crval, cdelt in ((1, 'RA---SIN', 180.0, -0.001),
+                                      (2, 'DEC--SIN', -30.0, 0.001),
+                                      (3, 'FREQ', 1.4e9, 18500.0)):
+        header[f'CTYPE{axis}'] = ctype
+        header[f'CRVAL{axis}'] = crval
+        header[f'CDELT{axis}'] = cdelt
+        header[f'CRPIX{axis}'] = 1.0
+    fits.PrimaryHDU(data=data, header=header).writeto(path)
+
+
+class GenerateProductsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(products.close_files)
+
+        self.cube = os.path.join(self.tmp.name, 'cube.fits')
+        self.mask = os.path.join(self.tmp.name, 'mask.fits')
+        data = np.ones((8, 10, 10), dtype=np.float32)
+        mask = np.zeros((8, 10, 10), dtype=np.int32)
+        mask[2:5, 3:6, 3:6] = 7
+        write_cube(self.cube, data)
+        write_cube(self.mask, mask)
+
+    def test_moment_zero(self):
+        result = products.generate_products(self.cube, self.mask, [0, 9, 0, 9, 0, 7], 7,
+                                            (3, 5, 3, 5, 2, 4))
+        mom0 = fits.getdata(io.BytesIO(result[2]))
+        np.testing.assert_allclose(mom0, np.full((3, 3), 3 * 18500.0))
+
+    def test_chan_is_signal_to_noise(self):
+        result = products.generate_products(self.cube, self.mask, [0, 9, 0, 9, 0, 7], 7,
+                                            (3, 5, 3, 5, 2, 4), 0.5)
+        # 3 channels of 1 over a noise of 0.5 per channel
+        snr = fits.getdata(io.BytesIO(result[5]))
+        np.testing.assert_allclose(snr, np.full((3, 3), 3 / (0.5 * np.sqrt(3))), rtol=1e-6)
+
+    def test_chan_empty_without_rms(self):
+        result = products.generate_products(self.cube, self.mask, [0, 9, 0, 9, 0, 7], 7,
+                                            (3, 5, 3, 5, 2, 4))
+        self.assertEqual(result[5], b'')
+
+    def test_close_files(self):
+        cube = products._open_cube(self.cube)
+        products.close_files()
+        self.assertEqual(len(products._open_files), 0)
+        self.assertTrue(cube.hdul._file.closed)
+
+    def test_open_files_are_bounded(self):
+        with mock.patch.object(products, 'MAX_OPEN_FILES', 1):
+            first = products._open_cube(self.cube)
+            self.assertIs(products._open_cube(self.cube), first)
+            products._open_cube(self.mask)
+            self.assertEqual(len(products._open_files), 1)
+            self.assertTrue(first.hdul._file.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
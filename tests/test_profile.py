@@ -0,0 +1,82 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import sys
+import json
+import asyncio
+import tempfile
+import unittest
+
+from sofiax.metrics import start_metrics, stop_metrics
+from sofiax.profile import Profiler
+
+
+class ProfilerTest(unittest.TestCase):
+    def instance(self, name: str):
+        metrics = start_metrics('run', name)
+        stop_metrics()
+        return metrics
+
+    def test_unattributed_samples_per_instance(self):
+        profiler = Profiler()
+        first = self.instance('first')
+        profiler.profile(first)
+        profiler._sample(sys._getframe())
+
+        second = self.instance('second')
+        profiler.profile(second)
+        profiler._sample(sys._getframe())
+
+        with tempfile.TemporaryDirectory() as tmp:
+            profiles = {}
+            for metrics in (first, second):
+                profiler.profile(metrics).path = os.path.join(tmp, metrics.instance)
+                profiler.write(metrics)
+                with open(os.path.join(tmp, metrics.instance, 'profile.json')) as f:
+                    profiles[metrics.instance] = json.load(f)
+
+        self.assertEqual(profiles['first']['unattributed_samples'], {'other': 2})
+        self.assertEqual(profiles['second']['unattributed_samples'], {'other': 1})
+
+    def test_sampler_survives_stage_changes(self):
+        profiler = Profiler(interval=0.0001)
+        metrics = self.instance('stages')
+
+        async def main():
+            for _ in range(20000):
+                profiler._observe(metrics, 'merge', True)
+                profiler._observe(metrics, 'merge', False)
+            await asyncio.sleep(0)
+
+        # switch threads as often as possible to hit the loop mid change
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        profiler.start()
+        try:
+            asyncio.run(main())
+            self.assertTrue(profiler._thread.is_alive())
+        finally:
+            profiler.stop()
+            sys.setswitchinterval(switch)
+        self.assertEqual(profiler._tasks, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#
+# Copyright (c) 2021 AusSRC.
+#
+# This file is part of SoFiAX
+# (see https://github.com/AusSRC/SoFiAX).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.#
+
+import os
+import asyncio
+import tempfile
+import unittest
+
+from sofiax.columns import Detection
+from sofiax.db import Run, Instance
+from sofiax.sqlite import SQLiteBackend
+
+
+SANITY = {'flux': 5, 'uncertainty_sigma': 5, 'spatial_extent': (5, 5), 'spectral_extent': (5, 5)}
+
+
+class InstanceRollbackTest(unittest.TestCase):
+    def test_rolled_back_columns_are_written_again(self):
+        async def main(path):
+            backend = await SQLiteBackend.connect({'db_path': path})
+            run = await backend.run_upsert(Run('run', SANITY))
+            instance = Instance(run.run_id, None, 'cube.fits', [0, 1, 0, 1, 0, 1],
+                                None, None, None, {}, None, None, None, None)
+            await backend.instance_upsert(instance)
+
+            with self.assertRaises(RuntimeError):
+                async with backend.transaction():
+                    instance.stdout = b'merged'
+                    await backend.instance_upsert(instance)
+                    self.assertFalse(instance.changed)
+                    raise RuntimeError('merge failed')
+            self.assertEqual(instance.changed, {'stdout'})
+
+            async with backend.transaction():
+                await backend.instance_upsert(instance)
+            self.assertFalse(instance.changed)
+            row = backend.conn.execute('SELECT stdout FROM instance WHERE id=?',
+                                       (instance.instance_id,)).fetchone()
+            self.assertEqual(row[0], b'merged')
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(os.path.join(tmp, 'rollback.db')))
+
+
+class DetectionRowsTest(unittest.TestCase):
+    def test_duplicate_rows_share_an_id(self):
+        async def main(path):
+            backend = await SQLiteBackend.connect({'db_path': path})
+            run = await backend.run_upsert(Run('run', SANITY))
+            instance = await backend.instance_upsert(Instance(
+                run.run_id, None, 'cube.fits', [0, 1, 0, 1, 0, 1],
+                None, None, None, {}, None, None, None, None))
+            detection = Detection.from_mapping({
+                'name': 'a', 'x': 1.0, 'y': 2.0, 'z': 3.0, 'x_min': 0, 'x_max': 2,
+                'y_min': 1, 'y_max': 3, 'z_min': 2, 'z_max': 4, 'n_pix': 27, 'f_min': -0.1,
+                'f_max': 2.0, 'f_sum': 10.0, 'err_x': 1.0, 'err_y': 1.0, 'err_z': 1.0})
+            other = Detection.from_mapping(dict(detection.as_dict(), name='b'))
+            ids = await backend.detection_rows_insert(
+                'url?id=', run.run_id, [(instance.instance_id, detection, False),
+                                        (instance.instance_id, other, False),
+                                        (instance.instance_id, detection, True)])
+            self.assertEqual(ids[0], ids[2])
+            self.assertNotEqual(ids[0], ids[1])
+            row = backend.conn.execute('SELECT COUNT(*), SUM(unresolved) FROM detection').fetchone()
+            self.assertEqual(tuple(row), (2, 1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(os.path.join(tmp, 'rows.db')))
+
+
+if __name__ == '__main__':
+    unittest.main()